@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Room, RoomMember, Scene
+from .models import Asset, Room, RoomMember, Scene, SceneOp, TilePyramid, Token
 
 @admin.register(Room)
 class RoomAdmin(admin.ModelAdmin):
@@ -10,8 +10,8 @@ class RoomAdmin(admin.ModelAdmin):
 
 @admin.register(RoomMember)
 class RoomMemberAdmin(admin.ModelAdmin):
-    list_display = ['player_name', 'room', 'role', 'is_online', 'joined_at']
-    list_filter = ['role', 'is_online', 'joined_at']
+    list_display = ['player_name', 'room', 'role', 'joined_at']
+    list_filter = ['role', 'joined_at']
     search_fields = ['player_name', 'room__name', 'user__username']
 
 @admin.register(Scene)
@@ -21,3 +21,32 @@ class SceneAdmin(admin.ModelAdmin):
     search_fields = ['name', 'room__name']
     readonly_fields = ['created_at', 'updated_at']
     ordering = ['room', 'order', 'created_at']
+
+@admin.register(SceneOp)
+class SceneOpAdmin(admin.ModelAdmin):
+    list_display = ['scene', 'revision', 'kind', 'created_at']
+    list_filter = ['kind', 'scene__room']
+    search_fields = ['scene__name']
+    readonly_fields = ['scene', 'revision', 'kind', 'ops', 'inverse', 'created_at']
+    ordering = ['scene', '-revision']
+
+@admin.register(Token)
+class TokenAdmin(admin.ModelAdmin):
+    list_display = ['name', 'token_id', 'scene', 'grid_x', 'grid_y', 'visible', 'controlled_by']
+    list_filter = ['visible', 'scene__room']
+    search_fields = ['name', 'controlled_by', 'scene__name']
+    ordering = ['scene', 'order']
+
+@admin.register(Asset)
+class AssetAdmin(admin.ModelAdmin):
+    list_display = ['id', 'content_type', 'size', 'uploaded_by', 'created_at']
+    list_filter = ['content_type', 'created_at']
+    search_fields = ['id', 'uploaded_by__username']
+    readonly_fields = ['id', 'content_type', 'size', 'uploaded_by', 'created_at']
+
+@admin.register(TilePyramid)
+class TilePyramidAdmin(admin.ModelAdmin):
+    list_display = ['asset', 'width', 'height', 'tile_size', 'levels', 'format', 'created_at']
+    list_filter = ['format', 'created_at']
+    search_fields = ['asset__id']
+    readonly_fields = ['asset', 'width', 'height', 'tile_size', 'levels', 'format', 'created_at']
@@ -0,0 +1,156 @@
+"""
+Armazenamento das imagens (assets) endereçado pelo conteúdo.
+
+Cada imagem enviada é identificada pelo SHA-256 do seu conteúdo: o mesmo
+arquivo enviado de novo não é gravado outra vez, e o upload responde na hora
+com o asset que já existe. O cliente calcula o hash antes de enviar e, se o
+asset já existe (HEAD /assets/<id>/), nem faz o upload.
+
+As cenas guardam a referência 'asset:<id>' no imageSrc dos tokens e no
+backgroundImage, no lugar da URL completa. Como o conteúdo de um id nunca
+muda, /assets/<id>/ responde com cache de longa duração (immutable) e ETag.
+
+O backend de armazenamento é configurável (ASSET_STORAGE); o padrão grava os
+arquivos em ASSET_ROOT. Backends externos podem devolver uma URL própria em
+url(), e a view redireciona para ela; url(id, size) é a URL de uma variante
+reduzida (veja grid/variants.py). Quem serve o asset ao cliente só abre o
+arquivo (open) quando url() é None; open() de um backend externo baixa o
+conteúdo, para o que o servidor precisar processar.
+"""
+import hashlib
+import os
+import tempfile
+import urllib.error
+import urllib.request
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Prefixo das referências a assets no scene_data
+ASSET_SCHEME = 'asset:'
+
+# Cabeçalho (magic bytes) -> content type das imagens aceitas. SVG fica de fora:
+# pode carregar scripts e seria servido pelo domínio da aplicação
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def sniff_content_type(head):
+    """Content type a partir dos primeiros bytes do arquivo (None se não for uma imagem aceita)"""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def digest_file(file):
+    """SHA-256 (hex) do arquivo, lido em blocos; o arquivo volta para o início"""
+    sha256 = hashlib.sha256()
+    for chunk in file.chunks(CHUNK_SIZE):
+        sha256.update(chunk)
+    file.seek(0)
+    return sha256.hexdigest()
+
+
+def is_asset_id(value):
+    return len(value) == 64 and all(char in '0123456789abcdef' for char in value)
+
+
+def reference(asset_id):
+    return f'{ASSET_SCHEME}{asset_id}'
+
+
+class LocalAssetStorage:
+    """Arquivos em ASSET_ROOT, em subpastas pelos dois primeiros caracteres do id"""
+
+    def __init__(self, root=None):
+        self.root = str(root or settings.ASSET_ROOT)
+
+    def path(self, asset_id):
+        return os.path.join(self.root, asset_id[:2], asset_id)
+
+    def exists(self, asset_id):
+        return os.path.exists(self.path(asset_id))
+
+    def save(self, asset_id, file):
+        """Grava o conteúdo (arquivo temporário + rename: nunca fica um asset pela metade)"""
+        path = self.path(asset_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                for chunk in file.chunks(CHUNK_SIZE):
+                    output.write(chunk)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def open(self, asset_id):
+        return open(self.path(asset_id), 'rb')
+
+    def url(self, asset_id, size=None):
+        # Servido pela própria aplicação (asset_view e asset_variant_view)
+        return None
+
+
+class CloudinaryAssetStorage:
+    """Assets no Cloudinary (public_id derivado do id); a view redireciona para a CDN"""
+    folder = 'rpg_grid/assets'
+    # Segundos para baixar um original da CDN
+    timeout = 10
+
+    def public_id(self, asset_id):
+        return f'{self.folder}/{asset_id}'
+
+    def exists(self, asset_id):
+        # O modelo Asset já registra o que foi enviado: sem consulta à API
+        return True
+
+    def save(self, asset_id, file):
+        import cloudinary.uploader
+        cloudinary.uploader.upload(file, public_id=self.public_id(asset_id), resource_type='image', overwrite=False)
+
+    def open(self, asset_id):
+        """Baixa o original da CDN (resposta lida como arquivo); FileNotFoundError se não existe"""
+        try:
+            return urllib.request.urlopen(self.url(asset_id), timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            if error.code == 404:
+                raise FileNotFoundError(asset_id) from error
+            raise
+
+    def url(self, asset_id, size=None):
+        import cloudinary.utils
+        if size is None:
+            return cloudinary.utils.cloudinary_url(self.public_id(asset_id), secure=True)[0]
+        # Variante gerada e guardada pela própria CDN
+        return cloudinary.utils.cloudinary_url(
+            self.public_id(asset_id), secure=True, width=size, height=size, crop='limit', fetch_format='auto'
+        )[0]
+
+
+_storage = None
+
+
+def get_storage():
+    """Backend configurado em ASSET_STORAGE (instanciado no primeiro uso)"""
+    global _storage
+    if _storage is None:
+        backend = getattr(settings, 'ASSET_STORAGE', 'grid.assets.LocalAssetStorage')
+        _storage = import_string(backend)()
+    return _storage
+
+
+def reset_storage():
+    """Descarta o backend instanciado (após mudar as configurações, em testes)"""
+    global _storage
+    _storage = None
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core import checks
+
+# Caches que guardam tudo na memória do próprio processo
+LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@checks.register(checks.Tags.caches)
+def check_upload_job_cache(app_configs, **kwargs):
+    """
+    Com vários workers (CLUSTER_ENABLED), o job de upload é consultado em
+    qualquer worker: o estado dele não pode ficar no cache de um processo só.
+    """
+    if not getattr(settings, 'CLUSTER_ENABLED', False):
+        return []
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    if backend not in LOCAL_CACHES:
+        return []
+    return [checks.Error(
+        'O cache padrão é local ao processo, mas CLUSTER_ENABLED liga vários workers',
+        hint='Use um cache compartilhado (com REDIS_URL, o Redis) para o estado dos jobs de upload.',
+        id='grid.E001',
+    )]
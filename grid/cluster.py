@@ -0,0 +1,245 @@
+"""
+Vários workers atendendo as salas (CLUSTER_ENABLED).
+
+O RoomState de uma sala só existe em um processo. Com vários workers (um
+daphne por núcleo, com o channel layer no Redis), cada sala pertence a um
+worker escolhido por hash consistente do código da sala entre os workers
+vivos. Adicionar ou remover um worker move só as salas do trecho do anel que
+mudou de dono.
+
+Os workers se registram em um registro compartilhado (Redis, ou em memória
+para um processo só e para testes) e renovam o registro a cada
+CLUSTER_HEARTBEAT segundos; quem passa de CLUSTER_WORKER_TTL sem renovar é
+considerado morto e sai do anel.
+
+Roteamento: o socket que chega no worker errado é aceito e fechado com o
+código ROOM_MOVED e a URL do dono (CLUSTER_WORKER_URL dele) como motivo; o
+cliente reconecta direto nele. As páginas das salas já saem com a URL do dono.
+
+Quando o anel muda, o antigo dono grava a sala no banco e fecha as conexões
+com ROOM_MOVED; o novo dono carrega a sala do banco na primeira conexão. Se um
+worker morre, as alterações ainda não gravadas (até ROOM_STATE_FLUSH_INTERVAL)
+se perdem e a sala é recarregada do banco pelo próximo dono.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Código de fechamento do WebSocket: a sala está em outro worker (motivo = URL do worker)
+ROOM_MOVED = 4100
+
+# Pontos de cada worker no anel (mais pontos, distribuição mais uniforme)
+REPLICAS = 64
+
+
+def is_enabled():
+    return getattr(settings, 'CLUSTER_ENABLED', False)
+
+
+def heartbeat_interval():
+    return getattr(settings, 'CLUSTER_HEARTBEAT', 5)
+
+
+def worker_ttl():
+    return getattr(settings, 'CLUSTER_WORKER_TTL', 15)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """Anel de hash consistente: cada chave pertence ao próximo ponto do anel"""
+
+    def __init__(self, nodes, replicas=REPLICAS):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (_hash(f'{node}#{index}'), node)
+            for node in self.nodes
+            for index in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, _hash(key)) % len(self.hashes)
+        return self.owners[index]
+
+
+# ==================== Registro dos workers ====================
+
+class MemoryRegistry:
+    """Registro em memória: um processo só (ou vários workers simulados em testes)"""
+
+    def __init__(self):
+        self.workers = {}
+
+    async def heartbeat(self, worker_id, url, ttl):
+        self.workers[worker_id] = (url, time.time() + ttl)
+
+    async def remove(self, worker_id):
+        self.workers.pop(worker_id, None)
+
+    async def alive(self):
+        now = time.time()
+        return {worker_id: url for worker_id, (url, expires) in self.workers.items() if expires > now}
+
+
+class RedisRegistry:
+    """Registro no Redis: sorted set com a validade de cada worker e hash com as URLs"""
+    WORKERS_KEY = 'tabletop:cluster:workers'
+    URLS_KEY = 'tabletop:cluster:urls'
+
+    def __init__(self, url):
+        import redis.asyncio
+        self.redis = redis.asyncio.from_url(url, decode_responses=True)
+
+    async def heartbeat(self, worker_id, url, ttl):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(self.WORKERS_KEY, {worker_id: time.time() + ttl})
+            pipe.hset(self.URLS_KEY, worker_id, url)
+            await pipe.execute()
+
+    async def remove(self, worker_id):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(self.WORKERS_KEY, worker_id)
+            pipe.hdel(self.URLS_KEY, worker_id)
+            await pipe.execute()
+
+    async def alive(self):
+        now = time.time()
+        # Workers expirados saem do registro (quem morreu não se remove sozinho)
+        expired = await self.redis.zrangebyscore(self.WORKERS_KEY, '-inf', now)
+        if expired:
+            await self.redis.zrem(self.WORKERS_KEY, *expired)
+            await self.redis.hdel(self.URLS_KEY, *expired)
+        workers = await self.redis.zrangebyscore(self.WORKERS_KEY, now, '+inf')
+        if not workers:
+            return {}
+        urls = await self.redis.hmget(self.URLS_KEY, workers)
+        return dict(zip(workers, urls))
+
+
+def registry_from_settings():
+    """Redis de CLUSTER_REDIS_URL ou do channel layer; sem Redis, registro em memória"""
+    url = getattr(settings, 'CLUSTER_REDIS_URL', None)
+    layer = settings.CHANNEL_LAYERS['default']
+    if url is None and layer['BACKEND'].startswith('channels_redis.'):
+        from channels_redis.core import decode_hosts
+        host = decode_hosts(layer.get('CONFIG', {}).get('hosts'))[0]
+        url = host.get('address') or f"redis://{host['host']}:{host['port']}"
+    return RedisRegistry(url) if url else MemoryRegistry()
+
+
+# ==================== Worker ====================
+
+class Cluster:
+    def __init__(self, worker_id, url, registry):
+        self.worker_id = worker_id
+        self.url = url
+        self.registry = registry
+        self.ring = HashRing([worker_id])
+        self.urls = {worker_id: url}
+        self._task = None
+
+    async def start(self):
+        await self.registry.heartbeat(self.worker_id, self.url, worker_ttl())
+        await self.refresh()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.registry.remove(self.worker_id)
+
+    async def refresh(self):
+        """Relê os workers vivos e remonta o anel"""
+        workers = await self.registry.alive()
+        # Este worker está vivo enquanto roda, mesmo que o registro tenha falhado
+        workers.setdefault(self.worker_id, self.url)
+        if set(workers) != set(self.ring.nodes):
+            logger.info('Workers vivos no anel: %s', ', '.join(sorted(workers)))
+            self.ring = HashRing(workers)
+        self.urls = workers
+
+    def owner(self, room_code):
+        return self.ring.owner(room_code)
+
+    def is_local(self, room_code):
+        return self.owner(room_code) == self.worker_id
+
+    def url_for(self, room_code):
+        return self.urls.get(self.owner(room_code), '')
+
+    async def rebalance(self):
+        """Entrega as salas abertas aqui que passaram para outro worker"""
+        from . import room_state
+        for room_code in list(room_state._rooms):
+            if not self.is_local(room_code):
+                await room_state.hand_off(room_code, self.url_for(room_code))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(heartbeat_interval())
+            try:
+                await self.registry.heartbeat(self.worker_id, self.url, worker_ttl())
+                await self.refresh()
+                await self.rebalance()
+            except Exception:
+                logger.exception('Erro no heartbeat do worker %s', self.worker_id)
+
+
+_cluster = None
+_start_lock = None
+
+
+def default_worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+async def get_cluster():
+    """Worker deste processo (registrado no primeiro uso)"""
+    global _cluster, _start_lock
+    if _cluster is not None:
+        return _cluster
+    if _start_lock is None:
+        _start_lock = asyncio.Lock()
+    async with _start_lock:
+        if _cluster is None:
+            cluster = Cluster(
+                getattr(settings, 'CLUSTER_WORKER_ID', None) or default_worker_id(),
+                getattr(settings, 'CLUSTER_WORKER_URL', ''),
+                registry_from_settings(),
+            )
+            await cluster.start()
+            _cluster = cluster
+    return _cluster
+
+
+async def route(room_code):
+    """URL do worker dono da sala, ou None se a sala é deste processo"""
+    if not is_enabled():
+        return None
+    cluster = await get_cluster()
+    if cluster.is_local(room_code):
+        return None
+    return cluster.url_for(room_code)
+
+
+async def owner_url(room_code):
+    """URL do worker dono da sala para as páginas (None fora do modo cluster)"""
+    if not is_enabled():
+        return None
+    cluster = await get_cluster()
+    return cluster.url_for(room_code)
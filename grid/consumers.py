@@ -1,8 +1,19 @@
-import json
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 from django.contrib.auth.models import User
-from .models import Room, RoomMember, Scene
+from .models import Room, RoomMember
+from .frames import JSON, decode_message, encode_frame, negotiate
+from .outbox import SKIPPED, Outbox
+from .scene_ops import is_int, is_visible
+from .spatial import Viewport, viewport_margin
+from . import cluster, metrics, room_state, tracing
+
+# Ações conhecidas (rótulo das métricas; qualquer outra vira 'unknown')
+ACTIONS = {
+    'update_scene', 'switch_scene', 'patch_scene', 'undo', 'redo', 'move_token', 'heartbeat', 'ack', 'get_state',
+    'subscribe_viewport',
+}
 
 class GameRoomConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -10,284 +21,475 @@ class GameRoomConsumer(AsyncWebsocketConsumer):
         self.room_group_name = f'game_room_{self.room_code}'
         self.user = self.scope['user']
         
-        # Verifica se o usuário pode entrar na sala
-        can_join = await self.check_room_access()
-        
-        if not can_join:
-            await self.close()
+        # Com vários workers, cada sala é atendida só pelo worker dono dela
+        owner_url = await cluster.route(self.room_code)
+        if owner_url is not None:
+            await self.accept()
+            await self.close(code=cluster.ROOM_MOVED, reason=owner_url)
             return
         
-        # Entra no grupo da sala
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-        
-        await self.accept()
-        
-        # Marca membro como online
-        await self.set_member_online(True)
-        
-        # Envia estado atual da sala para o novo membro
-        room_data = await self.get_room_data()
-        await self.send(text_data=json.dumps({
-            'type': 'room_state',
-            'data': room_data
-        }))
-        
-        # Notifica outros membros
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'member_joined',
-                'member': await self.get_member_info()
-            }
-        )
+        with tracing.trace(self.room_code, 'connect'):
+            # Verifica se o usuário pode entrar na sala
+            with metrics.DB_CALL_SECONDS.time(helper='check_room_access'), tracing.span('db.check_room_access'):
+                can_join = await self.check_room_access()
+            
+            if not can_join:
+                await self.close()
+                return
+            
+            # Estado da sala em memória (carregado do banco apenas na primeira conexão)
+            try:
+                self.room_state = await room_state.acquire(self.room_code)
+            except Room.DoesNotExist:
+                await self.close()
+                return
+            
+            # Entra no grupo da sala
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+            
+            # Formato dos frames: JSON (padrão) ou MessagePack, se o cliente pedir o subprotocolo
+            self.wire_format, subprotocol = negotiate(self.scope.get('subprotocols'))
+            self.room_state.wire_formats[self.wire_format] += 1
+            # Fila de saída com controle de fluxo (clientes que confirmam os eventos)
+            self.outbox = Outbox()
+            # Área assinada pelo cliente (None: recebe a cena inteira) e tokens
+            # que ele tem, com o seq do estado em que cada um foi enviado
+            self.viewport = self.query_viewport()
+            self.known = None
+            
+            await self.accept(subprotocol=subprotocol)
+            
+            # Marca membro como online (presença em memória, sem escrita no banco)
+            member = self.room_state.member_connected(
+                self.channel_name, self.member_id, self.player_name, self.role
+            )
+            
+            # Cliente reconectando recebe só os eventos perdidos; os demais, o estado atual da sala
+            # (com viewport, só os tokens da área: os eventos do buffer não são filtrados)
+            missed = self.missed_frames() if self.viewport is None else None
+            if missed is None:
+                await self.send_room_state()
+            else:
+                for frame in missed:
+                    await self.send_encoded(frame)
+            
+            # Notifica outros membros (só na primeira conexão do membro)
+            if member is not None:
+                await self.broadcast('member_joined', {'member': member})
     
     async def disconnect(self, close_code):
-        # Marca membro como offline
-        await self.set_member_online(False)
+        if not hasattr(self, 'room_state'):
+            return
         
-        # Notifica outros membros
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'member_left',
-                'member': await self.get_member_info()
-            }
-        )
+        # Marca membro como offline e notifica os outros (se era sua última conexão)
+        member = self.room_state.member_disconnected(self.channel_name)
+        if member is not None:
+            await self.broadcast('member_left', {'member': member})
         
         # Sai do grupo
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
-    
-    async def receive(self, text_data):
-        data = json.loads(text_data)
-        action = data.get('action')
         
-        # Verifica se é mestre
-        is_master = await self.is_room_master()
+        # A última conexão grava a cena pendente no banco
+        self.room_state.wire_formats[self.wire_format] -= 1
+        await room_state.release(self.room_state)
+    
+    async def receive(self, text_data=None, bytes_data=None):
+        # Trace da mensagem (só com TRACING_* ligados ou perfil da sala em andamento)
+        with tracing.trace(self.room_code, 'receive') as trace:
+            started = metrics.now()
+            try:
+                with tracing.span('decode'):
+                    data = decode_message(text_data, bytes_data)
+            except (ValueError, TypeError):
+                # Mensagem malformada: ignora
+                return
+            action = data.get('action')
+            label = action if action in ACTIONS else 'unknown'
+            trace.set_action(label)
+            metrics.MESSAGES_RECEIVED.inc(action=label)
+            
+            # Qualquer mensagem vale como sinal de vida da conexão
+            self.room_state.heartbeat(self.channel_name)
+            
+            await self.handle_action(action, data)
+            metrics.RECEIVE_SECONDS.observe_since(started, action=label)
+    
+    async def handle_action(self, action, data):
+        # Papel resolvido na conexão (sem consulta ao banco por mensagem)
+        is_master = self.role == 'master'
         
         if action == 'update_scene' and is_master:
-            # Mestre atualiza a cena
+            # Mestre substitui a cena inteira, a partir da revisão que ele tem (if_match)
             scene_data = data.get('scene_data')
-            await self.save_scene_data(scene_data)
+            expected = data.get('if_match')
             
-            # Broadcast para todos os jogadores
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'scene_update',
-                    'scene_data': scene_data
-                }
-            )
+            # A troca de cena é feita via API: garante que o estado em memória está na cena ativa
+            await self.room_state.sync_active_scene()
+            # Movimentos pendentes saem antes, para manter a ordem das revisões
+            await self.room_state.flush_moves()
+            try:
+                self.room_state.replace_scene(scene_data, expected if isinstance(expected, int) else None)
+            except room_state.StaleRevision as error:
+                # A cena mudou desde a revisão do mestre: ele recarrega a cena em vez de sobrescrever
+                await self.send_encoded(encode_frame('scene_conflict', {'revision': error.revision}, self.wire_format))
+                return
+            except ValueError:
+                # Cena com tipos inválidos: devolve o estado completo para o mestre ressincronizar
+                await self.send_room_state()
+                return
+            
+            # Broadcast para todos; os jogadores recebem a projeção (sem tokens ocultos).
+            # A gravação fica com o write-behind da sala
+            await self.room_state.broadcast_scene()
+        
+        elif action == 'switch_scene' and is_master:
+            # O mestre trocou de cena via API: a sala recarrega a cena ativa do banco
+            # e envia para todos, sem gravar nada
+            await self.room_state.sync_active_scene()
+            await self.room_state.broadcast_scene()
+        
+        elif action == 'patch_scene' and is_master:
+            # Mestre envia apenas as alterações (delta) da cena
+            ops = data.get('ops')
+            # Movimentos pendentes saem antes, para manter a ordem das revisões
+            await self.room_state.flush_moves()
+            try:
+                with tracing.span('apply_ops'):
+                    revision, player_ops = self.room_state.apply_ops(ops)
+            except ValueError:
+                # Patch inválido: devolve o estado completo para o mestre ressincronizar
+                await self.send_room_state()
+                return
+            
+            if revision is not None:
+                # Broadcast apenas do delta (os jogadores não recebem operações em tokens ocultos)
+                await self.broadcast('scene_patch', {
+                    'ops': ops,
+                    'revision': revision
+                }, None if player_ops is ops else {
+                    'ops': player_ops,
+                    'revision': revision
+                })
+        
+        elif action in ('undo', 'redo') and is_master:
+            # Desfazer/refazer no servidor: as operações (inversas ou não) da última
+            # edição viram uma nova revisão, enviada como um scene_patch comum
+            await self.room_state.flush_moves()
+            history = self.room_state.undo() if action == 'undo' else self.room_state.redo()
+            if history is not None:
+                revision, ops, player_ops = history
+                # history: o mestre aplica estas operações na própria tela
+                await self.broadcast('scene_patch', {
+                    'ops': ops,
+                    'revision': revision,
+                    'history': action
+                }, None if player_ops is ops else {
+                    'ops': player_ops,
+                    'revision': revision
+                })
         
         elif action == 'move_token':
             # Jogador move seu token
             token_id = data.get('token_id')
             grid_x = data.get('gridX')
             grid_y = data.get('gridY')
-            player_name = self.scope['session'].get('player_name') if not self.user.is_authenticated else self.user.username
-            
-            # Buscar cena ativa e verificar permissão
-            can_move = await self.can_player_move_token(token_id, player_name)
+            player_name = self.player_name
+            if not (is_int(grid_x) and is_int(grid_y)):
+                # Posição inválida: ignora (não pode chegar ao banco)
+                return
             
-            if can_move:
-                # Atualizar posição do token na cena
-                await self.update_token_position(token_id, grid_x, grid_y)
-                
-                # Broadcast para todos
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        'type': 'token_moved',
-                        'token_id': token_id,
-                        'gridX': grid_x,
-                        'gridY': grid_y,
-                        'moved_by': player_name
-                    }
-                )
+            # Verifica permissão e move o token na cena em memória (sem acesso ao banco).
+            # O broadcast sai no próximo tick da sala, junto com os outros movimentos (tokens_moved)
+            with tracing.span('permission'):
+                allowed = self.room_state.can_move_token(token_id, player_name)
+            if allowed:
+                self.room_state.move_token(token_id, grid_x, grid_y, player_name)
+        
+        elif action == 'heartbeat':
+            # Apenas mantém a presença (já registrada acima)
+            pass
+        
+        elif action == 'ack':
+            # Cliente confirmou os eventos até seq: abre a janela e envia o que estava na fila
+            seq = data.get('seq')
+            if isinstance(seq, int):
+                self.outbox.ack(seq)
+                await self.flush_outbox()
         
         elif action == 'get_state':
-            # Jogador pede estado atual
-            room_data = await self.get_room_data()
-            await self.send(text_data=json.dumps({
-                'type': 'room_state',
-                'data': room_data
-            }))
+            # Jogador pede estado atual (também usado para ressincronizar quando fica para trás)
+            await self.send_room_state()
+        
+        elif action == 'subscribe_viewport' and not is_master:
+            # Jogador passa a receber só os tokens da área visível. O mestre fica
+            # de fora: o editor envia a cena inteira (update_scene) a partir do que tem
+            await self.subscribe_viewport(data)
     
-    # Handlers para mensagens do grupo
-    async def scene_update(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'scene_update',
-            'scene_data': event['scene_data']
-        }))
+    def query_viewport(self):
+        """Viewport informado na conexão (?viewport=x,y,largura,altura), só para jogadores"""
+        if self.role == 'master':
+            return None
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        if 'viewport' not in query:
+            return None
+        return Viewport.from_query(query['viewport'][0])
     
-    async def member_joined(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'member_joined',
-            'member': event['member']
-        }))
+    async def subscribe_viewport(self, data):
+        if data.get('width') is None:
+            # Sem área: volta a receber a cena inteira
+            if self.viewport is not None:
+                self.viewport = None
+                await self.send_room_state()
+            return
+        try:
+            viewport = Viewport.parse(data.get('x'), data.get('y'), data.get('width'), data.get('height'))
+        except ValueError:
+            return
+        
+        state = self.room_state
+        if self.known is None:
+            # Até agora o cliente recebia a cena inteira: tem todos os tokens que pode ver
+            self.known = {
+                token['id']: 0 for token in state.scene_data.get('tokens', [])
+                if self.role == 'master' or is_visible(token)
+            }
+        self.viewport = viewport
+        
+        # Quem entrou na área recebe o token; quem saiu (com folga, para não ir e
+        # voltar a cada pequeno deslocamento) é descartado pelo cliente
+        with tracing.span('viewport.query'):
+            tokens = state.tokens_in(viewport, self.role)
+        entering = [token for token in tokens if token['id'] not in self.known]
+        keep = viewport.expand(viewport_margin())
+        removed = [
+            token_id for token_id in self.known
+            if (token := state.index.get(token_id)) is None or not keep.contains(token)
+        ]
+        for token_id in removed:
+            del self.known[token_id]
+        await self.send_viewport_tokens(entering, removed)
     
-    async def member_left(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'member_left',
-            'member': event['member']
-        }))
+    async def send_viewport_tokens(self, tokens, removed=()):
+        if not tokens and not removed:
+            return
+        for token in tokens:
+            self.known[token['id']] = self.room_state.seq
+        frame = encode_frame('viewport_tokens', {'tokens': tokens, 'removed': list(removed)}, self.wire_format)
+        await self.send_encoded(frame)
     
-    async def token_moved(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'token_moved',
-            'token_id': event['token_id'],
-            'gridX': event['gridX'],
-            'gridY': event['gridY'],
-            'moved_by': event['moved_by']
-        }))
+    async def reconcile_viewport(self, token_ids):
+        """
+        Depois de um evento que alterou tokens: manda os que entraram na área
+        (os removidos saem do known junto com o remove_token, em viewport_patch_frame).
+        """
+        state = self.room_state
+        entering = []
+        for token_id in token_ids:
+            if token_id in self.known:
+                continue
+            token = state.index.get(token_id)
+            if token is None or not (self.role == 'master' or is_visible(token)):
+                continue
+            if self.viewport.contains(token):
+                entering.append(token)
+        await self.send_viewport_tokens(entering)
     
-    # Database queries
-    @database_sync_to_async
-    def check_room_access(self):
-        try:
-            room = Room.objects.get(code=self.room_code, is_active=True)
-            
-            # Se for usuário autenticado (mestre)
-            if self.user.is_authenticated:
-                # Verifica se é o mestre
-                if room.master == self.user:
-                    # Cria ou atualiza membro
-                    RoomMember.objects.update_or_create(
-                        room=room,
-                        user=self.user,
-                        defaults={
-                            'player_name': self.user.username,
-                            'role': 'master'
-                        }
-                    )
-                    return True
-            
-            # Para jogadores anônimos, verificamos na sessão
-            player_name = self.scope['session'].get('player_name')
-            if player_name:
-                # Cria membro como jogador
-                RoomMember.objects.get_or_create(
-                    room=room,
-                    player_name=player_name,
-                    defaults={'role': 'player'}
-                )
-                return True
-            
-            return False
-        except Room.DoesNotExist:
-            return False
+    def viewport_moves_frame(self, seq, revision, moves, frames):
+        """tokens_moved com os movimentos dos tokens que o cliente tem"""
+        known = self.known
+        # Tokens enviados depois do evento já estão na posição nova
+        visible = [move for move in moves if known.get(move['token_id'], seq) < seq]
+        if len(visible) == len(moves):
+            return frames.get(self.wire_format, frames[JSON])
+        # Sai mesmo vazio: a revisão precisa chegar ao cliente
+        return encode_frame('tokens_moved', {'moves': visible, 'revision': revision, 'seq': seq}, self.wire_format)
     
-    @database_sync_to_async
-    def is_room_master(self):
-        if not self.user.is_authenticated:
-            return False
-        try:
-            room = Room.objects.get(code=self.room_code)
-            return room.master == self.user
-        except Room.DoesNotExist:
-            return False
+    def viewport_patch_frame(self, seq, revision, ops, frames):
+        """scene_patch com as operações nos tokens que o cliente tem ou que entram na área"""
+        known = self.known
+        visible = []
+        for op in ops:
+            kind = op['op']
+            if kind == 'set':
+                visible.append(op)
+            elif kind == 'add_token':
+                token_id = op['token']['id']
+                if token_id not in known and self.viewport.contains(op['token']):
+                    visible.append(op)
+                    known[token_id] = seq
+            elif kind == 'remove_token':
+                if known.pop(op['id'], None) is not None:
+                    visible.append(op)
+            elif known.get(op['id'], seq) < seq:
+                # Tokens enviados depois do evento já têm a alteração
+                visible.append(op)
+        if len(visible) == len(ops):
+            return frames.get(self.wire_format, frames[JSON])
+        # Sai mesmo vazio: a revisão precisa chegar ao cliente
+        return encode_frame('scene_patch', {'ops': visible, 'revision': revision, 'seq': seq}, self.wire_format)
     
-    @database_sync_to_async
-    def get_room_data(self):
+    def missed_frames(self):
+        """Eventos perdidos desde ?epoch=...&last_seq=... (None se precisa do estado completo)"""
+        query = parse_qs(self.scope.get('query_string', b'').decode())
         try:
-            room = Room.objects.get(code=self.room_code)
-            
-            # Buscar cena ativa da sala
-            active_scene = room.scenes.filter(is_active=True).first()
-            scene_data = active_scene.scene_data if active_scene else {}
-            
-            return {
-                'code': room.code,
-                'name': room.name,
-                'scene_data': scene_data,
-                'members': list(room.members.values('player_name', 'role', 'is_online'))
-            }
-        except Room.DoesNotExist:
+            epoch = query['epoch'][0]
+            last_seq = int(query['last_seq'][0])
+        except (KeyError, ValueError):
             return None
+        return self.room_state.frames_since(epoch, last_seq, self.wire_format, self.role)
     
-    @database_sync_to_async
-    def save_scene_data(self, scene_data):
-        try:
-            room = Room.objects.get(code=self.room_code)
-            
-            # Atualizar cena ativa
-            active_scene = room.scenes.filter(is_active=True).first()
-            if active_scene:
-                active_scene.scene_data = scene_data
-                active_scene.save()
-            
-            # Também salvar em current_scene_data para compatibilidade (se existir)
-            if hasattr(room, 'current_scene_data'):
-                room.current_scene_data = scene_data
-                room.save()
-        except Room.DoesNotExist:
-            pass
-    
-    @database_sync_to_async
-    def get_member_info(self):
-        player_name = self.user.username if self.user.is_authenticated else self.scope['session'].get('player_name')
-        return {
-            'player_name': player_name,
-            'role': 'master' if self.user.is_authenticated else 'player'
-        }
+    async def send_room_state(self):
+        if self.viewport is None:
+            # Snapshot serializado uma vez por revisão e reaproveitado por todas as conexões
+            frame = self.room_state.snapshot(self.wire_format, self.role)
+            self.known = None
+        else:
+            # Só os tokens do viewport (serializado para esta conexão)
+            state = self.room_state
+            with tracing.span('viewport.query'):
+                scene_data = state.viewport_scene(self.viewport, self.role)
+            self.known = {token['id']: state.seq for token in scene_data['tokens']}
+            frame = encode_frame('room_state', {'data': state.room_data(self.role, scene_data)}, self.wire_format)
+        metrics.FRAME_BYTES.observe(len(frame), type='room_state', format=self.wire_format)
+        # O estado completo substitui tudo o que estava na fila de saída
+        self.outbox.reset(self.room_state.seq)
+        await self.send_encoded(frame)
+        self.outbox.sent(self.room_state.seq)
     
-    @database_sync_to_async
-    def set_member_online(self, is_online):
-        try:
-            room = Room.objects.get(code=self.room_code)
-            if self.user.is_authenticated:
-                RoomMember.objects.filter(room=room, user=self.user).update(is_online=is_online)
+    async def flush_outbox(self):
+        """Envia a fila de saída enquanto a janela de controle de fluxo permitir"""
+        outbox = self.outbox
+        while outbox.is_open():
+            if outbox.resync:
+                # A fila estourou: o cliente recebe o estado atual no lugar do backlog
+                await self.send_room_state()
+                continue
+            if not outbox.pending:
+                break
+            message_type, seq, revision, tokens, frames, changes = outbox.pending.popleft()
+            if message_type == SKIPPED:
+                frame = encode_frame(SKIPPED, {'seq': seq, 'revision': revision}, self.wire_format)
+            elif self.known is not None and message_type == 'scene_update':
+                # Cena nova com viewport: o estado da área no lugar da cena inteira
+                await self.send_room_state()
+                continue
+            elif self.known is not None and message_type == 'tokens_moved':
+                frame = self.viewport_moves_frame(seq, revision, changes, frames)
+            elif self.known is not None and message_type == 'scene_patch':
+                frame = self.viewport_patch_frame(seq, revision, changes, frames)
             else:
-                player_name = self.scope['session'].get('player_name')
-                RoomMember.objects.filter(room=room, player_name=player_name).update(is_online=is_online)
-        except Room.DoesNotExist:
-            pass
+                # Cliente que entrou depois da serialização recebe JSON (todo cliente entende texto)
+                frame = frames.get(self.wire_format, frames[JSON])
+            await self.send_encoded(frame)
+            outbox.sent(seq)
+            if self.known is not None and tokens:
+                await self.reconcile_viewport(tokens)
     
-    @database_sync_to_async
-    def can_player_move_token(self, token_id, player_name):
-        try:
-            room = Room.objects.get(code=self.room_code)
-            active_scene = room.scenes.filter(is_active=True).first()
-            
-            if not active_scene or not active_scene.scene_data:
-                return False
-            
-            tokens = active_scene.scene_data.get('tokens', [])
-            token = next((t for t in tokens if t['id'] == token_id), None)
-            
-            if token and token.get('controlledBy') == player_name:
-                return True
-            
-            return False
-        except Room.DoesNotExist:
-            return False
+    async def send_encoded(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+    
+    async def broadcast(self, message_type, payload, player_payload=None):
+        await self.room_state.broadcast(message_type, payload, player_payload)
+    
+    # Handlers para mensagens do grupo: o frame já chega serializado
+    async def send_frame(self, event):
+        with tracing.trace(self.room_code, event['type']):
+            # Jogadores recebem a projeção da cena, quando ela difere da do mestre
+            frames = event['frames']
+            if self.role != 'master' and event['player_frames'] is not None:
+                frames = event['player_frames']
+            # Passa pela fila de saída: cliente lento recebe os eventos agrupados
+            changes = event['moves']
+            if event['type'] == 'scene_patch':
+                changes = event['ops'] if frames is event['frames'] else event['player_ops']
+            self.outbox.push(event['type'], event['seq'], event['revision'], event['tokens'], frames, changes)
+            with tracing.span('send'):
+                await self.flush_outbox()
+    
+    scene_update = send_frame
+    scene_patch = send_frame
+    tokens_moved = send_frame
+    member_joined = send_frame
+    member_left = send_frame
     
+    async def room_moved(self, event):
+        # A sala passou para outro worker (cluster): o cliente reconecta direto nele
+        await self.close(code=cluster.ROOM_MOVED, reason=event['url'])
+    
+    async def presence_expired(self, event):
+        # A conexão parou de mandar heartbeat: o cliente reconecta sozinho
+        await self.close()
+    
+    async def room_invalidated(self, event):
+        # A sala foi deletada, desativada ou mudou de mestre: revalida o acesso
+        with tracing.trace(self.room_code, 'room_invalidated'):
+            with metrics.DB_CALL_SECONDS.time(helper='check_room_access'), tracing.span('db.check_room_access'):
+                can_join = await self.check_room_access()
+            if not can_join:
+                await self.close()
+    
+    async def asset_ready(self, event):
+        # Job de upload concluído (grid.uploads): só o mestre envia imagens
+        if self.role == 'master':
+            payload = {key: value for key, value in event.items() if key != 'type'}
+            await self.send_encoded(encode_frame('asset_ready', payload, self.wire_format))
+    
+    async def profile_room(self, event):
+        # Pedido de perfil da sala (room_profile_api); só a primeira conexão do processo inicia
+        tracing.start_profile(self.room_code, event['seconds'])
+    
+    # Database queries
     @database_sync_to_async
-    def update_token_position(self, token_id, grid_x, grid_y):
+    def check_room_access(self):
+        """
+        Resolve sala, papel e membro uma única vez por conexão.
+        
+        O resultado fica guardado no consumer (room_id, role, member_id e
+        player_name) durante toda a vida do socket; a revalidação só acontece
+        quando chega um room_invalidated pelo channel layer.
+        """
         try:
-            room = Room.objects.get(code=self.room_code)
-            active_scene = room.scenes.filter(is_active=True).first()
-            
-            if not active_scene:
-                return
-            
-            scene_data = active_scene.scene_data or {}
-            tokens = scene_data.get('tokens', [])
-            
-            for token in tokens:
-                if token['id'] == token_id:
-                    token['gridX'] = grid_x
-                    token['gridY'] = grid_y
-                    break
-            
-            scene_data['tokens'] = tokens
-            active_scene.scene_data = scene_data
-            active_scene.save()
+            room = Room.objects.get(code=self.room_code, is_active=True)
         except Room.DoesNotExist:
-            pass
-
+            return False
+        
+        # Se for usuário autenticado e mestre da sala
+        if self.user.is_authenticated and room.master_id == self.user.id:
+            role = 'master'
+            player_name = self.user.username
+            member = RoomMember.objects.filter(room=room, user=self.user).first()
+        else:
+            # Para jogadores anônimos, verificamos na sessão
+            role = 'player'
+            player_name = self.scope['session'].get('player_name')
+            if not player_name:
+                return False
+            member = RoomMember.objects.filter(room=room, player_name=player_name).first()
+        
+        # Só escreve no banco quando o membro ainda não existe (ou mudou de papel)
+        if member is None:
+            member = RoomMember.objects.create(
+                room=room,
+                user=self.user if role == 'master' else None,
+                player_name=player_name,
+                role=role
+            )
+        elif member.role != role or member.player_name != player_name:
+            member.role = role
+            member.player_name = player_name
+            member.save(update_fields=['role', 'player_name'])
+        
+        self.room_id = room.id
+        self.role = role
+        self.member_id = member.id
+        self.player_name = player_name
+        return True
@@ -0,0 +1,138 @@
+"""
+Serialização dos frames enviados pelo WebSocket da sala.
+
+Mensagens de grupo (broadcast) são serializadas uma única vez, no momento do
+group_send, e cada consumer apenas escreve o frame pronto no socket. Assim uma
+sala com 30 jogadores faz um json.dumps por atualização, e não 30.
+
+Formatos suportados (negociados pelo subprotocolo do WebSocket):
+
+- JSON (texto), padrão para clientes que não pedem subprotocolo;
+- MessagePack (binário), com o subprotocolo 'tabletop.msgpack.v1'. As
+  mensagens mais frequentes (tokens_moved, scene_patch, member_joined,
+  member_left e viewport_tokens) usam códigos inteiros no lugar dos nomes dos
+  campos.
+"""
+import json
+
+try:
+    import msgpack
+except ImportError:  # msgpack é opcional (instalado junto com channels-redis)
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# Subprotocolo do WebSocket -> formato dos frames
+SUBPROTOCOLS = {
+    'tabletop.msgpack.v1': MSGPACK,
+    'tabletop.json.v1': JSON,
+}
+
+# Códigos curtos usados no formato binário (devem ser iguais aos do cliente)
+MESSAGE_CODES = {
+    'token_moved': 1,
+    'scene_patch': 2,
+    'member_joined': 3,
+    'member_left': 4,
+    'tokens_moved': 5,
+    'skipped': 6,
+    'viewport_tokens': 7,
+}
+
+FIELD_CODES = {
+    'type': 0,
+    'action': 1,
+    'revision': 2,
+    'token_id': 3,
+    'gridX': 4,
+    'gridY': 5,
+    'moved_by': 6,
+    'ops': 7,
+    'op': 8,
+    'id': 9,
+    'changes': 10,
+    'token': 11,
+    'member': 12,
+    'player_name': 13,
+    'role': 14,
+    'controlledBy': 15,
+    'visible': 16,
+    'size': 17,
+    'name': 18,
+    'imageSrc': 19,
+    'is_online': 20,
+    'moves': 21,
+    'seq': 22,
+    'tokens': 23,
+    'removed': 24,
+}
+
+MESSAGE_NAMES = {code: name for name, code in MESSAGE_CODES.items()}
+FIELD_NAMES = {code: name for name, code in FIELD_CODES.items()}
+
+
+def negotiate(subprotocols):
+    """Escolhe o formato a partir dos subprotocolos pedidos pelo cliente"""
+    for subprotocol in subprotocols or []:
+        wire_format = SUBPROTOCOLS.get(subprotocol)
+        if wire_format == MSGPACK and msgpack is None:
+            continue
+        if wire_format:
+            return wire_format, subprotocol
+    return JSON, None
+
+
+def _compact(value):
+    if isinstance(value, dict):
+        return {FIELD_CODES.get(key, key): _compact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_compact(item) for item in value]
+    return value
+
+
+def _expand(value):
+    if isinstance(value, dict):
+        return {FIELD_NAMES.get(key, key): _expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_expand(item) for item in value]
+    return value
+
+
+def encode_frame(message_type, payload, wire_format=JSON):
+    """Serializa uma mensagem {'type': ..., **payload} no formato pedido"""
+    message = {'type': message_type, **payload}
+    if wire_format == MSGPACK:
+        if message_type in MESSAGE_CODES:
+            message = _compact(message)
+            message[FIELD_CODES['type']] = MESSAGE_CODES[message_type]
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message)
+
+
+def encode_frames(message_type, payload, wire_formats):
+    """Serializa a mensagem uma vez para cada formato em uso (JSON sempre)"""
+    frames = {JSON: encode_frame(message_type, payload)}
+    for wire_format in wire_formats:
+        if wire_format not in frames:
+            frames[wire_format] = encode_frame(message_type, payload, wire_format)
+    return frames
+
+
+def decode_message(text_data=None, bytes_data=None):
+    """
+    Decodifica uma mensagem recebida do cliente (texto JSON ou MessagePack);
+    ValueError se não for um objeto.
+    """
+    if text_data is not None:
+        message = json.loads(text_data)
+    elif msgpack is None:
+        raise ValueError('Formato binário indisponível')
+    else:
+        message = _expand(msgpack.unpackb(bytes_data, raw=False, strict_map_key=False))
+        if isinstance(message, dict) and isinstance(message.get('type'), int):
+            # Frames com código curto voltam ao nome do tipo (ida e volta do encode_frame)
+            message['type'] = MESSAGE_NAMES.get(message['type'], message['type'])
+    if not isinstance(message, dict):
+        raise ValueError('A mensagem deve ser um objeto')
+    return message
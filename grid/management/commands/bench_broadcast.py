@@ -0,0 +1,113 @@
+"""
+Mede o custo de CPU de um broadcast em função do tamanho da sala.
+
+Compara o formato antigo (cada consumer faz json.dumps do evento) com o frame
+serializado uma única vez no group_send. Usa um InMemoryChannelLayer isolado,
+então não precisa de banco nem de servidor rodando.
+
+    python manage.py bench_broadcast --sizes 1 10 30 100 --tokens 200
+"""
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from grid.frames import encode_frame
+
+
+def build_scene(token_count):
+    return {
+        'tokens': [
+            {
+                'id': i,
+                'name': f'Token {i}',
+                'imageSrc': f'https://res.cloudinary.com/demo/image/upload/rpg_grid/token_{i}.png',
+                'size': 1,
+                'gridX': i % 40,
+                'gridY': i // 40,
+                'visible': True,
+                'controlledBy': None,
+            }
+            for i in range(token_count)
+        ],
+        'backgroundImage': 'https://res.cloudinary.com/demo/image/upload/rpg_grid/map.png',
+        'gridSize': 50,
+        'gridColor': '#333333',
+        'bgColor': '#1a1a1a',
+    }
+
+
+async def run_broadcasts(room_size, scene_data, rounds, pre_encoded):
+    """Retorna o tempo de CPU médio (ms) de um broadcast entregue a toda a sala"""
+    layer = InMemoryChannelLayer(capacity=rounds + 10)
+    channels = []
+    for _ in range(room_size):
+        channel = await layer.new_channel()
+        await layer.group_add('bench', channel)
+        channels.append(channel)
+
+    start = time.process_time()
+    for revision in range(rounds):
+        payload = {'scene_data': scene_data, 'revision': revision}
+        if pre_encoded:
+            event = {'type': 'scene_update', 'text': encode_frame('scene_update', payload)}
+        else:
+            event = {'type': 'scene_update', **payload}
+        await layer.group_send('bench', event)
+
+        for channel in channels:
+            event = await layer.receive(channel)
+            if pre_encoded:
+                frame = event['text']
+            else:
+                frame = json.dumps({
+                    'type': 'scene_update',
+                    'scene_data': event['scene_data'],
+                    'revision': event['revision'],
+                })
+            assert frame
+    elapsed = time.process_time() - start
+    return elapsed * 1000 / rounds
+
+
+class Command(BaseCommand):
+    help = 'Mede o custo de CPU por broadcast em função do tamanho da sala'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 10, 30, 100])
+        parser.add_argument('--tokens', type=int, default=200)
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--json', action='store_true', help='Saída em JSON')
+
+    def handle(self, *args, **options):
+        scene_data = build_scene(options['tokens'])
+        frame_size = len(encode_frame('scene_update', {'scene_data': scene_data, 'revision': 0}))
+
+        results = []
+        for size in options['sizes']:
+            per_consumer = asyncio.run(run_broadcasts(size, scene_data, options['rounds'], False))
+            encode_once = asyncio.run(run_broadcasts(size, scene_data, options['rounds'], True))
+            results.append({
+                'room_size': size,
+                'per_consumer_ms': round(per_consumer, 3),
+                'encode_once_ms': round(encode_once, 3),
+                'speedup': round(per_consumer / encode_once, 2) if encode_once else None,
+            })
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'tokens': options['tokens'],
+                'frame_bytes': frame_size,
+                'results': results,
+            }))
+            return
+
+        self.stdout.write(f"Cena com {options['tokens']} tokens ({frame_size} bytes por frame)")
+        self.stdout.write(f"{'jogadores':>10} {'json por consumer':>18} {'json uma vez':>14} {'ganho':>7}")
+        for row in results:
+            self.stdout.write(
+                f"{row['room_size']:>10} {row['per_consumer_ms']:>15.3f} ms "
+                f"{row['encode_once_ms']:>11.3f} ms {row['speedup']:>6}x"
+            )
@@ -0,0 +1,395 @@
+"""
+Teste de carga do WebSocket das salas, sem servidor rodando.
+
+Cria N salas com M jogadores e K conexões do mestre cada, conectadas via
+WebsocketCommunicator no mesmo processo, e dispara uma mistura de ações
+(move_token, patch_scene, update_scene, get_state). Mede:
+
+- vazão (ações enviadas e frames entregues por segundo);
+- latência de fan-out (p50/p95/p99) entre o envio da ação e a chegada do
+  broadcast em cada cliente da sala;
+- consultas ao banco por ação (na conexão, em cada tipo de ação isolada e na
+  média da carga toda, incluindo as gravações do write-behind);
+- crescimento de memória (RSS) do processo.
+
+Roda em um banco de teste descartável. Com --json a saída é uma linha JSON,
+para comparar execuções entre commits:
+
+    python manage.py loadtest --rooms 10 --players 8 --masters 1 --actions 100 --json
+"""
+import asyncio
+import json
+import random
+import resource
+import statistics
+import time
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from grid import room_state
+from grid.frames import MESSAGE_NAMES, decode_message
+from grid.models import Room, RoomMember, Scene
+from grid.routing import websocket_urlpatterns
+
+PLAYER_ACTIONS = ('move_token', 'get_state')
+MASTER_ACTIONS = ('patch_scene', 'update_scene', 'get_state')
+DEFAULT_MIX = 'move_token=70,patch_scene=15,update_scene=5,get_state=10'
+
+
+def parse_mix(value):
+    try:
+        mix = {name: float(weight) for name, weight in (item.split('=') for item in value.split(','))}
+    except ValueError:
+        raise CommandError(f'Mistura inválida: {value}')
+    unknown = set(mix) - set(PLAYER_ACTIONS) - set(MASTER_ACTIONS)
+    if unknown:
+        raise CommandError(f"Ações desconhecidas: {', '.join(sorted(unknown))}")
+    return mix
+
+
+def percentiles(values):
+    """p50/p95/p99 em milissegundos"""
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None}
+    if len(values) == 1:
+        value = round(values[0] * 1000, 3)
+        return {'p50': value, 'p95': value, 'p99': value}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        'p50': round(cuts[49] * 1000, 3),
+        'p95': round(cuts[94] * 1000, 3),
+        'p99': round(cuts[98] * 1000, 3),
+    }
+
+
+def rss_kb():
+    """RSS atual do processo (KB); cai para o pico quando /proc não existe"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class QueryCounter:
+    """execute_wrapper que conta as consultas de todas as conexões do banco"""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self)
+
+
+class LoadClient:
+    def __init__(self, test, room, role, name, user=None, token_id=None):
+        self.test = test
+        self.room = room
+        self.role = role
+        self.token_id = token_id
+        self.frames = 0
+        self.bytes = 0
+        self.state_requests = []
+        path = f'/ws/room/{room.code}/'
+        subprotocols = ['tabletop.msgpack.v1'] if test.wire_format == 'msgpack' else None
+        self.communicator = WebsocketCommunicator(test.app, path, subprotocols=subprotocols)
+        self.communicator.scope['user'] = user or AnonymousUser()
+        self.communicator.scope['session'] = {} if user else {'player_name': name}
+        self.reader = None
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise CommandError(f'Conexão recusada na sala {self.room.code}')
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        while True:
+            # Sem timeout: o receive_output cancela a aplicação quando o tempo acaba
+            output = await self.communicator.receive_output(timeout=None)
+            if output['type'] != 'websocket.send':
+                continue
+            received = time.perf_counter()
+            frame = output.get('bytes') or output.get('text')
+            self.frames += 1
+            self.bytes += len(frame)
+            message = decode_message(output.get('text'), output.get('bytes'))
+            message_type = MESSAGE_NAMES.get(message.get('type'), message.get('type'))
+            self.test.record(self, message_type, message, received)
+
+    async def send(self, message):
+        await self.communicator.send_to(text_data=json.dumps(message))
+
+    async def act(self, action):
+        marker = self.test.next_marker()
+        sent = time.perf_counter()
+        if action == 'move_token':
+            self.test.pending[(self.room.code, 'move', self.token_id, marker)] = sent
+            await self.send({'action': 'move_token', 'token_id': self.token_id, 'gridX': marker, 'gridY': 0})
+        elif action == 'patch_scene':
+            self.test.pending[(self.room.code, 'scene', marker)] = sent
+            await self.send({'action': 'patch_scene', 'ops': [{'op': 'set', 'changes': {'offsetX': marker}}]})
+        elif action == 'update_scene':
+            self.test.pending[(self.room.code, 'scene', marker)] = sent
+            scene_data = {**self.test.scenes[self.room.code], 'offsetX': marker}
+            await self.send({'action': 'update_scene', 'scene_data': scene_data})
+        elif action == 'get_state':
+            self.state_requests.append(sent)
+            await self.send({'action': 'get_state'})
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.communicator.disconnect()
+
+
+class LoadTest:
+    def __init__(self, options):
+        self.options = options
+        self.wire_format = options['wire_format']
+        self.app = URLRouter(websocket_urlpatterns)
+        self.rng = random.Random(options['seed'])
+        self.mix = parse_mix(options['mix'])
+        self.scenes = {}
+        self.pending = {}
+        self.latencies = {'move_token': [], 'scene': [], 'get_state': []}
+        self.marker = 0
+        self.clients = []
+
+    def next_marker(self):
+        self.marker += 1
+        return self.marker
+
+    # ==================== Dados ====================
+
+    def build_scene(self, players):
+        tokens = max(self.options['tokens'], players)
+        return {
+            'tokens': [
+                {
+                    'id': i,
+                    'name': f'Token {i}',
+                    'imageSrc': f'https://res.cloudinary.com/demo/image/upload/rpg_grid/token_{i}.png',
+                    'size': 1,
+                    'gridX': i % 40,
+                    'gridY': i // 40,
+                    'visible': True,
+                    'controlledBy': f'player{i}' if i < players else None,
+                }
+                for i in range(tokens)
+            ],
+            'gridSize': 50,
+            'gridColor': '#333333',
+            'bgColor': '#1a1a1a',
+        }
+
+    def create_rooms(self):
+        rooms = []
+        for index in range(self.options['rooms']):
+            master = User.objects.create_user(f'loadtest_master{index}')
+            room = Room.objects.create(name=f'Carga {index}', master=master, code=f'LOAD{index:04d}')
+            RoomMember.objects.create(room=room, user=master, player_name=master.username, role='master')
+            scene_data = self.build_scene(self.options['players'])
+            Scene(room=room, name='Cena', is_active=True).set_scene_data(scene_data)
+            self.scenes[room.code] = scene_data
+            rooms.append((room, master))
+        return rooms
+
+    # ==================== Métricas ====================
+
+    def record(self, client, message_type, message, received):
+        code = client.room.code
+        if message_type == 'tokens_moved':
+            for move in message['moves']:
+                sent = self.pending.get((code, 'move', move['token_id'], move['gridX']))
+                if sent is not None:
+                    self.latencies['move_token'].append(received - sent)
+        elif message_type == 'scene_patch':
+            changes = message['ops'][0].get('changes', {})
+            sent = self.pending.get((code, 'scene', changes.get('offsetX')))
+            if sent is not None:
+                self.latencies['scene'].append(received - sent)
+        elif message_type == 'scene_update':
+            sent = self.pending.get((code, 'scene', message['scene_data'].get('offsetX')))
+            if sent is not None:
+                self.latencies['scene'].append(received - sent)
+        elif message_type == 'room_state' and client.state_requests:
+            self.latencies['get_state'].append(received - client.state_requests.pop(0))
+
+    def pick_action(self, client):
+        actions = PLAYER_ACTIONS if client.role == 'player' else MASTER_ACTIONS
+        weights = [self.mix.get(action, 0) for action in actions]
+        if not any(weights):
+            return None
+        return self.rng.choices(actions, weights)[0]
+
+    async def settle(self):
+        # Espera os broadcasts pendentes (tick dos movimentos) chegarem
+        await asyncio.sleep(room_state.tick_interval() + 0.1)
+
+    # ==================== Execução ====================
+
+    async def run_client(self, client):
+        interval = 1 / self.options['rate']
+        for _ in range(self.options['actions']):
+            action = self.pick_action(client)
+            if action is None:
+                return
+            await client.act(action)
+            self.actions += 1
+            await asyncio.sleep(self.rng.uniform(0.5, 1.5) * interval)
+
+    async def calibrate(self, counter):
+        """Consultas de cada tipo de ação, disparada sozinha com a sala parada"""
+        room_clients = [client for client in self.clients if client.room == self.clients[0].room]
+        samples = {}
+        for action in ('move_token', 'patch_scene', 'update_scene', 'get_state'):
+            role = 'player' if action == 'move_token' else 'master'
+            client = next((c for c in room_clients if c.role == role), None)
+            if client is None:
+                continue
+            await self.settle()
+            before = counter.count
+            await client.act(action)
+            await self.settle()
+            samples[action] = counter.count - before
+        return samples
+
+    async def run(self, rooms, counter):
+        rss_start = rss_kb()
+
+        for room, master in rooms:
+            for _ in range(self.options['masters']):
+                self.clients.append(LoadClient(self, room, 'master', master.username, user=master))
+            for index in range(self.options['players']):
+                self.clients.append(LoadClient(self, room, 'player', f'player{index}', token_id=index))
+
+        before = counter.count
+        start = time.perf_counter()
+        for client in self.clients:
+            await client.connect()
+        connect_seconds = time.perf_counter() - start
+        connect_queries = counter.count - before
+        await self.settle()
+
+        calibration = await self.calibrate(counter)
+        for client in self.clients:
+            client.frames = client.bytes = 0
+        for values in self.latencies.values():
+            values.clear()
+
+        self.actions = 0
+        before = counter.count
+        start = time.perf_counter()
+        await asyncio.gather(*(self.run_client(client) for client in self.clients))
+        await self.settle()
+        elapsed = time.perf_counter() - start
+        load_queries = counter.count - before
+        rss_loaded = rss_kb()
+
+        frames = sum(client.frames for client in self.clients)
+        frame_bytes = sum(client.bytes for client in self.clients)
+
+        before = counter.count
+        for client in self.clients:
+            await client.close()
+        disconnect_queries = counter.count - before
+
+        return {
+            'connections': len(self.clients),
+            'connect_seconds': round(connect_seconds, 3),
+            'duration_seconds': round(elapsed, 3),
+            'actions': self.actions,
+            'actions_per_second': round(self.actions / elapsed, 1),
+            'frames_delivered': frames,
+            'frames_per_second': round(frames / elapsed, 1),
+            'bytes_delivered': frame_bytes,
+            'latency_ms': {kind: percentiles(values) for kind, values in self.latencies.items()},
+            'queries': {
+                'connect': round(connect_queries / len(self.clients), 2),
+                'disconnect': round(disconnect_queries / len(self.clients), 2),
+                'per_action': calibration,
+                'per_action_under_load': round(load_queries / self.actions, 3) if self.actions else None,
+            },
+            'rss_kb': {
+                'start': rss_start,
+                'loaded': rss_loaded,
+                'growth': rss_loaded - rss_start,
+                'per_connection': round((rss_loaded - rss_start) / len(self.clients), 1),
+            },
+        }
+
+
+class Command(BaseCommand):
+    help = 'Simula salas cheias de jogadores no WebSocket e mede vazão, latência, consultas e memória'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=5)
+        parser.add_argument('--players', type=int, default=8, help='Jogadores por sala')
+        parser.add_argument('--masters', type=int, default=1, help='Conexões do mestre por sala')
+        parser.add_argument('--tokens', type=int, default=50, help='Tokens por cena')
+        parser.add_argument('--actions', type=int, default=50, help='Ações por cliente')
+        parser.add_argument('--rate', type=float, default=10.0, help='Ações por segundo de cada cliente')
+        parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Peso de cada ação (padrão: {DEFAULT_MIX})')
+        parser.add_argument('--wire-format', choices=['json', 'msgpack'], default='json')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--json', action='store_true', help='Saída em JSON')
+
+    def handle(self, *args, **options):
+        if options['rate'] <= 0:
+            raise CommandError('--rate deve ser positivo')
+        test = LoadTest(options)
+
+        # Banco de teste descartável: a carga não toca nos dados reais
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        counter = QueryCounter()
+        connection_created.connect(counter.install)
+        connection.execute_wrappers.append(counter)
+        try:
+            rooms = test.create_rooms()
+            results = asyncio.run(test.run(rooms, counter))
+        finally:
+            connection_created.disconnect(counter.install)
+            connection.execute_wrappers.remove(counter)
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        config = {
+            key: options[key]
+            for key in ('rooms', 'players', 'masters', 'tokens', 'actions', 'rate', 'mix', 'wire_format', 'seed')
+        }
+        if options['json']:
+            self.stdout.write(json.dumps({'config': config, 'results': results}))
+            return
+
+        self.stdout.write(
+            f"{config['rooms']} salas x ({config['players']} jogadores + {config['masters']} mestre), "
+            f"{config['tokens']} tokens, {config['wire_format']}"
+        )
+        self.stdout.write(
+            f"{results['actions']} ações em {results['duration_seconds']}s: "
+            f"{results['actions_per_second']} ações/s, {results['frames_per_second']} frames/s "
+            f"({results['bytes_delivered']} bytes entregues)"
+        )
+        for kind, latency in results['latency_ms'].items():
+            self.stdout.write(f"  latência {kind:<12} p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} ms")
+        queries = results['queries']
+        self.stdout.write(
+            f"  consultas: conexão={queries['connect']} desconexão={queries['disconnect']} "
+            f"carga={queries['per_action_under_load']}/ação"
+        )
+        for action, count in queries['per_action'].items():
+            self.stdout.write(f"    {action:<12} {count}")
+        rss = results['rss_kb']
+        self.stdout.write(f"  RSS: +{rss['growth']} KB ({rss['per_connection']} KB por conexão)")
@@ -0,0 +1,248 @@
+"""
+Métricas da camada de tempo real no formato texto do Prometheus.
+
+Contadores e histogramas ficam em memória no processo (cada worker expõe os
+seus) e são servidos pela view metrics_view. Com METRICS_ENABLED = False toda
+medição retorna logo na primeira linha, sem tocar no relógio nem nos
+dicionários, então o custo nos caminhos quentes é praticamente zero.
+
+Uso nos caminhos quentes:
+
+    MESSAGES_RECEIVED.inc(action='move_token')
+    with DB_CALL_SECONDS.time(helper='check_room_access'):
+        ...
+    started = now()
+    ...
+    RECEIVE_SECONDS.observe_since(started, action='move_token')
+"""
+import hmac
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+# Todas as métricas registradas, na ordem de criação
+REGISTRY = []
+
+# Limites dos buckets (segundos e bytes)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+
+def is_enabled():
+    return getattr(settings, 'METRICS_ENABLED', False)
+
+
+def is_authorized(authorization):
+    """Cabeçalho Authorization do scrape confere com METRICS_TOKEN (sem token, nada confere)"""
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if not token:
+        return False
+    return hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode())
+
+
+def now():
+    """Início de uma medição (None com as métricas desligadas)"""
+    return time.perf_counter() if is_enabled() else None
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        for name, labels, value in self.samples():
+            lines.append(f'{name}{labels} {_format_value(value)}')
+        return lines
+
+    def reset(self):
+        self.values = {}
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        if not is_enabled():
+            return
+        key = self._key(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            # Contagem por bucket (não cumulativa), soma e total
+            entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def observe_since(self, started, **labels):
+        if started is not None:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def time(self, **labels):
+        """Context manager que mede o tempo do bloco"""
+        if not is_enabled():
+            return NULL_TIMER
+        return _Timer(self, labels)
+
+    def samples(self):
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])
+                yield f'{self.name}_bucket', labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, count
+
+
+class Gauge(Metric):
+    """Valor lido na hora da coleta (collect retorna pares (labels, valor))"""
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for key, value in self.collect():
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+def render():
+    """Todas as métricas no formato texto do Prometheus"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.reset()
+
+
+# ==================== Coletas feitas na hora do scrape ====================
+
+def _room_connections():
+    # Agregado: o código da sala é o segredo de entrada e não pode virar label
+    from .room_state import _rooms
+    connections = [state.connections for state in list(_rooms.values())]
+    yield ('rooms',), len(connections)
+    yield ('total',), sum(connections)
+    yield ('max',), max(connections, default=0)
+
+
+def _channel_layer_queues():
+    from channels.layers import get_channel_layer
+    # Só o InMemoryChannelLayer expõe as filas; no Redis a profundidade fica no servidor
+    queues = getattr(get_channel_layer(), 'channels', None) or {}
+    sizes = [queue.qsize() for queue in list(queues.values())]
+    yield ('total',), sum(sizes)
+    yield ('max',), max(sizes, default=0)
+
+
+# ==================== Métricas ====================
+
+MESSAGES_RECEIVED = Counter(
+    'tabletop_ws_messages_received_total', 'Mensagens recebidas no WebSocket, por ação', ['action']
+)
+RECEIVE_SECONDS = Histogram(
+    'tabletop_ws_receive_seconds', 'Tempo gasto no receive do consumer, por ação', ['action']
+)
+DB_CALL_SECONDS = Histogram(
+    'tabletop_db_call_seconds',
+    'Tempo de cada chamada database_sync_to_async (inclui a espera pela thread do banco)',
+    ['helper']
+)
+GROUP_SEND_SECONDS = Histogram(
+    'tabletop_group_send_seconds', 'Latência do group_send, por tipo de mensagem', ['type']
+)
+FRAME_BYTES = Histogram(
+    'tabletop_ws_frame_bytes', 'Tamanho dos frames enviados, por tipo e formato', ['type', 'format'],
+    buckets=SIZE_BUCKETS
+)
+OUTBOX_DROPPED = Counter(
+    'tabletop_outbox_dropped_total',
+    'Frames descartados na fila de saída das conexões (agrupados ou por estouro da fila)', ['reason']
+)
+ROOM_CONNECTIONS = Gauge(
+    'tabletop_room_connections',
+    'Salas abertas neste processo e conexões (total e maior sala)', ['stat'],
+    collect=_room_connections
+)
+CHANNEL_LAYER_QUEUE_DEPTH = Gauge(
+    'tabletop_channel_layer_queue_depth', 'Mensagens aguardando nas filas do channel layer', ['stat'],
+    collect=_channel_layer_queues
+)
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0002_scene"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="revision",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
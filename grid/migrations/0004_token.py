@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:07
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0003_scene_revision"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Token",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("token_id", models.IntegerField()),
+                ("name", models.CharField(blank=True, max_length=100)),
+                ("image_src", models.TextField(blank=True)),
+                ("size", models.IntegerField(default=1)),
+                ("grid_x", models.IntegerField(default=0)),
+                ("grid_y", models.IntegerField(default=0)),
+                ("visible", models.BooleanField(default=True)),
+                (
+                    "controlled_by",
+                    models.CharField(blank=True, max_length=50, null=True),
+                ),
+                ("order", models.IntegerField(default=0)),
+                ("extra", models.JSONField(blank=True, default=dict)),
+                (
+                    "scene",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="tokens",
+                        to="grid.scene",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["order", "id"],
+                "indexes": [
+                    models.Index(
+                        fields=["scene", "grid_x", "grid_y"],
+                        name="grid_token_scene_i_c41aa0_idx",
+                    ),
+                    models.Index(
+                        fields=["scene", "controlled_by"],
+                        name="grid_token_scene_i_cf9abb_idx",
+                    ),
+                ],
+                "unique_together": {("scene", "token_id")},
+            },
+        ),
+    ]
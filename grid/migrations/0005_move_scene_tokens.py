@@ -0,0 +1,110 @@
+from django.db import migrations
+
+# Campos do token no scene_data (JSON) -> coluna do modelo Token
+FIELD_MAP = {
+    "name": "name",
+    "imageSrc": "image_src",
+    "size": "size",
+    "gridX": "grid_x",
+    "gridY": "grid_y",
+    "visible": "visible",
+    "controlledBy": "controlled_by",
+}
+
+# Valor padrão, tamanho máximo e faixa (IntegerField) das colunas, para dados antigos fora do formato
+INT_DEFAULTS = {"size": 1, "grid_x": 0, "grid_y": 0}
+MAX_LENGTH = {"name": 100, "controlled_by": 50}
+INT_RANGE = range(-2 ** 31, 2 ** 31)
+
+
+def to_int(value, default):
+    """Inteiro a partir de valores antigos como 3, "3", 1.5 ou "1.5"; o padrão para o resto"""
+    try:
+        number = int(value)
+    except (TypeError, ValueError, OverflowError):
+        try:
+            number = int(float(value))
+        except (TypeError, ValueError, OverflowError):
+            return default
+    return number if number in INT_RANGE else default
+
+
+def to_text(value, column):
+    if value is None or value == "":
+        return None if column == "controlled_by" else ""
+    text = value if isinstance(value, str) else str(value)
+    return text[:MAX_LENGTH[column]] if column in MAX_LENGTH else text
+
+
+def scene_tokens_to_table(apps, schema_editor):
+    """
+    Move os tokens do JSON scene_data para a tabela Token.
+
+    Dados antigos fora do formato não interrompem a migração: números
+    inválidos ficam com o padrão da coluna, textos são cortados no tamanho
+    da coluna e tokens sem id, ou com id repetido na cena, recebem um id
+    novo (depois do maior id da cena) em vez de serem descartados.
+    """
+    Scene = apps.get_model("grid", "Scene")
+    Token = apps.get_model("grid", "Token")
+
+    for scene in Scene.objects.all().iterator():
+        scene_data = scene.scene_data or {}
+        tokens = [data for data in scene_data.pop("tokens", None) or [] if isinstance(data, dict)]
+
+        ids = [to_int(data.get("id"), None) for data in tokens]
+        next_id = max((token_id for token_id in ids if token_id is not None), default=-1) + 1
+        seen = set()
+        rows = []
+        for order, (data, token_id) in enumerate(zip(tokens, ids)):
+            if token_id is None or token_id in seen:
+                token_id = next_id
+                next_id += 1
+            seen.add(token_id)
+            fields = {"extra": {}}
+            for key, value in data.items():
+                column = FIELD_MAP.get(key)
+                if key == "id":
+                    continue
+                elif column is None:
+                    fields["extra"][key] = value
+                elif column in INT_DEFAULTS:
+                    fields[column] = to_int(value, INT_DEFAULTS[column])
+                elif column == "visible":
+                    fields[column] = value is not False
+                else:
+                    fields[column] = to_text(value, column)
+            rows.append(Token(scene=scene, token_id=token_id, order=order, **fields))
+
+        Token.objects.bulk_create(rows)
+        Scene.objects.filter(pk=scene.pk).update(scene_data=scene_data)
+
+
+def table_tokens_to_scene(apps, schema_editor):
+    """Devolve os tokens da tabela Token para o JSON scene_data"""
+    Scene = apps.get_model("grid", "Scene")
+    Token = apps.get_model("grid", "Token")
+
+    for scene in Scene.objects.all().iterator():
+        tokens = []
+        for token in Token.objects.filter(scene=scene).order_by("order", "id"):
+            data = {"id": token.token_id}
+            for key, column in FIELD_MAP.items():
+                data[key] = getattr(token, column)
+            data.update(token.extra)
+            tokens.append(data)
+
+        scene_data = scene.scene_data or {}
+        scene_data["tokens"] = tokens
+        Scene.objects.filter(pk=scene.pk).update(scene_data=scene_data)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0004_token"),
+    ]
+
+    operations = [
+        migrations.RunPython(scene_tokens_to_table, table_tokens_to_scene),
+    ]
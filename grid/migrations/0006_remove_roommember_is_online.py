@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:14
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0005_move_scene_tokens"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="roommember",
+            name="is_online",
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0007_asset"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="TilePyramid",
+            fields=[
+                (
+                    "asset",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="pyramid",
+                        serialize=False,
+                        to="grid.asset",
+                    ),
+                ),
+                ("width", models.PositiveIntegerField()),
+                ("height", models.PositiveIntegerField()),
+                ("tile_size", models.PositiveIntegerField()),
+                ("levels", models.PositiveSmallIntegerField()),
+                ("format", models.CharField(max_length=10)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 21:56
+
+from django.db import migrations, models
+from django.db.models import Count
+
+ASSET_SCHEME = "asset:"
+
+
+def fill_scene_summary(apps, schema_editor):
+    """Preenche o resumo (número de tokens e asset do fundo) das cenas existentes"""
+    Scene = apps.get_model("grid", "Scene")
+
+    for scene in Scene.objects.annotate(tokens_total=Count("tokens")).iterator():
+        background = (scene.scene_data or {}).get("backgroundImage") or ""
+        thumbnail = ""
+        if isinstance(background, str) and background.startswith(ASSET_SCHEME):
+            thumbnail = background[len(ASSET_SCHEME):]
+        Scene.objects.filter(pk=scene.pk).update(token_count=scene.tokens_total, thumbnail=thumbnail)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0008_tilepyramid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="thumbnail",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="scene",
+            name="token_count",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_scene_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+# Generated by Django 5.2.18 on 2026-10-18 22:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_snapshots(apps, schema_editor):
+    """As cenas existentes estão inteiras em scene_data e na tabela Token: o snapshot está em dia"""
+    Scene = apps.get_model("grid", "Scene")
+    Scene.objects.update(snapshot_revision=F("revision"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("grid", "0009_scene_summary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="scene",
+            name="snapshot_revision",
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name="SceneOp",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.PositiveIntegerField()),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[
+                            ("edit", "Edição"),
+                            ("move", "Movimento"),
+                            ("undo", "Desfazer"),
+                            ("redo", "Refazer"),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ("ops", models.JSONField()),
+                ("inverse", models.JSONField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "scene",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="ops",
+                        to="grid.scene",
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ["revision"],
+                "unique_together": {("scene", "revision")},
+            },
+        ),
+        migrations.RunPython(mark_snapshots, migrations.RunPython.noop),
+    ]
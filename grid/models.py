@@ -2,6 +2,9 @@ from django.db import models
 from django.contrib.auth.models import User
 import secrets
 
+from .assets import ASSET_SCHEME
+from .scene_ops import apply_op
+
 class Room(models.Model):
     code = models.CharField(max_length=8, unique=True, db_index=True)
     name = models.CharField(max_length=100)
@@ -38,7 +41,7 @@ class RoomMember(models.Model):
     player_name = models.CharField(max_length=50)
     role = models.CharField(max_length=10, choices=ROLE_CHOICES, default='player')
     joined_at = models.DateTimeField(auto_now_add=True)
-    is_online = models.BooleanField(default=False)
+    # A presença (online/offline) fica em memória no RoomState, não no banco
     
     class Meta:
         unique_together = ['room', 'user']
@@ -46,14 +49,28 @@ class RoomMember(models.Model):
     def __str__(self):
         return f"{self.player_name} in {self.room.name} ({self.role})"
 
+def scene_thumbnail(scene_data):
+    """Id do asset do fundo da cena ('' se não há fundo ou é uma URL antiga)"""
+    background = scene_data.get('backgroundImage') or ''
+    if isinstance(background, str) and background.startswith(ASSET_SCHEME):
+        return background[len(ASSET_SCHEME):]
+    return ''
+
+
 class Scene(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='scenes')
     name = models.CharField(max_length=100)
-    scene_data = models.JSONField()  # Estado completo da cena
+    scene_data = models.JSONField()  # Configurações da cena (os tokens ficam na tabela Token)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField(default=False)  # Cena ativa no momento
     order = models.IntegerField(default=0)  # Ordem das cenas
+    revision = models.PositiveIntegerField(default=0)  # Incrementada a cada alteração do scene_data
+    # Revisão gravada em scene_data e na tabela Token (snapshot); as seguintes estão no log (SceneOp)
+    snapshot_revision = models.PositiveIntegerField(default=0)
+    # Resumo para a lista de cenas (sem carregar scene_data e tokens), mantido a cada gravação
+    token_count = models.PositiveIntegerField(default=0)
+    thumbnail = models.CharField(max_length=64, blank=True, default='')  # Asset do fundo
     
     class Meta:
         ordering = ['order', 'created_at']
@@ -67,3 +84,172 @@ class Scene(models.Model):
         if self.is_active:
             Scene.objects.filter(room=self.room, is_active=True).exclude(pk=self.pk).update(is_active=False)
         super().save(*args, **kwargs)
+    
+    def snapshot_data(self):
+        """Snapshot da cena (snapshot_revision), com os tokens montados a partir da tabela Token"""
+        scene_data = dict(self.scene_data or {})
+        scene_data['tokens'] = [token.to_dict() for token in self.tokens.all()]
+        return scene_data
+    
+    def op_tail(self):
+        """Operações do log posteriores ao snapshot, uma lista por entrada"""
+        if self.revision <= self.snapshot_revision:
+            # Snapshot em dia: sem consulta ao log
+            return []
+        return list(self.ops.filter(revision__gt=self.snapshot_revision).values_list('ops', flat=True))
+    
+    def get_scene_data(self):
+        """Estado completo da cena: o snapshot mais as operações do log posteriores a ele"""
+        scene_data = self.snapshot_data()
+        for ops in self.op_tail():
+            for op in ops:
+                apply_op(scene_data, op)
+        return scene_data
+    
+    def set_scene_data(self, scene_data):
+        """Separa os tokens do scene_data e grava cada um na tabela Token (novo snapshot)"""
+        scene_data = dict(scene_data or {})
+        tokens = scene_data.pop('tokens', None) or []
+        self.scene_data = scene_data
+        self.snapshot_revision = self.revision
+        self.token_count = len(tokens)
+        self.thumbnail = scene_thumbnail(scene_data)
+        self.save()
+        self.tokens.all().delete()
+        Token.objects.bulk_create([
+            Token.from_dict(self.pk, token, order=index) for index, token in enumerate(tokens)
+        ])
+
+
+class SceneOp(models.Model):
+    """
+    Entrada do log de operações de uma cena (append-only).
+    
+    Cada revisão alterada em memória gera uma entrada com as operações aplicadas
+    (scene_ops) e as que as desfazem. As entradas até snapshot_revision já estão
+    no snapshot e ficam só como histórico, até a compactação apagá-las.
+    """
+    EDIT = 'edit'  # Alteração do mestre (patch ou cena inteira)
+    MOVE = 'move'  # Lote de movimentos dos jogadores (um tick)
+    UNDO = 'undo'
+    REDO = 'redo'
+    KIND_CHOICES = [(EDIT, 'Edição'), (MOVE, 'Movimento'), (UNDO, 'Desfazer'), (REDO, 'Refazer')]
+    
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='ops')
+    revision = models.PositiveIntegerField()  # Revisão da cena depois desta entrada
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    ops = models.JSONField()
+    inverse = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['revision']
+        unique_together = ['scene', 'revision']
+    
+    def __str__(self):
+        return f"{self.scene.name} #{self.revision} ({self.kind})"
+
+
+class Token(models.Model):
+    # Campos do token no formato do scene_data (JSON) -> coluna do modelo
+    FIELD_MAP = {
+        'name': 'name',
+        'imageSrc': 'image_src',
+        'size': 'size',
+        'gridX': 'grid_x',
+        'gridY': 'grid_y',
+        'visible': 'visible',
+        'controlledBy': 'controlled_by',
+    }
+    
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='tokens')
+    token_id = models.IntegerField()  # id do token dentro da cena (gerado pelo cliente)
+    name = models.CharField(max_length=100, blank=True)
+    image_src = models.TextField(blank=True)
+    size = models.IntegerField(default=1)
+    grid_x = models.IntegerField(default=0)
+    grid_y = models.IntegerField(default=0)
+    visible = models.BooleanField(default=True)
+    controlled_by = models.CharField(max_length=50, null=True, blank=True)
+    order = models.IntegerField(default=0)  # Ordem de desenho
+    extra = models.JSONField(default=dict, blank=True)  # Demais campos do token
+    
+    class Meta:
+        ordering = ['order', 'id']
+        unique_together = ['scene', 'token_id']
+        indexes = [
+            models.Index(fields=['scene', 'grid_x', 'grid_y']),
+            models.Index(fields=['scene', 'controlled_by']),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} ({self.token_id}) - {self.scene.name}"
+    
+    @classmethod
+    def fields_from_dict(cls, data):
+        """Converte um token do scene_data para os campos do modelo"""
+        fields = {'extra': {}}
+        for key, value in data.items():
+            if key == 'id':
+                continue
+            column = cls.FIELD_MAP.get(key)
+            if column is None:
+                fields['extra'][key] = value
+            elif column in ('size', 'grid_x', 'grid_y'):
+                fields[column] = int(value or 0)
+            elif column == 'visible':
+                fields[column] = value is not False
+            elif column in ('name', 'image_src'):
+                fields[column] = value or ''
+            else:
+                fields[column] = value
+        return fields
+    
+    @classmethod
+    def from_dict(cls, scene_id, data, order=0):
+        return cls(scene_id=scene_id, token_id=data['id'], order=order, **cls.fields_from_dict(data))
+    
+    def to_dict(self):
+        """Converte para o formato usado no scene_data"""
+        data = {'id': self.token_id}
+        for key, column in self.FIELD_MAP.items():
+            data[key] = getattr(self, column)
+        data.update(self.extra)
+        return data
+
+
+class Asset(models.Model):
+    """Imagem armazenada uma única vez, identificada pelo SHA-256 do conteúdo"""
+    id = models.CharField(max_length=64, primary_key=True)
+    content_type = models.CharField(max_length=50)
+    size = models.PositiveBigIntegerField()
+    uploaded_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def __str__(self):
+        return f"{self.id[:12]} ({self.content_type}, {self.size} bytes)"
+
+
+class TilePyramid(models.Model):
+    """Pirâmide de tiles (deep zoom) gerada para uma imagem de fundo; veja grid/tiles.py"""
+    asset = models.OneToOneField(Asset, on_delete=models.CASCADE, primary_key=True, related_name='pyramid')
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    tile_size = models.PositiveIntegerField()
+    levels = models.PositiveSmallIntegerField()
+    format = models.CharField(max_length=10)
+    created_at = models.DateTimeField(auto_now_add=True)
+    
+    def descriptor(self):
+        """Referência guardada no backgroundTiles da cena"""
+        return {
+            'asset': self.asset_id,
+            'width': self.width,
+            'height': self.height,
+            'tileSize': self.tile_size,
+            'levels': self.levels,
+            'format': self.format,
+        }
+    
+    def __str__(self):
+        return f"{self.asset_id[:12]} ({self.width}x{self.height}, {self.levels} níveis)"
@@ -0,0 +1,124 @@
+"""
+Fila de saída de cada conexão da sala (controle de fluxo).
+
+O servidor ASGI não avisa quando um cliente está lento: os frames escritos no
+socket se acumulam no buffer do servidor. Por isso o controle de fluxo usa
+confirmações do próprio cliente: a ação ack informa o último seq recebido, e
+no máximo ROOM_OUTBOX_WINDOW frames ficam sem confirmação. Os seguintes
+esperam na fila da conexão e, enquanto esperam, são agrupados:
+
+- um tokens_moved substitui os tokens_moved anteriores que só moviam tokens
+  que ele também move (vale a última posição de cada token);
+- um scene_update (cena inteira) substitui tudo o que alterava a cena antes
+  dele (scene_update, scene_patch e tokens_moved).
+
+No lugar dos eventos descartados vai um marcador skipped, com o seq e a
+revisão até onde o cliente pode avançar sem pedir o estado completo. Se,
+mesmo assim, a fila passar de ROOM_OUTBOX_LIMIT frames, ela é esvaziada e a
+conexão recebe o estado completo (room_state) assim que a janela abrir.
+
+Clientes que nunca mandam ack ficam fora do controle de fluxo e recebem tudo
+na hora.
+"""
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+# Tipo do marcador que substitui eventos agrupados
+SKIPPED = 'skipped'
+
+# Mensagens que alteram a cena (substituídas por um scene_update posterior)
+SCENE_TYPES = {'scene_update', 'scene_patch', 'tokens_moved'}
+
+
+def window_size():
+    return getattr(settings, 'ROOM_OUTBOX_WINDOW', 64)
+
+
+def queue_limit():
+    return getattr(settings, 'ROOM_OUTBOX_LIMIT', 256)
+
+
+def _latest(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+class Outbox:
+    """
+    Entradas da fila: (tipo, seq, revisão, tokens alterados, frames por formato,
+    alterações: movimentos de tokens_moved ou operações de scene_patch). Os
+    marcadores skipped não têm tokens, frames nem alterações.
+    """
+
+    def __init__(self):
+        self.pending = deque()
+        # Seqs enviados e ainda não confirmados (só com controle de fluxo)
+        self.unacked = deque()
+        # Último seq confirmado (None: o cliente não manda ack)
+        self.acked = None
+        # Eventos até este seq já estão no último estado completo enviado
+        self.floor = 0
+        self.resync = False
+
+    def is_open(self):
+        return self.acked is None or len(self.unacked) < window_size()
+
+    def ack(self, seq):
+        self.acked = seq if self.acked is None else max(self.acked, seq)
+        while self.unacked and self.unacked[0] <= self.acked:
+            self.unacked.popleft()
+
+    def sent(self, seq):
+        if self.acked is not None:
+            self.unacked.append(seq)
+
+    def reset(self, seq):
+        """A conexão recebeu o estado completo da sala até seq"""
+        self.pending.clear()
+        self.resync = False
+        self.floor = seq
+
+    def push(self, message_type, seq, revision, tokens, frames, changes=None):
+        if seq <= self.floor:
+            # Já está no estado completo enviado depois que o evento foi publicado
+            return
+
+        superseded = None
+        if message_type == 'scene_update':
+            superseded = lambda entry: entry[0] in SCENE_TYPES
+        elif message_type == 'tokens_moved':
+            tokens = frozenset(tokens)
+            superseded = lambda entry: entry[0] == 'tokens_moved' and entry[3] <= tokens
+        if superseded is not None and self.pending:
+            self._coalesce(superseded)
+
+        self.pending.append((message_type, seq, revision, tokens, frames, changes))
+        if len(self.pending) > queue_limit():
+            # Cliente saturado: em vez do backlog, o estado completo
+            metrics.OUTBOX_DROPPED.inc(len(self.pending), reason='overflow')
+            self.pending.clear()
+            self.resync = True
+
+    def _coalesce(self, superseded):
+        """Troca as entradas substituídas por marcadores (vizinhos viram um só)"""
+        kept = deque()
+        dropped = 0
+        for entry in self.pending:
+            if entry[0] == SKIPPED or superseded(entry):
+                if entry[0] != SKIPPED:
+                    dropped += 1
+                if kept and kept[-1][0] == SKIPPED:
+                    previous = kept.pop()
+                    entry = (SKIPPED, max(previous[1], entry[1]), _latest(previous[2], entry[2]), None, None, None)
+                else:
+                    entry = (SKIPPED, entry[1], entry[2], None, None, None)
+            kept.append(entry)
+        if dropped:
+            metrics.OUTBOX_DROPPED.inc(dropped, reason='coalesced')
+            self.pending = kept
@@ -0,0 +1,872 @@
+"""
+Estado autoritativo das salas mantido em memória.
+
+Cada sala com conexões abertas tem um RoomState neste processo. Ele carrega a
+cena ativa uma única vez (na primeira conexão) e todas as alterações (patches,
+movimento de tokens) são aplicadas em memória, sem ida ao banco. A gravação em
+Scene.scene_data é feita depois (write-behind), agrupando várias alterações em
+uma única escrita, e também quando o último membro se desconecta. Apenas os
+tokens alterados são gravados, cada um com um UPDATE na sua linha da tabela
+Token.
+
+Movimentos de tokens também são agrupados: cada sala tem um tick de broadcast
+(ROOM_BROADCAST_TICK_HZ) e, dentro de um tick, vários movimentos do mesmo token
+viram apenas a última posição. Todos os tokens movidos no tick saem em um único
+frame tokens_moved, com uma única revisão.
+
+A presença dos membros (quem está online) também fica aqui, e não no banco:
+cada conexão registra o membro e manda heartbeats periódicos. Conexões que
+param de responder por ROOM_PRESENCE_TIMEOUT segundos são derrubadas.
+
+Todo broadcast da sala recebe um número de sequência (seq) e fica guardado em
+um buffer circular (ROOM_REPLAY_BUFFER eventos). Um cliente que reconecta
+informa a época (epoch) e o último seq recebido e recebe apenas os eventos que
+perdeu; o estado completo só é reenviado quando o buffer já não cobre o
+intervalo ou a sala foi recarregada (epoch diferente).
+
+A gravação é event-sourced: cada revisão vira uma entrada no log da cena
+(SceneOp, um INSERT por lote de entradas), e scene_data e a tabela Token só
+são regravados como snapshot a cada SCENE_SNAPSHOT_INTERVAL revisões e quando
+a cena sai da memória. Carregar a cena é ler o snapshot e reaplicar as
+entradas posteriores a ele. Na compactação, o log anterior ao snapshot é
+apagado, exceto as últimas SCENE_OP_RETENTION revisões (histórico).
+
+Desfazer e refazer são operações do servidor: cada edição do mestre guarda as
+operações inversas, e undo/redo aplicam uma ou outra como uma nova revisão,
+que sai como um scene_patch comum (até SCENE_UNDO_DEPTH edições, enquanto a
+cena está em memória).
+
+O estado completo (frame room_state) é serializado uma vez e reaproveitado por
+todas as conexões e pela API HTTP até a cena ou a lista de membros mudar.
+
+Os jogadores recebem uma projeção da cena, calculada no servidor: tokens
+ocultos e campos do mestre nunca saem para eles. Cada broadcast gera frames
+para o mestre e, quando a projeção difere, frames próprios para os jogadores;
+eventos que não têm nada visível para os jogadores saem vazios, para manter a
+sequência (seq e revisão) igual para todos.
+
+Os tokens da cena ativa ficam também em um índice espacial (grid/spatial.py),
+usado para achar um token pelo id e para montar o estado de quem assinou um
+viewport (só os tokens da área visível).
+
+A revisão da cena (Scene.revision) é também o ETag da API de cenas. Quem
+substitui a cena inteira informa a revisão em que se baseou (If-Match na API,
+if_match no update_scene): se a cena mudou desde então, a troca é recusada com
+StaleRevision, em vez de apagar as alterações dos outros.
+"""
+import asyncio
+import copy
+import gzip
+import logging
+import time
+import uuid
+from collections import Counter, OrderedDict, deque
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.utils import timezone
+
+from . import metrics, tracing
+from .frames import JSON, encode_frame, encode_frames
+from .models import Room, RoomMember, Scene, SceneOp, Token, scene_thumbnail
+from .scene_ops import (
+    MASTER_ONLY_FIELDS, apply_op, diff_scene, find_token, inverse_ops, is_visible, player_ops,
+    player_scene, touched_tokens, validate_ops, validate_scene,
+)
+from .spatial import SpatialIndex
+
+logger = logging.getLogger(__name__)
+
+# Salas carregadas neste processo, indexadas pelo código
+_rooms = {}
+
+MASTER = 'master'
+
+
+class StaleRevision(Exception):
+    """A cena mudou desde a revisão informada (If-Match)"""
+
+    def __init__(self, revision):
+        super().__init__(revision)
+        self.revision = revision
+
+
+def flush_interval():
+    return getattr(settings, 'ROOM_STATE_FLUSH_INTERVAL', 2.0)
+
+
+def tick_interval():
+    tick_hz = getattr(settings, 'ROOM_BROADCAST_TICK_HZ', 20)
+    # 0 desliga o tick: os movimentos saem no próximo ciclo do event loop
+    return 1 / tick_hz if tick_hz > 0 else 0
+
+
+def presence_timeout():
+    return getattr(settings, 'ROOM_PRESENCE_TIMEOUT', 90)
+
+
+def replay_buffer_size():
+    return getattr(settings, 'ROOM_REPLAY_BUFFER', 512)
+
+
+def snapshot_interval():
+    return getattr(settings, 'SCENE_SNAPSHOT_INTERVAL', 200)
+
+
+def op_retention():
+    return getattr(settings, 'SCENE_OP_RETENTION', 500)
+
+
+def undo_depth():
+    return getattr(settings, 'SCENE_UNDO_DEPTH', 100)
+
+
+class RoomState:
+    def __init__(self, room_code):
+        self.room_code = room_code
+        self.group_name = f'game_room_{room_code}'
+        self.room_id = None
+        self.name = ''
+        self.scene_id = None
+        self.scene_data = {}
+        self.index = SpatialIndex()
+        self.revision = 0
+        self.snapshot_revision = 0
+        self.loaded = False
+        self.dirty = False
+        # Entradas do log ainda não gravadas: (revisão, tipo, ops, inversas)
+        self.log = []
+        # O que mudou desde o último snapshot
+        self.settings_dirty = False
+        self.tokens_replaced = False
+        self.dirty_tokens = set()
+        self.removed_tokens = set()
+        self.connections = 0
+        self.wire_formats = Counter()  # Conexões por formato de frame (JSON/MessagePack)
+        self._load_lock = asyncio.Lock()
+        self._flush_handle = None
+        # Movimentos ainda não enviados no tick atual: token_id -> movimento
+        self.pending_moves = {}
+        # Tokens ocultos entre os movimentos pendentes (não vão para os jogadores)
+        self.hidden_moves = set()
+        # Posição de cada token movido no tick antes do primeiro movimento (inversa do lote)
+        self.move_origins = {}
+        # Edições do mestre que podem ser desfeitas/refeitas: (ops, inversas)
+        self.undo_stack = deque(maxlen=undo_depth())
+        self.redo_stack = []
+        self._tick_handle = None
+        # Presença: membros da sala (member_id -> nome e papel), conexões por
+        # membro e último sinal de cada canal
+        self.members = {}
+        self.online = Counter()
+        self.presence = {}
+        self.roster_version = 0
+        self._sweep_handle = None
+        # Sequência dos eventos: a época muda sempre que a sala é carregada
+        self.epoch = uuid.uuid4().hex[:12]
+        self.seq = 0
+        self.replay = deque(maxlen=replay_buffer_size())
+        # Snapshot (room_state) já serializado, por papel e formato
+        self._snapshot_key = None
+        self._snapshots = {}
+        # Projeção da cena para os jogadores, por revisão
+        self._projection_key = None
+        self._projection = None
+
+    # ==================== Carga e persistência ====================
+
+    def load(self):
+        """Carrega a sala e a cena ativa do banco (síncrono)"""
+        room = Room.objects.get(code=self.room_code)
+        self.room_id = room.id
+        self.name = room.name
+        self.members = {
+            member.pop('id'): member
+            for member in RoomMember.objects.filter(room_id=room.id)
+            .order_by('joined_at')
+            .values('id', 'player_name', 'role')
+        }
+        self._load_active_scene()
+        self.loaded = True
+
+    def _load_active_scene(self):
+        active_scene = Scene.objects.filter(room_id=self.room_id, is_active=True).first()
+        tail = []
+        if active_scene:
+            self.scene_id = active_scene.id
+            self.scene_data = active_scene.snapshot_data()
+            self.revision = active_scene.revision
+            self.snapshot_revision = active_scene.snapshot_revision
+            tail = active_scene.op_tail()
+        else:
+            self.scene_id = None
+            self.scene_data = {}
+            self.revision = 0
+            self.snapshot_revision = 0
+        self.index = SpatialIndex(self.scene_data.get('tokens', []))
+        self._clear_changes()
+        self.log = []
+        self.undo_stack.clear()
+        self.redo_stack = []
+        # Entradas do log posteriores ao snapshot: entram no próximo snapshot
+        for ops in tail:
+            self._apply(ops)
+
+    def _clear_changes(self):
+        self.dirty = False
+        self.settings_dirty = False
+        self.tokens_replaced = False
+        self.dirty_tokens = set()
+        self.removed_tokens = set()
+
+    def _active_scene_id(self):
+        return (
+            Scene.objects.filter(room_id=self.room_id, is_active=True)
+            .values_list('id', flat=True)
+            .first()
+        )
+
+    @staticmethod
+    def _write_scene(scene_id, revision, entries, token_count, thumbnail, snapshot=None):
+        """
+        Grava as entradas novas do log e o resumo da cena. Com snapshot
+        (settings_data, replaced, removed, tokens), grava também o snapshot e
+        apaga o log anterior a ele além da retenção.
+        """
+        with transaction.atomic():
+            scene_fields = {
+                'revision': revision, 'updated_at': timezone.now(), 'token_count': token_count, 'thumbnail': thumbnail,
+            }
+            if snapshot is not None:
+                settings_data, replaced, removed, tokens = snapshot
+                scene_fields['snapshot_revision'] = revision
+                if settings_data is not None:
+                    scene_fields['scene_data'] = settings_data
+            if not Scene.objects.filter(pk=scene_id).update(**scene_fields):
+                # A cena foi deletada enquanto estava em memória
+                return
+
+            # Um único INSERT para todas as entradas do intervalo
+            SceneOp.objects.bulk_create([
+                SceneOp(scene_id=scene_id, revision=entry_revision, kind=kind, ops=ops, inverse=inverse)
+                for entry_revision, kind, ops, inverse in entries
+            ])
+            if snapshot is None:
+                return
+
+            if revision > op_retention():
+                SceneOp.objects.filter(scene_id=scene_id, revision__lte=revision - op_retention()).delete()
+
+            if replaced:
+                Token.objects.filter(scene_id=scene_id).delete()
+                Token.objects.bulk_create([
+                    Token.from_dict(scene_id, data, order=order) for order, data in tokens
+                ])
+                return
+
+            if removed:
+                Token.objects.filter(scene_id=scene_id, token_id__in=removed).delete()
+
+            # Um UPDATE de uma linha por token alterado (INSERT se for novo)
+            for order, data in tokens:
+                fields = Token.fields_from_dict(data)
+                updated = Token.objects.filter(scene_id=scene_id, token_id=data['id']).update(**fields)
+                if not updated:
+                    Token.objects.create(scene_id=scene_id, token_id=data['id'], order=order, **fields)
+
+    async def flush(self, snapshot=False):
+        """
+        Grava no banco as entradas novas do log. O snapshot é regravado a cada
+        SCENE_SNAPSHOT_INTERVAL revisões, ou com snapshot=True (a cena sai da memória).
+        Retorna False se a gravação falhou (as alterações continuam na fila).
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self.scene_id is None:
+            return True
+        snapshot = snapshot or self.revision - self.snapshot_revision >= snapshot_interval()
+        if not self.log and not (snapshot and self.revision != self.snapshot_revision):
+            return True
+
+        # Cópia feita no event loop: a escrita roda em outra thread enquanto
+        # novas alterações continuam chegando
+        entries = self.log
+        self.log = []
+        self.dirty = False
+        snapshot_args = None
+        if snapshot:
+            settings_data = None
+            if self.settings_dirty:
+                settings_data = copy.deepcopy({k: v for k, v in self.scene_data.items() if k != 'tokens'})
+            tokens = [
+                (order, copy.deepcopy(token))
+                for order, token in enumerate(self.scene_data.get('tokens', []))
+                if self.tokens_replaced or token.get('id') in self.dirty_tokens
+            ]
+            snapshot_args = (settings_data, self.tokens_replaced, list(self.removed_tokens), tokens)
+            self._clear_changes()
+        revision = self.revision
+        args = (
+            self.scene_id, revision, entries,
+            len(self.scene_data.get('tokens', [])), scene_thumbnail(self.scene_data), snapshot_args,
+        )
+        try:
+            with metrics.DB_CALL_SECONDS.time(helper='write_scene'), tracing.span('db.write_scene'):
+                await database_sync_to_async(self._write_scene)(*args)
+        except Exception:
+            logger.exception('Erro ao salvar a cena da sala %s', self.room_code)
+            # As entradas voltam para a fila; o próximo snapshot grava a cena inteira
+            self.log = entries + self.log
+            if snapshot_args is not None:
+                self.settings_dirty = True
+                self.tokens_replaced = True
+            self._mark_dirty()
+            return False
+        if snapshot_args is not None:
+            self.snapshot_revision = revision
+        return True
+
+    def _mark_dirty(self):
+        self.dirty = True
+        # Agrupa todas as alterações do intervalo em uma única escrita
+        if self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(
+                flush_interval(),
+                lambda: asyncio.ensure_future(self._flush_later())
+            )
+
+    async def _flush_later(self):
+        """Gravação do write-behind; sem conexões (a gravação final falhou), a sala sai da memória quando gravar"""
+        if self.connections > 0:
+            await self.flush()
+        elif await self.flush(snapshot=True):
+            _unload(self)
+
+    async def sync_active_scene(self):
+        """Recarrega a cena ativa quando ela foi trocada (switch_scene_api)"""
+        with metrics.DB_CALL_SECONDS.time(helper='active_scene_id'), tracing.span('db.active_scene_id'):
+            scene_id = await database_sync_to_async(self._active_scene_id)()
+        if scene_id != self.scene_id:
+            await self.flush_moves()
+            # A cena sai da memória com o snapshot em dia
+            await self.flush(snapshot=True)
+            with metrics.DB_CALL_SECONDS.time(helper='load_active_scene'), tracing.span('db.load_active_scene'):
+                await database_sync_to_async(self._load_active_scene)()
+
+    def active_wire_formats(self):
+        return [wire_format for wire_format, count in self.wire_formats.items() if count > 0]
+
+    # ==================== Snapshot ====================
+
+    def player_scene(self):
+        """Cena sem tokens ocultos nem campos do mestre, recalculada só quando a revisão muda"""
+        key = (self.scene_id, self.revision)
+        if key != self._projection_key:
+            self._projection_key = key
+            self._projection = player_scene(self.scene_data)
+        return self._projection
+
+    def tokens_in(self, viewport, role=MASTER):
+        """Tokens da área (índice espacial); jogadores não recebem os ocultos"""
+        tokens = self.index.query(viewport)
+        if role != MASTER:
+            tokens = [token for token in tokens if is_visible(token)]
+        return tokens
+
+    def viewport_scene(self, viewport, role=MASTER):
+        """Cena com apenas os tokens do viewport (estado de quem assinou um viewport)"""
+        scene_data = {
+            key: value for key, value in self.scene_data.items()
+            if key != 'tokens' and (role == MASTER or key not in MASTER_ONLY_FIELDS)
+        }
+        scene_data['tokens'] = self.tokens_in(viewport, role)
+        return scene_data
+
+    def room_data(self, role=MASTER, scene_data=None):
+        if scene_data is None:
+            scene_data = self.scene_data if role == MASTER else self.player_scene()
+        return {
+            'code': self.room_code,
+            'name': self.name,
+            'scene_data': scene_data,
+            'revision': self.revision,
+            'members': self.roster(),
+            # Posição no fluxo de eventos, usada para retomar após reconexão
+            'epoch': self.epoch,
+            'seq': self.seq
+        }
+
+    def _snapshot_cache(self):
+        # Todo evento da sala muda a revisão da cena ou a lista de membros (e o seq)
+        key = (self.scene_id, self.revision, self.roster_version, self.seq)
+        if key != self._snapshot_key:
+            self._snapshot_key = key
+            self._snapshots = {}
+        return self._snapshots
+
+    def snapshot(self, wire_format=JSON, role=MASTER):
+        """Frame room_state serializado, reaproveitado enquanto a cena e os membros não mudam"""
+        cache = self._snapshot_cache()
+        key = (role == MASTER, wire_format)
+        if key not in cache:
+            with tracing.span('encode.room_state'):
+                cache[key] = encode_frame('room_state', {'data': self.room_data(role)}, wire_format)
+        return cache[key]
+
+    def snapshot_gzip(self, role=MASTER):
+        """Snapshot JSON comprimido com gzip (API HTTP)"""
+        cache = self._snapshot_cache()
+        key = (role == MASTER, 'gzip')
+        if key not in cache:
+            cache[key] = gzip.compress(self.snapshot(JSON, role).encode(), compresslevel=6)
+        return cache[key]
+
+    # ==================== Broadcast ====================
+
+    async def broadcast(self, message_type, payload, player_payload=None):
+        """
+        Envia para o grupo a mensagem já serializada, uma vez por formato em uso
+        na sala. player_payload é a versão dos jogadores, quando difere da do mestre.
+        """
+        self.seq += 1
+        payload = {**payload, 'seq': self.seq}
+        wire_formats = self.active_wire_formats()
+        with tracing.span(f'encode.{message_type}'):
+            frames = encode_frames(message_type, payload, wire_formats)
+            player_frames = None
+            if player_payload is not None:
+                player_payload = {**player_payload, 'seq': self.seq}
+                player_frames = encode_frames(message_type, player_payload, wire_formats)
+        self.replay.append((self.seq, message_type, payload, frames, player_payload, player_frames))
+        if metrics.is_enabled():
+            for wire_format, frame in frames.items():
+                metrics.FRAME_BYTES.observe(len(frame), type=message_type, format=wire_format)
+            for wire_format, frame in (player_frames or {}).items():
+                metrics.FRAME_BYTES.observe(len(frame), type=message_type, format=wire_format)
+        with metrics.GROUP_SEND_SECONDS.time(type=message_type), tracing.span(f'group_send.{message_type}'):
+            await get_channel_layer().group_send(
+                self.group_name,
+                {
+                    'type': message_type,
+                    'frames': frames,
+                    # Frames dos jogadores (None: iguais aos do mestre)
+                    'player_frames': player_frames,
+                    # Usados pela fila de saída de cada conexão para agrupar eventos
+                    'seq': payload['seq'],
+                    'revision': payload.get('revision'),
+                    'tokens': touched_tokens(message_type, payload),
+                    # Posições e operações, para filtrar os eventos pelo viewport de cada conexão
+                    'moves': payload['moves'] if message_type == 'tokens_moved' else None,
+                    'ops': payload['ops'] if message_type == 'scene_patch' else None,
+                    'player_ops': player_payload['ops'] if message_type == 'scene_patch' and player_payload else None
+                }
+            )
+
+    async def broadcast_scene(self):
+        """Envia a cena inteira (scene_update); os jogadores recebem a projeção"""
+        await self.broadcast('scene_update', {
+            'scene_data': self.scene_data,
+            'revision': self.revision
+        }, {
+            'scene_data': self.player_scene(),
+            'revision': self.revision
+        })
+
+    def frames_since(self, epoch, last_seq, wire_format, role=MASTER):
+        """
+        Frames dos eventos posteriores a last_seq, para um cliente que reconectou.
+
+        Retorna None quando não é possível retomar (outra época ou o buffer já
+        descartou eventos do intervalo) e o cliente precisa do estado completo.
+        """
+        if epoch != self.epoch or not 0 <= last_seq <= self.seq:
+            return None
+        if last_seq < self.seq and (not self.replay or self.replay[0][0] > last_seq + 1):
+            return None
+        missed = []
+        for seq, message_type, payload, frames, player_payload, player_frames in self.replay:
+            if seq <= last_seq:
+                continue
+            if role != MASTER and player_payload is not None:
+                payload, frames = player_payload, player_frames
+            missed.append(frames.get(wire_format) or encode_frame(message_type, payload, wire_format))
+        return missed
+
+    def _schedule_tick(self):
+        if self._tick_handle is None:
+            loop = asyncio.get_running_loop()
+            self._tick_handle = loop.call_later(
+                tick_interval(),
+                lambda: asyncio.ensure_future(self.flush_moves())
+            )
+
+    async def flush_moves(self):
+        """Envia os movimentos acumulados no tick em um único tokens_moved"""
+        if self._tick_handle is not None:
+            self._tick_handle.cancel()
+            self._tick_handle = None
+
+        if not self.pending_moves:
+            return
+
+        moves = list(self.pending_moves.values())
+        hidden = self.hidden_moves
+        origins = self.move_origins
+        self.pending_moves = {}
+        self.hidden_moves = set()
+        self.move_origins = {}
+        # Uma revisão (e uma entrada no log) por tick, não por movimento
+        revision = self._record(SceneOp.MOVE, [
+            {'op': 'update_token', 'id': move['token_id'], 'changes': {'gridX': move['gridX'], 'gridY': move['gridY']}}
+            for move in moves
+        ], [
+            {'op': 'update_token', 'id': token_id, 'changes': {'gridX': grid_x, 'gridY': grid_y}}
+            for token_id, (grid_x, grid_y) in origins.items()
+        ])
+        player_payload = None
+        if hidden:
+            # Jogadores não veem tokens ocultos (o lote pode sair vazio, só com a revisão)
+            player_payload = {
+                'moves': [move for move in moves if move['token_id'] not in hidden],
+                'revision': revision
+            }
+        await self.broadcast('tokens_moved', {
+            'moves': moves,
+            'revision': revision
+        }, player_payload)
+
+    # ==================== Presença ====================
+
+    def member_info(self, member_id):
+        return {**self.members[member_id], 'is_online': self.online[member_id] > 0}
+
+    def roster(self):
+        return [self.member_info(member_id) for member_id in self.members]
+
+    def member_connected(self, channel_name, member_id, player_name, role):
+        """Registra uma conexão; retorna o membro se ele acabou de ficar online"""
+        self.members[member_id] = {'player_name': player_name, 'role': role}
+        self.presence[channel_name] = {'member_id': member_id, 'last_seen': time.monotonic()}
+        self.online[member_id] += 1
+        self._schedule_sweep()
+        if self.online[member_id] == 1:
+            self.roster_version += 1
+            return self.member_info(member_id)
+        return None
+
+    def member_disconnected(self, channel_name):
+        """Remove uma conexão; retorna o membro se ele ficou offline"""
+        entry = self.presence.pop(channel_name, None)
+        if entry is None:
+            return None
+        member_id = entry['member_id']
+        self.online[member_id] -= 1
+        if self.online[member_id] > 0:
+            return None
+        del self.online[member_id]
+        self.roster_version += 1
+        return self.member_info(member_id)
+
+    def heartbeat(self, channel_name):
+        entry = self.presence.get(channel_name)
+        if entry is not None:
+            entry['last_seen'] = time.monotonic()
+
+    def _schedule_sweep(self):
+        if self._sweep_handle is None:
+            loop = asyncio.get_running_loop()
+            self._sweep_handle = loop.call_later(
+                presence_timeout() / 3,
+                lambda: asyncio.ensure_future(self.sweep_presence())
+            )
+
+    async def sweep_presence(self):
+        """Derruba as conexões que pararam de mandar heartbeat"""
+        self._sweep_handle = None
+        deadline = time.monotonic() - presence_timeout()
+        expired = [
+            channel_name for channel_name, entry in self.presence.items()
+            if entry['last_seen'] < deadline
+        ]
+        for channel_name in expired:
+            member = self.member_disconnected(channel_name)
+            if member is not None:
+                await self.broadcast('member_left', {'member': member})
+            await get_channel_layer().send(channel_name, {'type': 'presence_expired'})
+        if self.presence:
+            self._schedule_sweep()
+
+    # ==================== Alterações em memória ====================
+
+    def _bump(self):
+        self.revision += 1
+        self._mark_dirty()
+        return self.revision
+
+    def _record(self, kind, ops, inverse):
+        """Nova revisão, com a entrada correspondente no log"""
+        revision = self._bump()
+        self.log.append((revision, kind, ops, inverse))
+        return revision
+
+    def _apply(self, ops):
+        """Aplica operações já validadas, marcando o que muda no próximo snapshot"""
+        for op in ops:
+            apply_op(self.scene_data, op)
+        for op in ops:
+            if op['op'] == 'set':
+                self.settings_dirty = True
+            elif op['op'] == 'remove_token':
+                self.removed_tokens.add(op['id'])
+                self.dirty_tokens.discard(op['id'])
+                self.index.remove(op['id'])
+            else:
+                token_id = op['token']['id'] if op['op'] == 'add_token' else op['id']
+                self.dirty_tokens.add(token_id)
+                token = find_token(self.scene_data, token_id)
+                if token is not None:
+                    self.index.update(token)
+
+    def _commit(self, kind, ops, inverse):
+        """Aplica ops como uma nova revisão; retorna a revisão e as operações dos jogadores"""
+        projected = player_ops(self.scene_data, ops)
+        self._apply(ops)
+        return self._record(kind, ops, inverse), projected
+
+    def _push_undo(self, ops, inverse):
+        if ops:
+            self.undo_stack.append((ops, inverse))
+            self.redo_stack = []
+
+    def replace_scene(self, scene_data, expected=None):
+        """Substitui a cena inteira e retorna a nova revisão (expected: revisão do If-Match)"""
+        if self.scene_id is None:
+            return None
+        if expected is not None and expected != self.revision:
+            raise StaleRevision(self.revision)
+        validate_scene(scene_data)
+        scene_data = scene_data or {}
+        # No log a troca vira a diferença entre as duas cenas
+        ops = diff_scene(self.scene_data, scene_data)
+        inverse = diff_scene(scene_data, self.scene_data)
+        self.scene_data = scene_data
+        self.index = SpatialIndex(self.scene_data.get('tokens', []))
+        self.settings_dirty = True
+        self.tokens_replaced = True
+        revision = self._record(SceneOp.EDIT, ops, inverse)
+        self._push_undo(ops, inverse)
+        return revision
+
+    def apply_ops(self, ops):
+        """
+        Aplica um patch na cena. Retorna a nova revisão e as operações como os
+        jogadores devem recebê-las (a própria lista ops quando não há diferença).
+        """
+        if self.scene_id is None:
+            return None, ops
+        validate_ops(ops)
+        inverse = inverse_ops(self.scene_data, ops)
+        revision, projected = self._commit(SceneOp.EDIT, ops, inverse)
+        self._push_undo(ops, inverse)
+        return revision, projected
+
+    def undo(self):
+        """
+        Desfaz a última edição do mestre, aplicando as operações inversas como
+        uma nova revisão. Retorna (revisão, ops, ops dos jogadores) ou None.
+        """
+        if self.scene_id is None or not self.undo_stack:
+            return None
+        ops, inverse = self.undo_stack.pop()
+        revision, projected = self._commit(SceneOp.UNDO, inverse, ops)
+        self.redo_stack.append((ops, inverse))
+        return revision, inverse, projected
+
+    def redo(self):
+        """Refaz a última edição desfeita; mesmo retorno de undo"""
+        if self.scene_id is None or not self.redo_stack:
+            return None
+        ops, inverse = self.redo_stack.pop()
+        revision, projected = self._commit(SceneOp.REDO, ops, inverse)
+        self.undo_stack.append((ops, inverse))
+        return revision, ops, projected
+
+    def can_move_token(self, token_id, player_name):
+        token = self.index.get(token_id)
+        return bool(token) and token.get('controlledBy') == player_name
+
+    def move_token(self, token_id, grid_x, grid_y, moved_by):
+        """
+        Atualiza a posição de um token e agenda o envio no próximo tick.
+
+        A revisão só avança quando o tick envia o lote (flush_moves); a gravação
+        no banco segue o write-behind e guarda apenas a última posição.
+        """
+        if self.scene_id is None:
+            return
+        token = self.index.get(token_id)
+        if token is None:
+            return
+        self.move_origins.setdefault(token_id, (token.get('gridX'), token.get('gridY')))
+        token['gridX'] = grid_x
+        token['gridY'] = grid_y
+        self.index.update(token)
+        if is_visible(token):
+            self.hidden_moves.discard(token_id)
+        else:
+            self.hidden_moves.add(token_id)
+        self.dirty_tokens.add(token_id)
+        self.pending_moves[token_id] = {
+            'token_id': token_id,
+            'gridX': grid_x,
+            'gridY': grid_y,
+            'moved_by': moved_by
+        }
+        self._schedule_tick()
+
+
+async def acquire(room_code):
+    """Retorna o estado da sala (carregando do banco na primeira conexão)"""
+    state = _rooms.get(room_code)
+    if state is None:
+        state = _rooms[room_code] = RoomState(room_code)
+    state.connections += 1
+
+    async with state._load_lock:
+        if not state.loaded:
+            try:
+                with metrics.DB_CALL_SECONDS.time(helper='load_room'), tracing.span('db.load_room'):
+                    await database_sync_to_async(state.load)()
+            except Exception:
+                await release(state)
+                raise
+    return state
+
+
+# Salas fechadas cujo snapshot fica guardado para as views HTTP (as mais recentes)
+COLD_SNAPSHOT_ROOMS = 128
+
+# Salas fechadas: código -> (versão no banco, RoomState carregado só para o snapshot)
+_cold_rooms = OrderedDict()
+
+
+def cold_version(room_code):
+    """
+    O que muda o snapshot de uma sala fechada, em uma consulta: a sala e o
+    nome, a cena ativa e a revisão, e o número de membros. None se a sala não existe.
+    """
+    active = Scene.objects.filter(room_id=OuterRef('pk'), is_active=True)
+    return Room.objects.filter(code=room_code).annotate(
+        active_scene_id=Subquery(active.values('id')[:1]),
+        active_revision=Subquery(active.values('revision')[:1]),
+        member_count=Count('members'),
+    ).values_list('id', 'name', 'active_scene_id', 'active_revision', 'member_count').first()
+
+
+def _load_cold(room_code):
+    version = cold_version(room_code)
+    cached = _cold_rooms.get(room_code)
+    if cached is not None and version is not None and cached[0] == version:
+        _cold_rooms.move_to_end(room_code)
+        return cached[1]
+    state = RoomState(room_code)
+    state.load()
+    _cold_rooms[room_code] = (version, state)
+    _cold_rooms.move_to_end(room_code)
+    while len(_cold_rooms) > COLD_SNAPSHOT_ROOMS:
+        _cold_rooms.popitem(last=False)
+    return state
+
+
+async def room_snapshot(room_code, compressed=False, role=None):
+    """
+    Snapshot JSON da sala para as views HTTP.
+
+    Usa o estado em memória quando a sala está aberta neste processo; senão
+    monta o snapshot a partir do banco, sem registrar a sala. Esse snapshot
+    frio é reaproveitado (uma consulta) enquanto a revisão da cena ativa, o
+    nome e os membros da sala não mudam no banco. Sem papel, vale a visão
+    dos jogadores.
+    """
+    state = _rooms.get(room_code)
+    if state is None or not state.loaded:
+        state = await database_sync_to_async(_load_cold)(room_code)
+    return state.snapshot_gzip(role) if compressed else state.snapshot(JSON, role)
+
+
+async def open_scene(room_code, scene_id):
+    """
+    (revisão, cópia do scene_data) da cena, se ela é a cena ativa de uma sala
+    aberta neste processo: o banco pode estar atrás da memória (write-behind).
+    No modo cluster, a view só chama aqui no worker dono da sala.
+    """
+    state = _rooms.get(room_code)
+    if state is None or not state.loaded or state.scene_id != scene_id:
+        return None
+    return state.revision, copy.deepcopy(state.scene_data)
+
+
+async def put_scene(room_code, scene_id, scene_data, expected=None):
+    """
+    Substitui pela API HTTP a cena ativa de uma sala aberta neste processo.
+
+    A troca passa pelo estado em memória (e vai para os jogadores), para não
+    ser sobrescrita pela próxima gravação. Retorna a nova revisão, ou None se
+    a cena não está em memória (a view grava direto no banco).
+    """
+    state = _rooms.get(room_code)
+    if state is None or not state.loaded:
+        return None
+    await state.sync_active_scene()
+    if state.scene_id != scene_id:
+        return None
+    await state.flush_moves()
+    revision = state.replace_scene(scene_data, expected)
+    await state.broadcast_scene()
+    return revision
+
+
+async def release(state):
+    """Libera uma conexão; a última grava a cena e descarrega a sala"""
+    state.connections -= 1
+    if state.connections > 0:
+        return
+
+    if state._sweep_handle is not None:
+        state._sweep_handle.cancel()
+        state._sweep_handle = None
+    await state.flush_moves()
+    if not await state.flush(snapshot=True):
+        # Descarregar a sala perderia as alterações: ela fica em memória e o
+        # write-behind tenta gravar de novo (e descarrega a sala quando conseguir)
+        logger.error(
+            'Cena da sala %s não foi gravada ao sair; a sala continua em memória (revisão %s)',
+            state.room_code, state.revision
+        )
+        return
+    _unload(state)
+
+
+def _unload(state):
+    # Alguém pode ter entrado enquanto a cena era gravada
+    if state.connections == 0 and _rooms.get(state.room_code) is state:
+        del _rooms[state.room_code]
+
+
+async def hand_off(room_code, url):
+    """
+    Entrega a sala para outro worker (cluster): grava a cena e fecha as
+    conexões com ROOM_MOVED; a última conexão a sair descarrega a sala.
+    """
+    state = _rooms.get(room_code)
+    if state is None:
+        return
+    await state.flush_moves()
+    await state.flush(snapshot=True)
+    await get_channel_layer().group_send(state.group_name, {'type': 'room_moved', 'url': url})
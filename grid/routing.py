@@ -1,7 +1,13 @@
+from channels.auth import AuthMiddlewareStack
 from django.urls import re_path
-from . import consumers
+from . import consumers, uploads
 
 websocket_urlpatterns = [
     re_path(r'ws/room/(?P<room_code>\w+)/$', consumers.GameRoomConsumer.as_asgi()),
 ]
 
+
+# Upload com a imagem crua no corpo, tratado antes do Django (veja grid.uploads)
+http_urlpatterns = [
+    re_path(r'^api/upload/$', AuthMiddlewareStack(uploads.UploadConsumer.as_asgi())),
+]
@@ -0,0 +1,334 @@
+"""
+Protocolo de patches incrementais para o scene_data de uma cena.
+
+Em vez de reenviar o estado completo da cena a cada alteração, o mestre envia
+uma lista de operações pequenas que o servidor aplica sobre a cena salva e
+repassa para os jogadores. Operações suportadas:
+
+    {'op': 'add_token', 'token': {...}}
+    {'op': 'remove_token', 'id': 3}
+    {'op': 'update_token', 'id': 3, 'changes': {'gridX': 4, 'gridY': 2}}
+    {'op': 'set', 'changes': {'gridSize': 40, 'backgroundImage': '...'}}
+
+As mesmas operações formam o log de cada cena (SceneOp): cada entrada guarda
+as operações aplicadas e as que as desfazem (inverse_ops), e uma troca da
+cena inteira vira a diferença entre as duas cenas (diff_scene).
+"""
+
+# Campos que podem existir em cada token da cena
+TOKEN_FIELDS = {
+    'id', 'name', 'imageSrc', 'size', 'gridX', 'gridY', 'visible', 'controlledBy',
+}
+
+# Propriedades da cena (grid, fundo e visualização) alteráveis via 'set'
+SCENE_FIELDS = {
+    'backgroundImage', 'backgroundTiles', 'imageOpacity', 'imageScale', 'bgColor', 'gridColor',
+    'gridOpacity', 'gridSize', 'lineWidth', 'offsetX', 'offsetY', 'scale',
+    'nextTokenId',
+}
+
+OP_TYPES = {'add_token', 'remove_token', 'update_token', 'set'}
+
+# Campos dos tokens que precisam ser inteiros (bool não conta) e booleanos
+INT_FIELDS = {'id', 'size', 'gridX', 'gridY'}
+BOOL_FIELDS = {'visible'}
+# Faixa das colunas inteiras do modelo Token
+INT_RANGE = range(-2 ** 31, 2 ** 31)
+# Campos de texto (ou None) dos tokens e o max_length da coluna do modelo Token (None: sem limite)
+STR_FIELDS = {'name': 100, 'imageSrc': None, 'controlledBy': 50}
+
+# Propriedades da cena que só o mestre recebe (contador de ids dos tokens)
+MASTER_ONLY_FIELDS = {'nextTokenId'}
+
+
+def find_token(scene_data, token_id):
+    """Retorna o token com o id informado ou None"""
+    for token in scene_data.get('tokens', []):
+        if token.get('id') == token_id:
+            return token
+    return None
+
+
+def _check_fields(changes, allowed):
+    if not isinstance(changes, dict):
+        raise ValueError('changes deve ser um objeto')
+    unknown = set(changes) - allowed
+    if unknown:
+        raise ValueError(f"Campos desconhecidos: {', '.join(sorted(unknown))}")
+    _check_types(changes)
+
+
+def _check_types(changes, nullable=False):
+    # Um valor que a coluna do Token não aceita faria a gravação falhar (e repetir) para sempre
+    for field in INT_FIELDS & set(changes):
+        value = changes[field]
+        if value is None and nullable and field != 'id':
+            continue
+        if not is_int(value):
+            raise ValueError(f'{field} deve ser um inteiro')
+    for field in BOOL_FIELDS & set(changes):
+        if not isinstance(changes[field], bool):
+            raise ValueError(f'{field} deve ser um booleano')
+    for field in STR_FIELDS.keys() & set(changes):
+        value = changes[field]
+        if value is None:
+            continue
+        if not isinstance(value, str):
+            raise ValueError(f'{field} deve ser um texto')
+        if STR_FIELDS[field] is not None and len(value) > STR_FIELDS[field]:
+            raise ValueError(f'{field} deve ter no máximo {STR_FIELDS[field]} caracteres')
+
+
+def is_int(value):
+    """True se value for um inteiro de verdade (True/False não contam) que cabe nas colunas do Token"""
+    return isinstance(value, int) and not isinstance(value, bool) and value in INT_RANGE
+
+
+def validate_op(op):
+    """Valida o formato de uma operação, levantando ValueError se inválida"""
+    if not isinstance(op, dict) or op.get('op') not in OP_TYPES:
+        raise ValueError('Operação inválida')
+
+    kind = op['op']
+    if kind == 'add_token':
+        token = op.get('token')
+        _check_fields(token, TOKEN_FIELDS)
+        if 'id' not in token:
+            raise ValueError('Token sem id')
+    elif kind == 'remove_token':
+        if not is_int(op.get('id')):
+            raise ValueError('remove_token sem id')
+    elif kind == 'update_token':
+        if not is_int(op.get('id')):
+            raise ValueError('update_token sem id')
+        _check_fields(op.get('changes'), TOKEN_FIELDS - {'id'})
+    elif kind == 'set':
+        _check_fields(op.get('changes'), SCENE_FIELDS)
+
+
+def validate_scene(scene_data):
+    """
+    Valida os tipos de um scene_data inteiro (update_scene e API), levantando
+    ValueError. Campos extras dos tokens são aceitos; posição e tamanho nulos
+    valem 0, como no banco.
+    """
+    if scene_data is None:
+        return
+    if not isinstance(scene_data, dict):
+        raise ValueError('scene_data deve ser um objeto')
+    tokens = scene_data.get('tokens', [])
+    if not isinstance(tokens, list):
+        raise ValueError('tokens deve ser uma lista')
+    for token in tokens:
+        if not isinstance(token, dict) or 'id' not in token:
+            raise ValueError('Token sem id')
+        _check_types(token, nullable=True)
+
+
+def apply_op(scene_data, op):
+    """Aplica uma operação já validada sobre o scene_data (in-place)"""
+    tokens = scene_data.setdefault('tokens', [])
+    kind = op['op']
+
+    if kind == 'add_token':
+        token = dict(op['token'])
+        existing = find_token(scene_data, token['id'])
+        if existing is not None:
+            # Reenvio do mesmo token: trata como atualização
+            existing.update(token)
+        else:
+            tokens.append(token)
+    elif kind == 'remove_token':
+        scene_data['tokens'] = [t for t in tokens if t.get('id') != op['id']]
+    elif kind == 'update_token':
+        token = find_token(scene_data, op['id'])
+        if token is not None:
+            token.update(op['changes'])
+    elif kind == 'set':
+        scene_data.update(op['changes'])
+
+
+def validate_ops(ops):
+    if not isinstance(ops, list):
+        raise ValueError('ops deve ser uma lista')
+    for op in ops:
+        validate_op(op)
+
+
+def apply_ops(scene_data, ops):
+    """
+    Valida e aplica uma lista de operações sobre o scene_data.
+
+    Todas as operações são validadas antes de qualquer alteração, então uma
+    lista inválida não deixa a cena pela metade.
+    """
+    validate_ops(ops)
+    for op in ops:
+        apply_op(scene_data, op)
+    return scene_data
+
+
+def touched_tokens(message_type, payload):
+    """Ids dos tokens alterados por um evento tokens_moved ou scene_patch (None nos demais)"""
+    if message_type == 'tokens_moved':
+        return [move['token_id'] for move in payload['moves']]
+    if message_type == 'scene_patch':
+        return [
+            op['token']['id'] if op['op'] == 'add_token' else op['id']
+            for op in payload['ops'] if op['op'] != 'set'
+        ]
+    return None
+
+
+# ==================== Histórico (log de operações) ====================
+
+def inverse_ops(scene_data, ops):
+    """
+    Operações que desfazem ops, na ordem em que devem ser aplicadas (chamar
+    antes de aplicar ops). Campos que não existiam voltam como None.
+    """
+    # Estado dos tokens e propriedades tocados, atualizado operação a operação
+    touched = {}
+    settings = {}
+
+    def current(token_id):
+        if token_id not in touched:
+            token = find_token(scene_data, token_id)
+            touched[token_id] = dict(token) if token is not None else None
+        return touched[token_id]
+
+    inverse = []
+    for op in ops:
+        kind = op['op']
+        if kind == 'set':
+            inverse.append({'op': 'set', 'changes': {
+                key: settings.get(key, scene_data.get(key)) for key in op['changes']
+            }})
+            settings.update(op['changes'])
+            continue
+
+        token_id = op['token']['id'] if kind == 'add_token' else op['id']
+        before = current(token_id)
+        if kind == 'remove_token':
+            if before is not None:
+                inverse.append({'op': 'add_token', 'token': before})
+            touched[token_id] = None
+        elif kind == 'add_token':
+            if before is None:
+                inverse.append({'op': 'remove_token', 'id': token_id})
+            else:
+                # add_token de um token existente é uma atualização: volta o token anterior
+                inverse.append({'op': 'add_token', 'token': before})
+            touched[token_id] = {**(before or {}), **op['token']}
+        elif before is not None:
+            inverse.append({'op': 'update_token', 'id': token_id, 'changes': {
+                key: before.get(key) for key in op['changes']
+            }})
+            touched[token_id] = {**before, **op['changes']}
+    inverse.reverse()
+    return inverse
+
+
+def diff_scene(before, after):
+    """
+    Operações que transformam a cena before em after. Todos os campos entram,
+    inclusive os extras dos tokens e da cena (campos que somem voltam como None),
+    para o log reconstruir a cena e o desfazer voltar a cena anterior inteira.
+    """
+    ops = []
+    old_tokens = {token.get('id'): token for token in before.get('tokens', [])}
+    new_ids = set()
+    for token in after.get('tokens', []):
+        token_id = token.get('id')
+        new_ids.add(token_id)
+        old = old_tokens.get(token_id)
+        if old is None:
+            ops.append({'op': 'add_token', 'token': dict(token)})
+            continue
+        changes = _changed(old, token, (set(old) | set(token)) - {'id'})
+        if changes:
+            ops.append({'op': 'update_token', 'id': token_id, 'changes': changes})
+    for token_id in old_tokens:
+        if token_id not in new_ids:
+            ops.append({'op': 'remove_token', 'id': token_id})
+
+    changes = _changed(before, after, (set(before) | set(after)) - {'tokens'})
+    if changes:
+        ops.append({'op': 'set', 'changes': changes})
+    return ops
+
+
+def _changed(old, new, keys):
+    return {key: new.get(key) for key in sorted(keys, key=str) if old.get(key) != new.get(key)}
+
+
+# ==================== Projeção para os jogadores ====================
+
+def is_visible(token):
+    return token.get('visible', True) is not False
+
+
+def player_scene(scene_data):
+    """Cena como os jogadores a veem: sem tokens ocultos nem campos do mestre"""
+    projected = {
+        key: value for key, value in scene_data.items()
+        if key != 'tokens' and key not in MASTER_ONLY_FIELDS
+    }
+    projected['tokens'] = [token for token in scene_data.get('tokens', []) if is_visible(token)]
+    return projected
+
+
+def player_ops(scene_data, ops):
+    """
+    Operações como os jogadores devem recebê-las (chamar antes de aplicar).
+
+    Operações sobre tokens ocultos somem; um token que passa a ser visível
+    vira add_token (com o token completo) e um que passa a ser oculto vira
+    remove_token. Retorna a própria lista ops quando nada muda.
+    """
+    # Estado dos tokens tocados pelo patch, atualizado operação a operação
+    touched = {}
+
+    def current(token_id):
+        if token_id not in touched:
+            token = find_token(scene_data, token_id)
+            touched[token_id] = dict(token) if token is not None else None
+        return touched[token_id]
+
+    projected = []
+    changed = False
+    for op in ops:
+        kind = op['op']
+        if kind == 'set':
+            changes = {key: value for key, value in op['changes'].items() if key not in MASTER_ONLY_FIELDS}
+            if len(changes) == len(op['changes']):
+                projected.append(op)
+            else:
+                changed = True
+                if changes:
+                    projected.append({'op': 'set', 'changes': changes})
+            continue
+
+        token_id = op['token']['id'] if kind == 'add_token' else op['id']
+        before = current(token_id)
+        was_visible = before is not None and is_visible(before)
+        if kind == 'remove_token':
+            after = None
+        elif kind == 'add_token':
+            after = {**before, **op['token']} if before is not None else dict(op['token'])
+        else:
+            after = {**before, **op['changes']} if before is not None else None
+        touched[token_id] = after
+        now_visible = after is not None and is_visible(after)
+
+        if was_visible and now_visible:
+            projected.append(op)
+        elif now_visible:
+            projected.append({'op': 'add_token', 'token': after})
+            changed = changed or kind != 'add_token' or before is not None
+        elif was_visible:
+            projected.append({'op': 'remove_token', 'id': token_id})
+            changed = changed or kind != 'remove_token'
+        else:
+            changed = True
+    return projected if changed else ops
@@ -0,0 +1,52 @@
+"""
+Avisos enviados aos sockets abertos quando uma sala muda.
+
+O consumer guarda o papel e o membro resolvidos na conexão; quando a sala é
+deletada, desativada ou troca de mestre, um room_invalidated é enviado para o
+grupo da sala e cada conexão revalida o seu acesso.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .models import Room
+
+
+def invalidate_room(room_code):
+    """Pede para as conexões da sala revalidarem o acesso"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    def send():
+        async_to_sync(channel_layer.group_send)(
+            f'game_room_{room_code}',
+            {'type': 'room_invalidated'}
+        )
+
+    transaction.on_commit(send)
+
+
+@receiver(pre_save, sender=Room)
+def remember_room_access(sender, instance, **kwargs):
+    # Guarda os valores anteriores para saber se o acesso mudou
+    previous = None
+    if instance.pk:
+        previous = Room.objects.filter(pk=instance.pk).values('master_id', 'is_active').first()
+    instance._previous_access = previous
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_previous_access', None)
+    if created or previous is None:
+        return
+    if previous['master_id'] != instance.master_id or previous['is_active'] != instance.is_active:
+        invalidate_room(instance.code)
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    invalidate_room(instance.code)
@@ -0,0 +1,159 @@
+"""
+Índice espacial dos tokens da cena e viewports das conexões.
+
+A grid é infinita e uma cena de campanha pode ter milhares de tokens. O
+índice divide a grid em células quadradas de SPATIAL_CELL_SIZE casas e guarda,
+para cada célula ocupada, os ids dos tokens posicionados nela (pela casa
+gridX/gridY do canto do token). Consultar uma área visita só as células que
+ela cobre, e mover um token só troca o id de célula.
+
+Uma conexão que assina um viewport (ação subscribe_viewport) recebe apenas os
+tokens da área visível mais VIEWPORT_MARGIN casas em cada lado; veja
+GameRoomConsumer.flush_outbox.
+"""
+import math
+from collections import namedtuple
+
+from django.conf import settings
+
+
+def cell_size():
+    return getattr(settings, 'SPATIAL_CELL_SIZE', 16)
+
+
+def viewport_margin():
+    return getattr(settings, 'VIEWPORT_MARGIN', 8)
+
+
+def token_position(token):
+    """Casa do canto do token (tokens sem posição ficam na origem)"""
+    try:
+        return int(token.get('gridX') or 0), int(token.get('gridY') or 0)
+    except (TypeError, ValueError):
+        return 0, 0
+
+
+def token_size(token):
+    try:
+        return max(int(token.get('size') or 1), 1)
+    except (TypeError, ValueError):
+        return 1
+
+
+class Viewport(namedtuple('Viewport', 'min_x min_y max_x max_y')):
+    """Retângulo de casas da grid (limites inclusivos), já com a margem"""
+
+    @classmethod
+    def parse(cls, x, y, width, height, margin=None):
+        """Viewport a partir de x, y, largura e altura em casas; ValueError se inválido"""
+        if margin is None:
+            margin = viewport_margin()
+        values = []
+        for value in (x, y, width, height):
+            # int() de inf levanta OverflowError, e de nan ValueError: ambos ficam de fora aqui
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+                raise ValueError('Viewport inválido')
+            values.append(int(value))
+        x, y, width, height = values
+        if width <= 0 or height <= 0:
+            raise ValueError('Viewport vazio')
+        return cls(x - margin, y - margin, x + width - 1 + margin, y + height - 1 + margin)
+
+    @classmethod
+    def from_query(cls, value):
+        """Viewport do parâmetro ?viewport=x,y,largura,altura (None se ausente ou inválido)"""
+        try:
+            return cls.parse(*(float(part) for part in value.split(',')))
+        except (TypeError, ValueError):
+            return None
+
+    def expand(self, amount):
+        return Viewport(self.min_x - amount, self.min_y - amount, self.max_x + amount, self.max_y + amount)
+
+    def contains(self, token):
+        """O token (com o seu tamanho) tem alguma casa dentro do viewport"""
+        x, y = token_position(token)
+        size = token_size(token)
+        return (
+            x + size - 1 >= self.min_x and x <= self.max_x
+            and y + size - 1 >= self.min_y and y <= self.max_y
+        )
+
+
+class SpatialIndex:
+    """Hash de células uniformes: célula (cx, cy) -> ids dos tokens nela"""
+
+    def __init__(self, tokens=()):
+        self.size = cell_size()
+        self.tokens = {}
+        self.cells = {}
+        self.cell_of = {}
+        # Maior token já indexado: uma consulta olha também as células à esquerda
+        # e acima da área, de onde um token grande pode alcançá-la
+        self.reach = 1
+        for token in tokens:
+            self.update(token)
+
+    def _cell(self, token):
+        x, y = token_position(token)
+        return x // self.size, y // self.size
+
+    def get(self, token_id):
+        return self.tokens.get(token_id)
+
+    def update(self, token):
+        """Indexa um token novo ou reposiciona um já indexado"""
+        token_id = token.get('id')
+        self.tokens[token_id] = token
+        self.reach = max(self.reach, token_size(token))
+        cell = self._cell(token)
+        previous = self.cell_of.get(token_id)
+        if previous == cell:
+            return
+        if previous is not None:
+            self._discard(previous, token_id)
+        self.cell_of[token_id] = cell
+        self.cells.setdefault(cell, set()).add(token_id)
+
+    def remove(self, token_id):
+        self.tokens.pop(token_id, None)
+        cell = self.cell_of.pop(token_id, None)
+        if cell is not None:
+            self._discard(cell, token_id)
+
+    def _discard(self, cell, token_id):
+        ids = self.cells[cell]
+        ids.discard(token_id)
+        if not ids:
+            del self.cells[cell]
+
+    def query(self, viewport):
+        """Tokens com alguma casa dentro do viewport"""
+        size = self.size
+        min_cx = (viewport.min_x - self.reach + 1) // size
+        min_cy = (viewport.min_y - self.reach + 1) // size
+        max_cx = viewport.max_x // size
+        max_cy = viewport.max_y // size
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) > len(self.cells):
+            # Área maior que a parte ocupada da grid: percorre só as células ocupadas
+            cells = [
+                ids for (cx, cy), ids in self.cells.items()
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy
+            ]
+        else:
+            cells = [
+                self.cells[cell]
+                for cell in (
+                    (cx, cy)
+                    for cx in range(min_cx, max_cx + 1)
+                    for cy in range(min_cy, max_cy + 1)
+                )
+                if cell in self.cells
+            ]
+        found = []
+        for ids in cells:
+            for token_id in ids:
+                token = self.tokens[token_id]
+                if viewport.contains(token):
+                    found.append(token)
+        return found
@@ -1,3 +1,1688 @@
-from django.test import TestCase
+"""
+Testes de regressão de desempenho.
 
-# Create your tests here.
+Fixam o número de consultas ao banco e o tamanho (bytes) das mensagens de cada
+ação do GameRoomConsumer e de cada view da API de cenas. As cenas são criadas
+com quantidades diferentes de tokens: as consultas não podem crescer com o
+número de tokens, e os bytes só podem crescer dentro do orçamento por token.
+
+Se uma mudança estourar um orçamento de propósito, atualize o valor aqui no
+mesmo commit e explique o motivo.
+
+WireFormatTests cobre os frames binários (subprotocolo MessagePack),
+MetricsTests a exposição das métricas, TracingTests o log de mensagens lentas
+e o perfil por sala, ClusterTests o modo com vários workers, com o registro em
+memória no lugar do Redis, OutboxTests a fila de saída das conexões lentas,
+PresenceTests a expiração das conexões sem heartbeat, RoomSignalTests os
+avisos às conexões quando a sala muda, ResumeTests a retomada após reconexão
+(epoch e last_seq), ProjectionTests a cena que os jogadores recebem (sem
+tokens ocultos), ViewportTests o índice espacial e as assinaturas de viewport,
+AssetTests o armazenamento de imagens por conteúdo, UploadTests o upload em
+blocos com jobs, TileTests a pirâmide de tiles dos fundos, VariantTests as
+variantes reduzidas da arte dos tokens, SceneListTests a lista resumida de
+cenas, SceneRevisionTests a revisão da cena como ETag (If-Match e
+If-None-Match), SceneHistoryTests o log de operações (snapshot, compactação e
+desfazer), MigrationTests a migração dos tokens para a tabela Token e
+LoadTestCommandTests o comando loadtest.
+"""
+import asyncio
+import copy
+import importlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import ApplicationCommunicator, WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError, connections
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import assets, checks, cluster, frames, metrics, room_state, tiles, tracing, uploads, variants, views
+from .frames import FIELD_CODES, MESSAGE_CODES, decode_message, encode_frame
+from .models import Asset, Room, RoomMember, Scene, SceneOp, Token
+from .outbox import SKIPPED, Outbox
+from .scene_ops import apply_ops, diff_scene, inverse_ops, player_ops, validate_ops, validate_scene
+from .spatial import SpatialIndex, Viewport
+from .routing import websocket_urlpatterns
+
+TOKEN_COUNTS = (1, 10, 100)
+
+# Consultas por ação (não dependem do número de tokens; as que gravam a cena
+# inteira ganham uma consulta a mais com 100 tokens porque o SQLite divide o
+# bulk_create em lotes). update_scene_api compara a revisão dentro de uma
+# transação, que nos testes aparece como SAVEPOINT/RELEASE. A última
+# desconexão grava as entradas do log (um INSERT) junto com o snapshot
+QUERY_BUDGETS = {
+    'connect_cold': 6,
+    'connect_warm': 3,
+    'move_token': 0,
+    'patch_scene': 0,
+    'update_scene': 1,
+    'get_state': 0,
+    'disconnect': 0,
+    'disconnect_last': 7,
+    'list_scenes': 5,
+    'get_scene': 5,
+    'create_scene': 11,
+    'update_scene_api': 11,
+    'switch_scene': 8,
+}
+
+# Bytes por mensagem: (fixo, por token)
+BYTE_BUDGETS = {
+    'room_state': (500, 200),
+    'tokens_moved': (140, 0),
+    'scene_patch': (140, 0),
+    'scene_update': (300, 200),
+    # A lista leva só o resumo das cenas: não cresce com os tokens
+    'list_scenes': (900, 0),
+    'get_scene': (400, 200),
+    'create_scene': (400, 200),
+    'update_scene_api': (400, 200),
+    'switch_scene': (300, 200),
+}
+
+SCENE_COUNT = 3
+
+
+def build_scene(token_count):
+    return {
+        'tokens': [
+            {
+                'id': i,
+                'name': f'Token {i}',
+                'imageSrc': f'https://res.cloudinary.com/demo/image/upload/rpg_grid/token_{i}.png',
+                'size': 1,
+                'gridX': i % 40,
+                'gridY': i // 40,
+                'visible': True,
+                'controlledBy': 'jogador' if i == 0 else None,
+            }
+            for i in range(token_count)
+        ],
+        'gridSize': 50,
+        'gridColor': '#333333',
+        'bgColor': '#1a1a1a',
+    }
+
+
+def upload_client(room_code='UPLOAD'):
+    """Client logado como mestre de uma sala nova: só o mestre envia imagens"""
+    master = User.objects.create_user(f'mestre-{room_code.lower()}', password='senha')
+    Room.objects.create(name='Sala', master=master, code=room_code)
+    client = Client()
+    client.force_login(master)
+    return client
+
+
+class QueryCapture:
+    """
+    Como CaptureQueriesContext, mas sem abrir a conexão ao entrar, então pode
+    ser usado dentro do event loop (as consultas em si rodam na thread do teste).
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.captured_queries = []
+
+    def __enter__(self):
+        self.force_debug_cursor = self.connection.force_debug_cursor
+        self.connection.force_debug_cursor = True
+        self.start = len(self.connection.queries_log)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.connection.force_debug_cursor = self.force_debug_cursor
+        self.captured_queries = list(self.connection.queries_log)[self.start:]
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+
+class BudgetMixin:
+    def assertQueriesWithin(self, name, captured, token_count):
+        count = len(captured)
+        budget = QUERY_BUDGETS[name]
+        self.assertLessEqual(
+            count, budget,
+            f'{name} com {token_count} tokens fez {count} consultas (orçamento: {budget}):\n'
+            + '\n'.join(query['sql'] for query in captured.captured_queries)
+        )
+
+    def assertBytesWithin(self, name, size, token_count):
+        base, per_token = BYTE_BUDGETS[name]
+        budget = base + per_token * token_count
+        self.assertLessEqual(
+            size, budget,
+            f'{name} com {token_count} tokens tem {size} bytes (orçamento: {budget})'
+        )
+
+    def create_room(self, token_count):
+        master = User.objects.create_user(f'mestre{token_count}', password='senha')
+        room = Room.objects.create(name='Sala', master=master, code=f'PERF{token_count}')
+        RoomMember.objects.create(room=room, user=master, player_name=master.username, role='master')
+        self.addCleanup(room_state._cold_rooms.pop, room.code, None)
+        for index in range(SCENE_COUNT):
+            scene = Scene(room=room, name=f'Cena {index}', is_active=index == 0, order=index)
+            scene.set_scene_data(build_scene(token_count))
+        return master, room
+
+    def communicator(self, room, user=None, player_name=None, query='', subprotocols=None):
+        """WebSocket da sala: o mestre (user) ou um jogador anônimo (player_name)"""
+        communicator = WebsocketCommunicator(
+            URLRouter(websocket_urlpatterns), f'/ws/room/{room.code}/{query}', subprotocols=subprotocols
+        )
+        communicator.scope['user'] = user or AnonymousUser()
+        communicator.scope['session'] = {'player_name': player_name} if player_name else {}
+        return communicator
+
+    async def next_message(self, communicator, *message_types):
+        """Recebe frames (texto ou binários) até chegar um dos tipos pedidos"""
+        while True:
+            frame = await communicator.receive_from()
+            message = decode_message(bytes_data=frame) if isinstance(frame, bytes) else json.loads(frame)
+            if message['type'] in message_types:
+                return message
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class ConsumerBudgetTests(BudgetMixin, TestCase):
+    """Consultas e bytes de cada ação do WebSocket da sala"""
+
+    def setUp(self):
+        # Conexão da thread principal: as consultas do consumer rodam nela
+        # (database_sync_to_async sob async_to_sync usa a thread do teste)
+        self.db = connections['default']
+
+    async def receive(self, communicator, message_type):
+        """Recebe frames até chegar o tipo pedido; retorna (mensagem, bytes)"""
+        while True:
+            frame = await communicator.receive_from()
+            message = json.loads(frame)
+            if message['type'] == message_type:
+                return message, len(frame.encode())
+
+    async def measure(self, action, *receivers_and_types):
+        """Executa a ação e retorna (consultas, bytes da mensagem recebida)"""
+        with QueryCapture(self.db) as captured:
+            await action()
+            size = 0
+            for communicator, message_type in receivers_and_types:
+                _, size = await self.receive(communicator, message_type)
+        return captured, size
+
+    async def scenario(self, room, master, token_count):
+        results = {}
+        master_socket = self.communicator(room, user=master)
+        player = self.communicator(room, player_name='jogador')
+
+        async def connect_master():
+            connected, _ = await master_socket.connect()
+            self.assertTrue(connected)
+
+        async def connect_player():
+            connected, _ = await player.connect()
+            self.assertTrue(connected)
+
+        results['connect_cold'] = await self.measure(connect_master, (master_socket, 'room_state'))
+        results['connect_warm'] = await self.measure(connect_player, (player, 'room_state'))
+        await self.receive(master_socket, 'member_joined')
+        await self.receive(player, 'member_joined')
+
+        results['move_token'] = await self.measure(
+            lambda: player.send_json_to({'action': 'move_token', 'token_id': 0, 'gridX': 7, 'gridY': 3}),
+            (master_socket, 'tokens_moved'),
+        )
+        await self.receive(player, 'tokens_moved')
+
+        results['patch_scene'] = await self.measure(
+            lambda: master_socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 0, 'changes': {'visible': False}}],
+            }),
+            (player, 'scene_patch'),
+        )
+        await self.receive(master_socket, 'scene_patch')
+
+        results['update_scene'] = await self.measure(
+            lambda: master_socket.send_json_to({
+                'action': 'update_scene',
+                'scene_data': build_scene(token_count),
+            }),
+            (player, 'scene_update'),
+        )
+        await self.receive(master_socket, 'scene_update')
+
+        results['get_state'] = await self.measure(
+            lambda: player.send_json_to({'action': 'get_state'}),
+            (player, 'room_state'),
+        )
+
+        results['disconnect'] = await self.measure(player.disconnect, (master_socket, 'member_left'))
+        with QueryCapture(self.db) as captured:
+            await master_socket.disconnect()
+        results['disconnect_last'] = (captured, 0)
+        return results
+
+    def test_consumer_actions_within_budget(self):
+        for token_count in TOKEN_COUNTS:
+            with self.subTest(tokens=token_count):
+                master, room = self.create_room(token_count)
+                results = async_to_sync(self.scenario)(room, master, token_count)
+                self.assertNotIn(room.code, room_state._rooms)
+
+                for name, (captured, size) in results.items():
+                    self.assertQueriesWithin(name, captured, token_count)
+
+                self.assertBytesWithin('room_state', results['get_state'][1], token_count)
+                self.assertBytesWithin('room_state', results['connect_warm'][1], token_count)
+                self.assertBytesWithin('tokens_moved', results['move_token'][1], token_count)
+                self.assertBytesWithin('scene_patch', results['patch_scene'][1], token_count)
+                self.assertBytesWithin('scene_update', results['update_scene'][1], token_count)
+
+    @override_settings(ROOM_BROADCAST_TICK_HZ=5)
+    def test_moves_in_one_tick_share_one_frame(self):
+        async def scenario(room, master):
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            state, _ = await self.receive(master_socket, 'room_state')
+            await player.connect()
+            await self.receive(master_socket, 'member_joined')
+            # Dois tokens do jogador, dois movimentos cada, dentro do mesmo tick (200 ms)
+            for token_id, grid_x, grid_y in ((0, 1, 0), (1, 3, 3), (0, 2, 0), (1, 4, 4)):
+                await player.send_json_to(
+                    {'action': 'move_token', 'token_id': token_id, 'gridX': grid_x, 'gridY': grid_y}
+                )
+            moved, _ = await self.receive(master_socket, 'tokens_moved')
+            # Nenhum frame a mais depois do tick
+            quiet = await master_socket.receive_nothing(timeout=0.4)
+            await player.disconnect()
+            await master_socket.disconnect()
+            return state['data']['revision'], moved, quiet
+
+        master, room = self.create_room(10)
+        Token.objects.filter(scene__room=room, token_id=1).update(controlled_by='jogador')
+        revision, moved, quiet = async_to_sync(scenario)(room, master)
+        self.assertEqual(
+            sorted((move['token_id'], move['gridX'], move['gridY']) for move in moved['moves']),
+            [(0, 2, 0), (1, 4, 4)],
+        )
+        self.assertEqual((moved['revision'], quiet), (revision + 1, True))
+
+    def test_write_behind_flush_is_constant(self):
+        """Vários movimentos do mesmo token viram uma única escrita na desconexão"""
+        async def scenario(room):
+            player = self.communicator(room, player_name='jogador')
+            await player.connect()
+            await self.receive(player, 'room_state')
+            for step in range(20):
+                await player.send_json_to({'action': 'move_token', 'token_id': 0, 'gridX': step, 'gridY': 0})
+                await self.receive(player, 'tokens_moved')
+            with QueryCapture(self.db) as captured:
+                await player.disconnect()
+            return captured
+
+        master, room = self.create_room(10)
+        captured = async_to_sync(scenario)(room)
+        self.assertQueriesWithin('disconnect_last', captured, 10)
+        token = Scene.objects.get(room=room, is_active=True).tokens.get(token_id=0)
+        self.assertEqual((token.grid_x, token.grid_y), (19, 0))
+
+
+class SceneApiBudgetTests(BudgetMixin, TestCase):
+    """Consultas e bytes de cada view da API de cenas"""
+
+    def request(self, name, token_count, method, url, data=None):
+        with CaptureQueriesContext(connections['default']) as captured:
+            response = getattr(self.client, method)(
+                url, json.dumps(data) if data is not None else None, content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200, response.content[:200])
+        self.assertQueriesWithin(name, captured, token_count)
+        return response
+
+    def test_scene_api_within_budget(self):
+        for token_count in TOKEN_COUNTS:
+            with self.subTest(tokens=token_count):
+                master, room = self.create_room(token_count)
+                self.client.force_login(master)
+                api = f'/api/room/{room.code}/scenes'
+
+                response = self.request('list_scenes', token_count, 'get', f'{api}/')
+                self.assertEqual(len(response.json()['scenes']), SCENE_COUNT)
+                self.assertBytesWithin('list_scenes', len(response.content), token_count * SCENE_COUNT)
+                scene_id = response.json()['scenes'][0]['id']
+
+                response = self.request('get_scene', token_count, 'get', f'{api}/{scene_id}/')
+                self.assertEqual(len(response.json()['scene_data']['tokens']), token_count)
+                self.assertBytesWithin('get_scene', len(response.content), token_count)
+
+                response = self.request('create_scene', token_count, 'post', f'{api}/create/', {
+                    'name': 'Nova cena', 'scene_data': build_scene(token_count)
+                })
+                self.assertBytesWithin('create_scene', len(response.content), token_count)
+                scene_id = response.json()['id']
+
+                response = self.request('update_scene_api', token_count, 'put', f'{api}/{scene_id}/', {
+                    'scene_data': build_scene(token_count)
+                })
+                self.assertBytesWithin('update_scene_api', len(response.content), token_count)
+
+                response = self.request('switch_scene', token_count, 'post', f'{api}/{scene_id}/switch/')
+                self.assertBytesWithin('switch_scene', len(response.content), token_count)
+
+
+@skipUnless(frames.msgpack is not None, 'msgpack não instalado')
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class WireFormatTests(BudgetMixin, TestCase):
+    """Frames binários (MessagePack) para quem pede o subprotocolo"""
+
+    def test_msgpack_subprotocol_round_trip(self):
+        master, room = self.create_room(2)
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador', subprotocols=['tabletop.msgpack.v1'])
+            await master_socket.connect()
+            _, subprotocol = await player.connect()
+            await self.next_message(player, 'room_state')
+
+            # Mensagem que não é um objeto é ignorada; a conexão continua
+            await player.send_to(text_data='[]')
+            await player.send_to(bytes_data=frames.msgpack.packb('x'))
+            # O cliente binário manda as ações também com os códigos curtos
+            await player.send_to(bytes_data=frames.msgpack.packb({
+                FIELD_CODES['action']: 'move_token', FIELD_CODES['token_id']: 0,
+                FIELD_CODES['gridX']: 7, FIELD_CODES['gridY']: 3,
+            }))
+            frame = await player.receive_from()
+            while decode_message(bytes_data=frame)['type'] != 'tokens_moved':
+                frame = await player.receive_from()
+            moved = await self.next_message(master_socket, 'tokens_moved')
+            await player.disconnect()
+            await master_socket.disconnect()
+            return subprotocol, frame, moved
+
+        subprotocol, frame, moved = async_to_sync(scenario)()
+        self.assertEqual(subprotocol, 'tabletop.msgpack.v1')
+        raw = frames.msgpack.unpackb(frame, strict_map_key=False)
+        self.assertEqual(raw[FIELD_CODES['type']], MESSAGE_CODES['tokens_moved'])
+        self.assertEqual(raw[FIELD_CODES['moves']][0][FIELD_CODES['gridX']], 7)
+        # Mesmo conteúdo do frame JSON do mestre, em menos bytes
+        self.assertEqual(decode_message(bytes_data=frame), moved)
+        self.assertLess(len(frame), len(json.dumps(moved)))
+        # Mensagens que não são objetos são recusadas como malformadas
+        for text_data, bytes_data in (('[]', None), ('1', None), ('"x"', None), (None, frames.msgpack.packb(7))):
+            with self.assertRaises(ValueError):
+                decode_message(text_data, bytes_data)
+        payload = {'moves': moved['moves'], 'revision': moved['revision'], 'seq': moved['seq']}
+        self.assertEqual(
+            decode_message(bytes_data=encode_frame('tokens_moved', payload, frames.MSGPACK)),
+            {'type': 'tokens_moved', **payload}
+        )
+
+
+@override_settings(METRICS_ENABLED=True)
+class MetricsTests(SimpleTestCase):
+    """Exposição das métricas no formato texto do Prometheus"""
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_text_exposition(self):
+        metrics.MESSAGES_RECEIVED.inc(action='move_token')
+        metrics.MESSAGES_RECEIVED.inc(2, action='a"b')
+        metrics.RECEIVE_SECONDS.observe(0.003, action='move_token')
+        with override_settings(METRICS_ENABLED=False):
+            metrics.MESSAGES_RECEIVED.inc(action='move_token')
+        lines = metrics.render().splitlines()
+        for line in (
+            '# TYPE tabletop_ws_messages_received_total counter',
+            'tabletop_ws_messages_received_total{action="move_token"} 1',
+            'tabletop_ws_messages_received_total{action="a\\"b"} 2',
+            '# TYPE tabletop_ws_receive_seconds histogram',
+            'tabletop_ws_receive_seconds_bucket{action="move_token",le="0.0025"} 0',
+            'tabletop_ws_receive_seconds_bucket{action="move_token",le="0.005"} 1',
+            'tabletop_ws_receive_seconds_bucket{action="move_token",le="+Inf"} 1',
+            'tabletop_ws_receive_seconds_sum{action="move_token"} 0.003',
+            'tabletop_ws_receive_seconds_count{action="move_token"} 1',
+            '# TYPE tabletop_channel_layer_queue_depth gauge',
+            'tabletop_channel_layer_queue_depth{stat="max"} 0',
+        ):
+            self.assertIn(line, lines)
+
+    @override_settings(METRICS_TOKEN='segredo')
+    def test_endpoint(self):
+        room_state._rooms['SEGREDO'] = room_state.RoomState('SEGREDO')
+        self.addCleanup(room_state._rooms.pop, 'SEGREDO')
+        response = Client().get('/metrics/', HTTP_AUTHORIZATION='Bearer segredo')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(b'tabletop_room_connections{stat="rooms"} 1', response.content)
+        # O código da sala é o segredo de entrada: nunca aparece nas métricas
+        self.assertNotIn(b'SEGREDO', response.content)
+        # Atrás de um proxy local tudo chega de 127.0.0.1: só o token vale
+        self.assertEqual(Client().get('/metrics/').status_code, 403)
+        self.assertEqual(Client().get('/metrics/', HTTP_AUTHORIZATION='Bearer outro').status_code, 403)
+        with override_settings(METRICS_TOKEN=None):
+            self.assertEqual(Client().get('/metrics/', HTTP_AUTHORIZATION='Bearer None').status_code, 403)
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEqual(Client().get('/metrics/', HTTP_AUTHORIZATION='Bearer segredo').status_code, 404)
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class TracingTests(BudgetMixin, TestCase):
+    """Log de mensagens lentas e perfil (cProfile) sob demanda de uma sala"""
+
+    def test_slow_message_logged_over_threshold(self):
+        def receive(pause):
+            with tracing.trace('SALA', 'receive') as trace:
+                with tracing.span('decode'):
+                    time.sleep(pause)
+                trace.set_action('move_token')
+
+        with override_settings(TRACING_SLOW_MS=1):
+            with self.assertLogs('grid.tracing', 'WARNING') as logs:
+                receive(0.005)
+            with self.assertNoLogs('grid.tracing', 'WARNING'):
+                with override_settings(TRACING_SLOW_MS=1000):
+                    receive(0)
+        entry = json.loads(logs.records[0].getMessage())
+        self.assertEqual((entry['event'], entry['room'], entry['action']), ('slow_message', 'SALA', 'move_token'))
+        self.assertEqual([span['name'] for span in entry['spans']], ['decode'])
+        self.assertGreaterEqual(entry['duration_ms'], 5)
+
+    def test_spans_are_noops_when_disabled(self):
+        self.assertIs(tracing.trace('SALA', 'receive'), tracing.NULL_TRACE)
+        self.assertIs(tracing.span('decode'), tracing.NULL_SPAN)
+        with self.assertNoLogs('grid.tracing'):
+            with tracing.trace('SALA', 'receive'):
+                with tracing.span('decode'):
+                    pass
+
+    def test_profile_endpoint_is_master_only(self):
+        master, room = self.create_room(2)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        url = f'/api/room/{room.code}/profile/'
+        other = User.objects.create_user('outro', password='senha', is_staff=True)
+        self.client.force_login(other)
+        self.assertEqual(self.client.post(url, '{}', content_type='application/json').status_code, 404)
+        self.client.force_login(master)
+
+        async def scenario():
+            socket = self.communicator(room, user=master)
+            await socket.connect()
+            await self.next_message(socket, 'room_state')
+            started = await sync_to_async(self.client.post)(url, '{"seconds": 60}', content_type='application/json')
+            # A conexão recebe o profile_room antes das próximas mensagens
+            await socket.send_json_to({'action': 'get_state'})
+            await self.next_message(socket, 'room_state')
+            await socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 0, 'changes': {'gridX': 3}}],
+            })
+            await self.next_message(socket, 'scene_patch')
+            path = tracing.stop_profile(room.code)
+            await socket.disconnect()
+            return started, path
+
+        with override_settings(TRACING_PROFILE_DIR=root):
+            self.assertEqual(self.client.get(url).status_code, 404)
+            started, path = async_to_sync(scenario)()
+            report = self.client.get(url)
+        self.assertEqual((started.status_code, started.json()['seconds']), (200, 60))
+        self.assertTrue(path.startswith(root))
+        self.assertEqual(report['Content-Type'], 'text/plain; charset=utf-8')
+        self.assertIn('function calls', report.content.decode())
+        self.assertIn('Ordered by: cumulative time', report.content.decode())
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, CLUSTER_ENABLED=True)
+class ClusterTests(TestCase):
+    """Salas distribuídas entre workers por hash consistente"""
+
+    def setUp(self):
+        self.app = URLRouter(websocket_urlpatterns)
+        self.registry = cluster.MemoryRegistry()
+        # Este processo é o worker w1 (sem o loop de heartbeat: os testes chamam refresh)
+        self.worker = cluster.Cluster('w1', 'ws://w1', self.registry)
+        self.join('w1')
+        cluster._cluster = self.worker
+
+    def tearDown(self):
+        cluster._cluster = None
+
+    def join(self, worker_id, ttl=60):
+        async_to_sync(self.registry.heartbeat)(worker_id, f'ws://{worker_id}', ttl)
+        async_to_sync(self.worker.refresh)()
+
+    def create_room(self, owner):
+        """Sala cujo código cai no worker pedido quando w1 e w2 estão vivos"""
+        ring = cluster.HashRing(['w1', 'w2'])
+        code = next(f'SALA{i}' for i in range(1000) if ring.owner(f'SALA{i}') == owner)
+        master = User.objects.create_user(f'mestre{code}', password='senha')
+        room = Room.objects.create(name='Sala', master=master, code=code)
+        scene = Scene(room=room, name='Cena', is_active=True)
+        scene.set_scene_data(build_scene(1))
+        return master, room
+
+    def communicator(self, room, user):
+        communicator = WebsocketCommunicator(self.app, f'/ws/room/{room.code}/')
+        communicator.scope['user'] = user
+        communicator.scope['session'] = {}
+        return communicator
+
+    async def receive(self, communicator, message_type):
+        while True:
+            message = json.loads(await communicator.receive_from())
+            if message['type'] == message_type:
+                return message
+
+    def test_new_worker_takes_only_its_share(self):
+        keys = [f'SALA{i}' for i in range(1000)]
+        before = cluster.HashRing(['w1', 'w2', 'w3'])
+        after = cluster.HashRing(['w1', 'w2', 'w3', 'w4'])
+        moved = [key for key in keys if before.owner(key) != after.owner(key)]
+        self.assertTrue(all(after.owner(key) == 'w4' for key in moved))
+        self.assertLess(len(moved), 400)
+
+    def test_socket_redirected_to_owner(self):
+        self.join('w2')
+        master, room = self.create_room('w2')
+
+        async def scenario():
+            socket = self.communicator(room, master)
+            connected, _ = await socket.connect()
+            self.assertTrue(connected)
+            return await socket.receive_output()
+
+        message = async_to_sync(scenario)()
+        self.assertEqual(message, {'type': 'websocket.close', 'code': cluster.ROOM_MOVED, 'reason': 'ws://w2'})
+        self.assertNotIn(room.code, room_state._rooms)
+
+    def test_scene_api_answered_by_owner_only(self):
+        self.join('w2')
+        master, room = self.create_room('w2')
+        scene = Scene.objects.get(room=room)
+        self.client.force_login(master)
+        url = f'/api/room/{room.code}/scenes/{scene.id}/'
+
+        read = self.client.get(url)
+        write = self.client.put(url, json.dumps({'scene_data': build_scene(3)}), content_type='application/json')
+        for response in (read, write):
+            self.assertEqual((response.status_code, response.json()['owner_url']), (421, 'ws://w2'))
+        # O worker errado não grava nada: a cena pode estar na memória do dono
+        self.assertEqual((Scene.objects.get(pk=scene.pk).revision, scene.tokens.count()), (0, 1))
+
+        # Nem serve o snapshot do banco: a API manda para o dono e a página vai sem o embutido
+        snapshot = self.client.get(f'/api/room/{room.code}/snapshot/')
+        self.assertEqual((snapshot.status_code, snapshot.json()['owner_url']), (421, 'ws://w2'))
+        self.assertIsNone(self.client.get(f'/room/{room.code}/').context['room_snapshot'])
+
+    def test_dead_worker_rooms_rehydrated(self):
+        self.join('w2', ttl=-1)
+        master, room = self.create_room('w2')
+        self.assertTrue(self.worker.is_local(room.code))
+
+        async def scenario():
+            socket = self.communicator(room, master)
+            await socket.connect()
+            message = await self.receive(socket, 'room_state')
+            await socket.disconnect()
+            return message
+
+        message = async_to_sync(scenario)()
+        self.assertEqual(message['data']['scene_data']['tokens'][0]['id'], 0)
+
+    def test_room_handed_off_when_owner_joins(self):
+        master, room = self.create_room('w2')
+
+        async def scenario():
+            socket = self.communicator(room, master)
+            await socket.connect()
+            await self.receive(socket, 'room_state')
+            await socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 0, 'changes': {'visible': False}}],
+            })
+            await self.receive(socket, 'scene_patch')
+
+            await self.registry.heartbeat('w2', 'ws://w2', 60)
+            await self.worker.refresh()
+            await self.worker.rebalance()
+            message = await socket.receive_output()
+            await socket.disconnect()
+            return message
+
+        message = async_to_sync(scenario)()
+        self.assertEqual(message['code'], cluster.ROOM_MOVED)
+        self.assertEqual(message['reason'], 'ws://w2')
+        self.assertNotIn(room.code, room_state._rooms)
+        token = Scene.objects.get(room=room).tokens.get(token_id=0)
+        self.assertFalse(token.visible)
+
+
+@override_settings(ROOM_OUTBOX_WINDOW=2, ROOM_OUTBOX_LIMIT=5)
+class OutboxTests(SimpleTestCase):
+    """Agrupamento e estouro da fila de saída"""
+
+    def queue(self, *entries):
+        outbox = Outbox()
+        for seq, (message_type, revision, tokens) in enumerate(entries, start=1):
+            outbox.push(message_type, seq, revision, tokens, {'json': f'{message_type}#{seq}'})
+        return [entry[:3] for entry in outbox.pending], outbox
+
+    def test_tokens_moved_keeps_latest_position(self):
+        pending, _ = self.queue(
+            ('tokens_moved', 1, [1]),
+            ('tokens_moved', 2, [1, 2]),
+            ('member_joined', None, None),
+            ('tokens_moved', 3, [2]),
+            ('tokens_moved', 4, [1, 2]),
+        )
+        self.assertEqual(pending, [
+            (SKIPPED, 2, 2), ('member_joined', 3, None), (SKIPPED, 4, 3), ('tokens_moved', 5, 4),
+        ])
+
+    def test_scene_update_replaces_scene_changes(self):
+        pending, _ = self.queue(
+            ('scene_patch', 1, None),
+            ('tokens_moved', 2, [1]),
+            ('member_left', None, None),
+            ('scene_update', 3, None),
+        )
+        self.assertEqual(pending, [(SKIPPED, 2, 2), ('member_left', 3, None), ('scene_update', 4, 3)])
+
+    def test_overflow_forces_resync(self):
+        pending, outbox = self.queue(*[('scene_patch', revision, None) for revision in range(6)])
+        self.assertEqual(pending, [])
+        self.assertTrue(outbox.resync)
+        outbox.reset(6)
+        outbox.push('scene_patch', 6, 6, None, {})
+        self.assertEqual(len(outbox.pending), 0)
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, ROOM_OUTBOX_WINDOW=2, ROOM_OUTBOX_LIMIT=5)
+class SlowClientTests(BudgetMixin, TestCase):
+    """Cliente que confirma os eventos devagar recebe o estado completo no lugar do backlog"""
+
+    def test_saturated_client_resyncs(self):
+        master, room = self.create_room(1)
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            await player.connect()
+            await player.receive_from()
+            joined = json.loads(await player.receive_from())
+            self.assertEqual(joined['type'], 'member_joined')
+            await player.send_json_to({'action': 'ack', 'seq': joined['seq']})
+
+            for step in range(10):
+                await master_socket.send_json_to({
+                    'action': 'patch_scene',
+                    'ops': [{'op': 'update_token', 'id': 0, 'changes': {'size': step + 2}}],
+                })
+            # Só a janela (2 frames) sai antes do próximo ack
+            received = [json.loads(await player.receive_from()) for _ in range(2)]
+            self.assertTrue(await player.receive_nothing(timeout=0.2))
+
+            await player.send_json_to({'action': 'ack', 'seq': received[-1]['seq']})
+            received.append(json.loads(await player.receive_from()))
+            await player.disconnect()
+            await master_socket.disconnect()
+            return received
+
+        received = async_to_sync(scenario)()
+        self.assertEqual([message['type'] for message in received], ['scene_patch', 'scene_patch', 'room_state'])
+        self.assertEqual(received[-1]['data']['scene_data']['tokens'][0]['size'], 11)
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, ROOM_PRESENCE_TIMEOUT=0.3)
+class PresenceTests(BudgetMixin, TestCase):
+    """Conexões sem heartbeat expiram na varredura de presença"""
+
+    def test_silent_member_expires(self):
+        async def scenario(room, master):
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            await player.connect()
+            await self.next_message(master_socket, 'member_joined')
+            # O mestre manda heartbeats; o jogador fica calado além do timeout
+            for _ in range(8):
+                await master_socket.send_json_to({'action': 'heartbeat'})
+                await asyncio.sleep(0.1)
+            left = await self.next_message(master_socket, 'member_left')
+            # O socket calado é fechado (depois dos frames que ele não leu)
+            closed = await player.receive_output(timeout=1)
+            while closed['type'] == 'websocket.send':
+                closed = await player.receive_output(timeout=1)
+            roster = room_state._rooms[room.code].roster()
+            await player.disconnect()
+            await master_socket.disconnect()
+            return left, closed, roster
+
+        master, room = self.create_room(1)
+        left, closed, roster = async_to_sync(scenario)(room, master)
+        self.assertEqual(left['member']['player_name'], 'jogador')
+        self.assertEqual(closed['type'], 'websocket.close')
+        online = {member['player_name']: member['is_online'] for member in roster}
+        self.assertEqual(online, {master.username: True, 'jogador': False})
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class RoomSignalTests(BudgetMixin, TestCase):
+    """Sala alterada ou deletada com sockets abertos: cada conexão revalida o acesso"""
+
+    async def connect(self, room, master):
+        master_socket = self.communicator(room, user=master)
+        player = self.communicator(room, player_name='jogador')
+        await master_socket.connect()
+        await player.connect()
+        await self.next_message(master_socket, 'member_joined')
+        await self.next_message(player, 'room_state')
+        return master_socket, player
+
+    async def closed(self, socket):
+        """True se o servidor fechou o socket (ignorando frames ainda não lidos)"""
+        # receive_nothing em vez de um timeout no receive_output, que cancela o consumer
+        while not await socket.receive_nothing(timeout=0.5):
+            message = await socket.receive_output()
+            if message['type'] == 'websocket.close':
+                return True
+        return False
+
+    def commit(self, change):
+        # O aviso sai no on_commit: roda a alteração e os callbacks, como no fim da transação
+        with self.captureOnCommitCallbacks(execute=True):
+            change()
+
+    def test_changed_room_revalidates_sockets(self):
+        master, room = self.create_room(1)
+        other = User.objects.create_user('outro', password='senha')
+
+        def rename():
+            room.name = 'Outro nome'
+            room.save()
+
+        def hand_over():
+            room.master = other
+            room.save()
+
+        async def scenario():
+            master_socket, player = await self.connect(room, master)
+            # Mudança que não afeta o acesso: nenhum aviso, ninguém sai
+            await sync_to_async(self.commit)(rename)
+            renamed = (await self.closed(master_socket), await self.closed(player))
+            # Outro mestre: o antigo perde o acesso, o jogador continua
+            await sync_to_async(self.commit)(hand_over)
+            handed = (await self.closed(master_socket), await self.closed(player))
+            await player.disconnect()
+            await master_socket.disconnect()
+            return renamed, handed
+
+        renamed, handed = async_to_sync(scenario)()
+        self.assertEqual(renamed, (False, False))
+        self.assertEqual(handed, (True, False))
+
+    def test_deactivated_or_deleted_room_closes_sockets(self):
+        for change in ('deactivate', 'delete'):
+            with self.subTest(change=change):
+                master, room = self.create_room(1 if change == 'deactivate' else 2)
+
+                def apply():
+                    if change == 'deactivate':
+                        room.is_active = False
+                        room.save()
+                    else:
+                        room.delete()
+
+                async def scenario():
+                    master_socket, player = await self.connect(room, master)
+                    await sync_to_async(self.commit)(apply)
+                    closed = await self.closed(master_socket), await self.closed(player)
+                    # O servidor ASGI avisa o consumer depois do close (websocket.disconnect)
+                    await player.disconnect()
+                    await master_socket.disconnect()
+                    return closed
+
+                self.assertEqual(async_to_sync(scenario)(), (True, True))
+                self.assertNotIn(room.code, room_state._rooms)
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, ROOM_REPLAY_BUFFER=4)
+class ResumeTests(BudgetMixin, TestCase):
+    """Cliente que reconecta com epoch e last_seq recebe só os eventos perdidos"""
+
+    async def drain(self, socket):
+        messages = []
+        while not await socket.receive_nothing(timeout=0.2):
+            messages.append(json.loads(await socket.receive_from()))
+        return messages
+
+    def resume(self, query, patches):
+        """Jogador sai, o mestre envia os patches e o jogador volta com a query (epoch/last_seq)"""
+        master, room = self.create_room(2)
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            await player.connect()
+            state = (await self.next_message(player, 'room_state'))['data']
+            # O cliente guarda o último seq recebido (o member_joined dele vem depois do estado)
+            state['seq'] = max([state['seq']] + [message['seq'] for message in await self.drain(player)])
+            await player.disconnect()
+            await self.next_message(master_socket, 'member_left')
+            for ops in patches:
+                await master_socket.send_json_to({'action': 'patch_scene', 'ops': ops})
+                await self.next_message(master_socket, 'scene_patch')
+
+            player = self.communicator(room, player_name='jogador', query=query(state))
+            await player.connect()
+            received = await self.drain(player)
+            await player.disconnect()
+            await master_socket.disconnect()
+            return state, received
+
+        return async_to_sync(scenario)()
+
+    def test_valid_seq_replays_missed_frames_as_player(self):
+        state, received = self.resume(lambda state: f"?epoch={state['epoch']}&last_seq={state['seq']}", [
+            [{'op': 'update_token', 'id': 1, 'changes': {'visible': False, 'name': 'Segredo'}}],
+            [{'op': 'update_token', 'id': 0, 'changes': {'gridX': 3}}],
+        ])
+        self.assertEqual([message['type'] for message in received], [
+            'member_left', 'scene_patch', 'scene_patch', 'member_joined',
+        ])
+        self.assertEqual([message['seq'] for message in received], list(range(state['seq'] + 1, state['seq'] + 5)))
+        # Os frames perdidos saem na projeção dos jogadores: o token oculto some
+        self.assertEqual(received[1]['ops'], [{'op': 'remove_token', 'id': 1}])
+        self.assertNotIn('Segredo', json.dumps(received))
+
+    def assertFullState(self, received):
+        self.assertEqual(received[0]['type'], 'room_state')
+        self.assertEqual(received[0]['data']['scene_data']['tokens'][0]['gridX'], 4)
+
+    def test_unknown_epoch_gets_full_state(self):
+        patches = [[{'op': 'update_token', 'id': 0, 'changes': {'gridX': 4}}]]
+        _, received = self.resume(lambda state: f"?epoch=outra&last_seq={state['seq']}", patches)
+        self.assertFullState(received)
+
+    def test_seq_out_of_buffer_gets_full_state(self):
+        # O buffer (4 eventos) já descartou o começo do intervalo
+        patches = [[{'op': 'update_token', 'id': 0, 'changes': {'gridX': step}}] for step in range(5)]
+        _, received = self.resume(lambda state: f"?epoch={state['epoch']}&last_seq={state['seq']}", patches)
+        self.assertFullState(received)
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class ProjectionTests(BudgetMixin, TestCase):
+    """Tokens ocultos e campos do mestre nunca chegam aos jogadores"""
+
+    def test_player_ops_follow_visibility(self):
+        scene = {'tokens': [{'id': 1, 'visible': True}, {'id': 2, 'visible': False}], 'nextTokenId': 3}
+        ops = [
+            {'op': 'update_token', 'id': 2, 'changes': {'gridX': 4}},
+            {'op': 'update_token', 'id': 1, 'changes': {'visible': False}},
+            {'op': 'update_token', 'id': 2, 'changes': {'visible': True}},
+            {'op': 'add_token', 'token': {'id': 3, 'visible': False}},
+            {'op': 'set', 'changes': {'nextTokenId': 4}},
+        ]
+        self.assertEqual(player_ops(scene, ops), [
+            {'op': 'remove_token', 'id': 1},
+            {'op': 'add_token', 'token': {'id': 2, 'visible': True, 'gridX': 4}},
+        ])
+        visible_only = [{'op': 'update_token', 'id': 1, 'changes': {'gridX': 4}}]
+        self.assertIs(player_ops(scene, visible_only), visible_only)
+
+    def test_hidden_tokens_never_reach_players(self):
+        master, room = self.create_room(2)
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            await player.connect()
+            await self.next_message(player, 'room_state')
+
+            # Oculta o token 1 e move os dois: o jogador só recebe o que vê
+            await master_socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 1, 'changes': {'visible': False, 'name': 'Segredo'}}],
+            })
+            patch = await self.next_message(player, 'scene_patch')
+            await master_socket.send_json_to({'action': 'update_scene', 'scene_data': {
+                **build_scene(2), 'nextTokenId': 2,
+                'tokens': [{**token, 'visible': token['id'] == 0} for token in build_scene(2)['tokens']],
+            }})
+            update = await self.next_message(player, 'scene_update')
+            await player.send_json_to({'action': 'get_state'})
+            state = await self.next_message(player, 'room_state')
+            await player.disconnect()
+            await master_socket.disconnect()
+            return patch, update, state
+
+        patch, update, state = async_to_sync(scenario)()
+        self.assertEqual(patch['ops'], [{'op': 'remove_token', 'id': 1}])
+        for scene_data in (update['scene_data'], state['data']['scene_data']):
+            self.assertEqual([token['id'] for token in scene_data['tokens']], [0])
+            self.assertNotIn('nextTokenId', scene_data)
+        self.assertNotIn('Segredo', json.dumps([patch, update, state]))
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, SPATIAL_CELL_SIZE=4, VIEWPORT_MARGIN=0)
+class ViewportTests(BudgetMixin, TestCase):
+    """Jogador com viewport recebe só os tokens e movimentos da área visível"""
+
+    def test_index_query(self):
+        index = SpatialIndex(build_scene(100)['tokens'])
+        self.assertEqual(sorted(token['id'] for token in index.query(Viewport.parse(0, 0, 5, 1))), [0, 1, 2, 3, 4])
+
+        index.update({'id': 0, 'gridX': 100, 'gridY': 100})
+        index.update({'id': 200, 'gridX': -2, 'gridY': -2, 'size': 3})
+        index.remove(4)
+        self.assertEqual(sorted(token['id'] for token in index.query(Viewport.parse(0, 0, 5, 1))), [1, 2, 3, 200])
+        # Área maior que a parte ocupada da grid
+        self.assertEqual(len(index.query(Viewport.parse(-1000, -1000, 2000, 2000))), 100)
+        # Valores não finitos são recusados (int(inf) levantaria OverflowError)
+        for value in (float('inf'), float('nan')):
+            with self.assertRaises(ValueError):
+                Viewport.parse(0, 0, value, 1)
+        self.assertIsNone(Viewport.from_query('0,0,inf,1'))
+
+    def test_player_receives_only_its_viewport(self):
+        master, room = self.create_room(100)
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador', query='?viewport=0,0,4,1')
+            await master_socket.connect()
+            await player.connect()
+            received = [await self.next_message(player, 'room_state')]
+
+            # Token 10 entra na área (pelo viewport_tokens); o 20 continua fora e o 2 sai da cena
+            await master_socket.send_json_to({'action': 'patch_scene', 'ops': [
+                {'op': 'update_token', 'id': 10, 'changes': {'gridX': 2}},
+                {'op': 'update_token', 'id': 20, 'changes': {'controlledBy': 'jogador'}},
+                {'op': 'update_token', 'id': 1, 'changes': {'name': 'Guarda'}},
+                {'op': 'remove_token', 'id': 2},
+                {'op': 'remove_token', 'id': 40},
+                {'op': 'add_token', 'token': {'id': 100, 'gridX': 3, 'gridY': 0}},
+                {'op': 'add_token', 'token': {'id': 101, 'gridX': 50, 'gridY': 0}},
+            ]})
+            received.append(await self.next_message(player, 'scene_patch'))
+            received.append(await self.next_message(player, 'viewport_tokens'))
+
+            for token_id, grid_x in ((20, 30), (0, 1)):
+                await player.send_json_to({'action': 'move_token', 'token_id': token_id, 'gridX': grid_x, 'gridY': 0})
+                received.append(await self.next_message(player, 'tokens_moved'))
+
+            await player.send_json_to({'action': 'subscribe_viewport', 'x': 28, 'y': 0, 'width': 4, 'height': 1})
+            received.append(await self.next_message(player, 'viewport_tokens'))
+            await player.disconnect()
+            await master_socket.disconnect()
+            return received
+
+        state, patch, entered, hidden_move, moved, panned = async_to_sync(scenario)()
+        self.assertEqual(sorted(token['id'] for token in state['data']['scene_data']['tokens']), [0, 1, 2, 3])
+        self.assertEqual([(op['op'], op.get('id', op.get('token', {}).get('id'))) for op in patch['ops']], [
+            ('update_token', 1), ('remove_token', 2), ('add_token', 100),
+        ])
+        self.assertEqual([token['id'] for token in entered['tokens']], [10])
+        self.assertEqual(hidden_move['moves'], [])
+        self.assertEqual([move['token_id'] for move in moved['moves']], [0])
+        self.assertEqual(sorted(token['id'] for token in panned['tokens']), [20, 28, 29, 30, 31])
+        self.assertEqual(sorted(panned['removed']), [0, 1, 3, 10, 100])
+
+
+@override_settings(ASSET_UPLOAD_WORKERS=0)
+class AssetTests(TestCase):
+    """Imagens gravadas uma vez por conteúdo e servidas com cache imutável"""
+    IMAGE = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = override_settings(ASSET_ROOT=root, ASSET_STORAGE='grid.assets.LocalAssetStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        assets.reset_storage()
+        self.addCleanup(assets.reset_storage)
+        self.uploader = upload_client()
+
+    def upload(self, content):
+        return self.uploader.post('/api/upload/image/?room=UPLOAD', {'image': SimpleUploadedFile('token.png', content)})
+
+    def test_same_image_is_stored_once(self):
+        first = self.upload(self.IMAGE)
+        second = self.upload(self.IMAGE)
+        self.assertEqual((first.status_code, second.status_code), (201, 200))
+        self.assertEqual(first.json()['asset_id'], second.json()['asset_id'])
+        self.assertEqual(second.json()['status'], 'done')
+        self.assertEqual(first.json()['ref'], 'asset:' + first.json()['asset_id'])
+        self.assertEqual(Asset.objects.count(), 1)
+        self.assertEqual(self.upload(b'<svg onload="alert(1)"></svg>').status_code, 415)
+
+    def test_asset_served_with_immutable_cache(self):
+        url = self.upload(self.IMAGE).json()['url']
+        response = Client().get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.IMAGE)
+        response.close()
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        with self.assertNumQueries(0):
+            cached = Client().get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(Client().head(url).status_code, 200)
+        self.assertEqual(Client().head('/assets/' + '0' * 64 + '/').status_code, 404)
+
+    def test_cloudinary_open_fetches_from_cdn(self):
+        storage = assets.CloudinaryAssetStorage()
+        asset_id = 'a' * 64
+        fetch = mock.patch('urllib.request.urlopen', return_value=io.BytesIO(self.IMAGE))
+        with mock.patch.object(storage, 'url', return_value='https://cdn/a.png'), fetch as urlopen:
+            with storage.open(asset_id) as source:
+                self.assertEqual(source.read(), self.IMAGE)
+            self.assertEqual(urlopen.call_args[0][0], 'https://cdn/a.png')
+            urlopen.side_effect = urllib.error.HTTPError('https://cdn/a.png', 404, 'Not Found', {}, None)
+            with self.assertRaises(FileNotFoundError):
+                storage.open(asset_id)
+
+
+@override_settings(ASSET_UPLOAD_WORKERS=0, ASSET_MAX_SIZE=1024, ROOM_BROADCAST_TICK_HZ=0)
+class UploadTests(TestCase):
+    """Corpo gravado em blocos, recusado cedo quando inválido, e job consultável"""
+    IMAGE = b'\x89PNG\r\n\x1a\n' + b'\x01' * 100
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = override_settings(ASSET_ROOT=root, ASSET_STORAGE='grid.assets.LocalAssetStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        assets.reset_storage()
+        self.addCleanup(assets.reset_storage)
+        self.master = User.objects.create_user('mestre', password='senha')
+        self.room = Room.objects.create(name='Sala', master=self.master, code='UPLOAD')
+
+    async def send(self, chunks, user=None, query=b'room=UPLOAD', headers=(), csrf=b'segredo'):
+        """Envia o corpo em blocos (pelo mestre, por padrão); para no primeiro bloco se o servidor já respondeu"""
+        if csrf:
+            headers = [*headers, (b'x-csrftoken', csrf)]
+        communicator = ApplicationCommunicator(uploads.UploadConsumer.as_asgi(), {
+            'type': 'http', 'method': 'POST', 'path': '/api/upload/', 'query_string': query,
+            'headers': list(headers), 'cookies': {'csrftoken': 'segredo'}, 'user': user or self.master,
+        })
+        for index, chunk in enumerate(chunks):
+            await communicator.send_input({
+                'type': 'http.request', 'body': chunk, 'more_body': index < len(chunks) - 1,
+            })
+            if not await communicator.receive_nothing(timeout=0.05):
+                break
+        start = await communicator.receive_output()
+        body = await communicator.receive_output()
+        return start['status'], json.loads(body['body'])
+
+    def post(self, chunks, **kwargs):
+        return async_to_sync(self.send)(chunks, **kwargs)
+
+    def test_streamed_upload_becomes_asset_and_job(self):
+        master, room = self.master, self.room
+        Scene(room=room, name='Cena', is_active=True).set_scene_data(build_scene(1))
+
+        async def notified():
+            socket = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/room/{room.code}/')
+            socket.scope['user'] = master
+            socket.scope['session'] = {}
+            await socket.connect()
+            await socket.receive_json_from()
+            status, job = await self.send([self.IMAGE[:10], self.IMAGE[10:]])
+            message = await socket.receive_json_from()
+            while message['type'] != 'asset_ready':
+                message = await socket.receive_json_from()
+            await socket.disconnect()
+            return status, job, message, threading.get_ident()
+
+        # Os blocos são gravados (hash e disco) fora da thread do event loop
+        writers = []
+        write = uploads.Spool.write
+
+        def recording_write(spool, chunk):
+            writers.append(threading.get_ident())
+            write(spool, chunk)
+
+        with mock.patch.object(uploads.Spool, 'write', recording_write):
+            status, job, message, loop_thread = async_to_sync(notified)()
+        self.assertEqual(len(writers), 2)
+        self.assertNotIn(loop_thread, writers)
+        self.assertEqual((status, job['status']), (201, 'done'))
+        self.assertEqual((message['type'], message['job_id']), ('asset_ready', job['job_id']))
+        self.assertEqual(Asset.objects.get().size, len(self.IMAGE))
+        self.assertEqual(Client().get(f'/api/upload/jobs/{job["job_id"]}/').json()['status'], 'done')
+        self.assertEqual(Client().get('/api/upload/jobs/' + '0' * 64 + '/').status_code, 404)
+        self.assertEqual(self.post([self.IMAGE])[0], 200)
+
+    def test_invalid_upload_rejected_before_body_ends(self):
+        status, _ = self.post([b'<svg>' + b' ' * 20, b'x' * 100])
+        self.assertEqual(status, 415)
+        status, _ = self.post([self.IMAGE, b'x' * 100], headers=[(b'content-length', b'4096')])
+        self.assertEqual(status, 413)
+        status, _ = self.post([self.IMAGE, b'\x00' * 1024, b'x'])
+        self.assertEqual(status, 413)
+        with override_settings(ASSET_UPLOAD_WORKERS=2, ASSET_UPLOAD_QUEUE=0):
+            self.assertEqual(self.post([self.IMAGE])[0], 503)
+        self.assertEqual(Asset.objects.count(), 0)
+
+    def test_only_room_master_may_upload(self):
+        # As imagens ficam no disco do servidor: anônimos, outros usuários e
+        # pedidos sem o token CSRF são recusados antes de gravar o corpo
+        other = User.objects.create_user('outro', password='senha')
+        Room.objects.create(name='Outra', master=other, code='OUTRA')
+        with mock.patch.object(uploads, 'Spool', wraps=uploads.Spool) as spool:
+            self.assertEqual(self.post([self.IMAGE], user=AnonymousUser())[0], 403)
+            self.assertEqual(self.post([self.IMAGE], user=other)[0], 403)
+            self.assertEqual(self.post([self.IMAGE], query=b'')[0], 403)
+            self.assertEqual(self.post([self.IMAGE], csrf=b'outro')[0], 403)
+            self.assertEqual(self.post([self.IMAGE], csrf=None)[0], 403)
+            spool.assert_not_called()
+
+            image = SimpleUploadedFile('token.png', self.IMAGE)
+            response = Client().post('/api/upload/image/?room=UPLOAD', {'image': image})
+            self.assertEqual(response.status_code, 403)
+            client = Client()
+            client.force_login(other)
+            self.assertEqual(client.post('/api/upload/image/?room=UPLOAD', {'image': image}).status_code, 403)
+            spool.assert_not_called()
+        self.assertEqual(Asset.objects.count(), 0)
+
+    def test_cluster_requires_shared_job_cache(self):
+        # O job é consultado em qualquer worker: com o cluster, o cache local ao processo é um erro
+        self.assertEqual(checks.check_upload_job_cache(None), [])
+        with override_settings(CLUSTER_ENABLED=True):
+            self.assertEqual([error.id for error in checks.check_upload_job_cache(None)], ['grid.E001'])
+        redis = {'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://r'}}
+        with override_settings(CLUSTER_ENABLED=True, CACHES=redis):
+            self.assertEqual(checks.check_upload_job_cache(None), [])
+
+
+@override_settings(ASSET_UPLOAD_WORKERS=0, BACKGROUND_TILE_SIZE=256)
+class TileTests(TestCase):
+    """Fundos cortados em tiles por nível e servidos com cache imutável"""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = override_settings(ASSET_ROOT=root, ASSET_STORAGE='grid.assets.LocalAssetStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        assets.reset_storage()
+        self.addCleanup(assets.reset_storage)
+
+    def test_levels_and_missing_tiles(self):
+        self.assertEqual(tiles.level_count(256, 10), 1)
+        self.assertEqual(tiles.level_count(1000, 300), 3)
+        self.assertEqual(tiles.level_count(300, 4000), 5)
+        asset_id = '0' * 64
+        self.assertEqual(Client().get(f'/assets/{asset_id}/tiles/0/0_0/').status_code, 404)
+        self.assertEqual(Client().get(f'/assets/{asset_id}/pyramid/').status_code, 404)
+
+    @skipUnless(tiles.available(), 'Pillow não instalado')
+    def test_background_upload_builds_pyramid(self):
+        from PIL import Image
+        content = io.BytesIO()
+        Image.new('RGB', (600, 300), (10, 120, 30)).save(content, 'PNG')
+        client = upload_client()
+
+        def upload():
+            image = SimpleUploadedFile('mapa.png', content.getvalue())
+            return client.post('/api/upload/image/?room=UPLOAD&tiles=1', {'image': image})
+
+        first = upload()
+        self.assertEqual(first.status_code, 201)
+        pyramid = first.json()['pyramid']
+        self.assertEqual((pyramid['width'], pyramid['height'], pyramid['levels']), (600, 300, 3))
+
+        tile = Client().get(f'/assets/{pyramid["asset"]}/tiles/2/2_1/')
+        self.assertEqual(tile.status_code, 200)
+        self.assertIn('immutable', tile['Cache-Control'])
+        tile.close()
+        self.assertEqual(Client().get(f'/assets/{pyramid["asset"]}/tiles/2/3_0/').status_code, 404)
+        self.assertEqual(Client().get(f'/assets/{pyramid["asset"]}/pyramid/').json(), pyramid)
+        self.assertEqual(upload().status_code, 200)
+
+
+@override_settings(ASSET_UPLOAD_WORKERS=0, TOKEN_VARIANT_SIZES=(64, 128))
+class VariantTests(TestCase):
+    """Variantes da arte dos tokens geradas no upload ou no primeiro pedido"""
+
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        settings = override_settings(ASSET_ROOT=root, ASSET_STORAGE='grid.assets.LocalAssetStorage')
+        settings.enable()
+        self.addCleanup(settings.disable)
+        assets.reset_storage()
+        self.addCleanup(assets.reset_storage)
+        self.uploader = upload_client()
+
+    def upload(self, content):
+        return self.uploader.post(
+            '/api/upload/image/?room=UPLOAD', {'image': SimpleUploadedFile('token.png', content)}
+        ).json()
+
+    def test_unknown_sizes_and_missing_pillow(self):
+        asset_id = self.upload(AssetTests.IMAGE)['asset_id']
+        self.assertEqual(Client().get(f'/assets/{asset_id}/w100/').status_code, 404)
+        self.assertEqual(Client().get('/assets/' + '0' * 64 + '/w64/').status_code, 404)
+        if not variants.available():
+            response = Client().get(f'/assets/{asset_id}/w64/')
+            self.assertEqual((response.status_code, response['Location']), (302, f'/assets/{asset_id}/'))
+
+    @skipUnless(variants.available(), 'Pillow não instalado')
+    def test_variants_generated_on_upload_and_lazily(self):
+        from PIL import Image
+        content = io.BytesIO()
+        Image.new('RGBA', (600, 300), (200, 10, 10, 255)).save(content, 'PNG')
+        asset_id = self.upload(content.getvalue())['asset_id']
+        self.assertIsNotNone(variants.find_variant(asset_id, 64))
+
+        # Asset antigo, sem variantes: geradas no primeiro pedido
+        shutil.rmtree(variants.variant_dir(asset_id))
+        response = Client().get(f'/assets/{asset_id}/w128/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('immutable', response['Cache-Control'])
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as variant:
+            self.assertEqual(variant.size, (128, 64))
+        response.close()
+
+
+@override_settings(SCENE_LIST_PAGE_SIZE=2)
+class SceneListTests(TestCase):
+    """Lista de cenas paginada, com resumo mantido nas gravações e GET condicional"""
+
+    def test_summary_pages_and_conditional_get(self):
+        master = User.objects.create_user('mestre', password='senha')
+        room = Room.objects.create(name='Sala', master=master, code='LISTA')
+        for index in range(3):
+            scene_data = build_scene(index + 1)
+            scene_data['backgroundImage'] = 'asset:' + str(index) * 64
+            Scene(room=room, name=f'Cena {index}', order=index).set_scene_data(scene_data)
+        self.client.force_login(master)
+        api = f'/api/room/{room.code}/scenes/'
+
+        first = self.client.get(api)
+        self.assertEqual([scene['token_count'] for scene in first.json()['scenes']], [1, 2])
+        self.assertEqual(first.json()['scenes'][1]['thumbnail'], '1' * 64)
+        self.assertNotIn('scene_data', first.json()['scenes'][0])
+        second = self.client.get(first.json()['next'])
+        self.assertEqual(([scene['name'] for scene in second.json()['scenes']], second.json()['next']), (['Cena 2'], None))
+
+        with self.assertNumQueries(4):
+            cached = self.client.get(api, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        scene_id = first.json()['scenes'][0]['id']
+        self.client.put(f'{api}{scene_id}/', json.dumps({'scene_data': build_scene(5)}), content_type='application/json')
+        changed = self.client.get(api, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual((changed.json()['scenes'][0]['token_count'], changed.json()['scenes'][0]['thumbnail']), (5, None))
+
+
+@override_settings(ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600)
+class SceneRevisionTests(BudgetMixin, TestCase):
+    """A revisão da cena é o ETag: escritas com revisão antiga são recusadas"""
+
+    def test_conditional_requests(self):
+        master, room = self.create_room(2)
+        self.client.force_login(master)
+        scene = Scene.objects.get(room=room, is_active=True)
+        url = f'/api/room/{room.code}/scenes/{scene.id}/'
+
+        first = self.client.get(url)
+        self.assertEqual(first['ETag'], '"0"')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"0"').status_code, 304)
+
+        body = json.dumps({'scene_data': build_scene(3)})
+        saved = self.client.put(url, body, content_type='application/json', HTTP_IF_MATCH='"0"')
+        self.assertEqual((saved.status_code, saved['ETag'], saved.json()['revision']), (200, '"1"', 1))
+        stale = self.client.put(url, body, content_type='application/json', HTTP_IF_MATCH='"0"')
+        self.assertEqual((stale.status_code, stale.json()['revision']), (412, 1))
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"0"').status_code, 200)
+
+        # Tipos inválidos são recusados na entrada, antes de chegar ao write-behind
+        bad = json.dumps({'scene_data': {'tokens': [{'id': 0, 'gridX': 'a'}]}})
+        self.assertEqual(self.client.put(url, bad, content_type='application/json').status_code, 400)
+
+    def test_cold_snapshot_reused_until_revision_changes(self):
+        master, room = self.create_room(10)
+        self.client.force_login(master)
+        snapshot = async_to_sync(room_state.room_snapshot)
+
+        first = snapshot(room.code, role='master')
+        # Sala fechada: a segunda visita só confere a versão no banco, sem recarregar nem serializar
+        with self.assertNumQueries(1), mock.patch.object(room_state, 'encode_frame') as encode:
+            self.assertIs(snapshot(room.code, role='master'), first)
+        encode.assert_not_called()
+
+        url = f'/api/room/{room.code}/scenes/{Scene.objects.get(room=room, is_active=True).id}/'
+        body = json.dumps({'scene_data': build_scene(2)})
+        self.assertEqual(self.client.put(url, body, content_type='application/json').status_code, 200)
+        changed = json.loads(snapshot(room.code, role='master'))['data']
+        self.assertEqual((changed['revision'], len(changed['scene_data']['tokens'])), (1, 2))
+
+    def test_switch_keeps_concurrent_write(self):
+        master, room = self.create_room(2)
+        self.client.force_login(master)
+        scene = Scene.objects.filter(room=room, is_active=False).first()
+        fetch = views.get_object_or_404
+
+        def fetch_then_flush(model, **kwargs):
+            # Uma gravação do write-behind chega entre a leitura da cena e o save da troca
+            found = fetch(model, **kwargs)
+            if model is Scene:
+                Scene.objects.filter(pk=found.pk).update(revision=7, snapshot_revision=7, token_count=5)
+            return found
+
+        with mock.patch.object(views, 'get_object_or_404', fetch_then_flush):
+            response = self.client.post(f'/api/room/{room.code}/scenes/{scene.id}/switch/')
+        self.assertEqual(response.status_code, 200)
+        scene.refresh_from_db()
+        self.assertEqual((scene.is_active, scene.revision, scene.snapshot_revision, scene.token_count), (True, 7, 7, 5))
+        self.assertEqual(Scene.objects.filter(room=room, is_active=True).count(), 1)
+
+    def test_open_scene_has_one_write_path(self):
+        master, room = self.create_room(2)
+        self.client.force_login(master)
+        scene = Scene.objects.get(room=room, is_active=True)
+        url = f'/api/room/{room.code}/scenes/{scene.id}/'
+
+        def put(revision):
+            return self.client.put(
+                url, json.dumps({'scene_data': build_scene(1)}),
+                content_type='application/json', HTTP_IF_MATCH=f'"{revision}"'
+            )
+
+        async def scenario():
+            socket = self.communicator(room, user=master)
+            await socket.connect()
+            await self.next_message(socket, 'room_state')
+
+            # Cena inteira baseada em uma revisão antiga: só o mestre recebe o conflito
+            await socket.send_json_to({'action': 'update_scene', 'scene_data': build_scene(0), 'if_match': 5})
+            conflict = await self.next_message(socket, 'scene_conflict')
+            await socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 0, 'changes': {'gridX': 9}}],
+            })
+            await self.next_message(socket, 'scene_patch')
+
+            # A API enxerga a revisão em memória (o banco ainda não foi gravado)
+            stale = await sync_to_async(put)(0)
+            saved = await sync_to_async(put)(1)
+            update = await self.next_message(socket, 'scene_update')
+            current = await sync_to_async(self.client.get)(url)
+            unsaved = await sync_to_async(lambda: Scene.objects.get(pk=scene.pk).revision)()
+            await socket.disconnect()
+            return conflict, stale, saved, update, current, unsaved
+
+        conflict, stale, saved, update, current, unsaved = async_to_sync(scenario)()
+        self.assertEqual(conflict['revision'], 0)
+        self.assertEqual((stale.status_code, saved.status_code, update['revision']), (412, 200, 2))
+        self.assertEqual((current['ETag'], len(current.json()['scene_data']['tokens'])), ('"2"', 1))
+        # Uma única gravação, feita pelo write-behind ao fechar a sala
+        self.assertEqual(unsaved, 0)
+        room.refresh_from_db()
+        self.assertIsNone(room.current_scene_data)
+        self.assertEqual(Scene.objects.get(pk=scene.pk).revision, 2)
+
+
+@override_settings(
+    ROOM_BROADCAST_TICK_HZ=0, ROOM_STATE_FLUSH_INTERVAL=3600, SCENE_SNAPSHOT_INTERVAL=1000, SCENE_OP_RETENTION=2,
+)
+class SceneHistoryTests(BudgetMixin, TestCase):
+    """Log de operações: a cena é o snapshot mais a cauda do log, e desfazer é uma operação do servidor"""
+
+    def test_inverse_and_diff_ops(self):
+        scene = build_scene(3)
+        original = copy.deepcopy(scene)
+        ops = [
+            {'op': 'update_token', 'id': 0, 'changes': {'gridX': 9}},
+            {'op': 'update_token', 'id': 0, 'changes': {'gridX': 12, 'name': 'Chefe'}},
+            {'op': 'remove_token', 'id': 1},
+            {'op': 'add_token', 'token': {'id': 7, 'name': 'Novo'}},
+            {'op': 'set', 'changes': {'gridSize': 40, 'backgroundImage': 'asset:' + 'a' * 64}},
+        ]
+        inverse = inverse_ops(scene, ops)
+        apply_ops(apply_ops(scene, ops), inverse)
+        by_id = lambda scene_data: {token['id']: token for token in scene_data['tokens']}
+        self.assertEqual(by_id(scene), by_id(original))
+        self.assertEqual((scene['gridSize'], scene['backgroundImage']), (50, None))
+
+        target = apply_ops(copy.deepcopy(original), ops)
+        rebuilt = apply_ops(copy.deepcopy(original), diff_scene(original, target))
+        self.assertEqual((by_id(rebuilt), rebuilt['gridSize']), (by_id(target), 40))
+
+    def test_ops_with_wrong_types_rejected(self):
+        for op in (
+            {'op': 'update_token', 'id': 0, 'changes': {'gridX': 'a'}},
+            {'op': 'update_token', 'id': 0, 'changes': {'size': True}},
+            {'op': 'update_token', 'id': 0, 'changes': {'visible': 0}},
+            {'op': 'update_token', 'id': '0', 'changes': {}},
+            {'op': 'remove_token', 'id': None},
+            {'op': 'add_token', 'token': {'id': 1, 'gridY': 1.5}},
+            {'op': 'update_token', 'id': 0, 'changes': {'gridX': 2 ** 31}},
+            {'op': 'update_token', 'id': 0, 'changes': {'name': 7}},
+            {'op': 'update_token', 'id': 0, 'changes': {'name': 'x' * 101}},
+            {'op': 'update_token', 'id': 0, 'changes': {'controlledBy': 'x' * 51}},
+            {'op': 'add_token', 'token': {'id': 1, 'imageSrc': ['asset:a']}},
+        ):
+            with self.assertRaises(ValueError):
+                validate_ops([op])
+        # O mesmo vale para a cena inteira (update_scene e API), que aceita nulos
+        for token in ({'id': 1, 'name': {'a': 1}}, {'id': 1, 'controlledBy': 'x' * 51}):
+            with self.assertRaises(ValueError):
+                validate_scene({'tokens': [token]})
+        validate_scene({'tokens': [{'id': 1, 'name': None, 'imageSrc': None, 'controlledBy': None}]})
+        validate_ops([{'op': 'add_token', 'token': {
+            'id': 1, 'gridX': 2, 'visible': False, 'name': 'x' * 100, 'imageSrc': 'x' * 5000,
+        }}])
+
+    def test_log_tail_compaction_and_undo(self):
+        master, room = self.create_room(2)
+        scene = Scene.objects.get(room=room, is_active=True)
+
+        def stored():
+            current = Scene.objects.get(pk=scene.pk)
+            return current.snapshot_revision, current.get_scene_data(), current.tokens.get(token_id=0).grid_x
+
+        async def scenario():
+            master_socket = self.communicator(room, user=master)
+            player = self.communicator(room, player_name='jogador')
+            await master_socket.connect()
+            await player.connect()
+            await self.next_message(player, 'room_state')
+            # Posições que não são inteiros nem entram na sala
+            for grid_x in ('5', True, None):
+                await player.send_json_to({'action': 'move_token', 'token_id': 0, 'gridX': grid_x, 'gridY': 0})
+            await player.send_json_to({'action': 'get_state'})
+            await self.next_message(player, 'room_state')
+            self.assertEqual(room_state._rooms[room.code].pending_moves, {})
+
+            await master_socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 1, 'changes': {'gridX': 9}}],
+            })
+            await self.next_message(master_socket, 'scene_patch')
+            await player.send_json_to({'action': 'move_token', 'token_id': 0, 'gridX': 5, 'gridY': 5})
+            await self.next_message(master_socket, 'tokens_moved')
+            # Desfaz só a edição do mestre: o movimento do jogador continua
+            history = []
+            for action in ('undo', 'redo', 'undo', 'undo'):
+                await master_socket.send_json_to({'action': action})
+            for _ in range(3):
+                history.append(await self.next_message(master_socket, 'scene_patch'))
+
+            # Write-behind sem snapshot: só as entradas do log são gravadas
+            await room_state._rooms[room.code].flush()
+            tail = await sync_to_async(stored)()
+            await player.disconnect()
+            await master_socket.disconnect()
+            return history, tail
+
+        history, (snapshot_revision, scene_data, grid_x) = async_to_sync(scenario)()
+        self.assertEqual([message['history'] for message in history], ['undo', 'redo', 'undo'])
+        self.assertEqual(history[0]['ops'], [{'op': 'update_token', 'id': 1, 'changes': {'gridX': 1}}])
+        self.assertEqual((snapshot_revision, grid_x), (0, 0))
+        self.assertEqual([(token['gridX'], token['gridY']) for token in scene_data['tokens']], [(5, 5), (1, 0)])
+
+        # A desconexão compacta: snapshot em dia e só as últimas entradas do log
+        snapshot_revision, scene_data, grid_x = stored()
+        self.assertEqual((snapshot_revision, grid_x), (5, 5))
+        self.assertEqual(list(SceneOp.objects.filter(scene=scene).values_list('revision', 'kind')), [
+            (4, SceneOp.REDO), (5, SceneOp.UNDO),
+        ])
+
+    def test_extra_fields_survive_log_replay_and_undo(self):
+        master, room = self.create_room(2)
+        scene = Scene.objects.get(room=room, is_active=True)
+
+        def with_hp(hp):
+            scene_data = build_scene(2)
+            scene_data['tokens'][0]['hp'] = hp
+            return {**scene_data, 'weather': f'chuva {hp}'}
+
+        def stored():
+            scene_data = Scene.objects.get(pk=scene.pk).get_scene_data()
+            return scene_data['tokens'][0].get('hp'), scene_data.get('weather')
+
+        async def scenario():
+            socket = self.communicator(room, user=master)
+            await socket.connect()
+            await self.next_message(socket, 'room_state')
+            results = []
+            for hp in (5, 9):
+                await socket.send_json_to({'action': 'update_scene', 'scene_data': with_hp(hp)})
+                await self.next_message(socket, 'scene_update')
+            # Só o log é gravado: a cena lida do banco é o snapshot mais a cauda
+            await room_state._rooms[room.code].flush()
+            results.append(await sync_to_async(stored)())
+            await socket.send_json_to({'action': 'undo'})
+            await self.next_message(socket, 'scene_patch')
+            await room_state._rooms[room.code].flush()
+            results.append(await sync_to_async(stored)())
+            await socket.disconnect()
+            return results
+
+        self.assertEqual(async_to_sync(scenario)(), [(9, 'chuva 9'), (5, 'chuva 5')])
+
+    @override_settings(ROOM_STATE_FLUSH_INTERVAL=0.05)
+    def test_failed_final_flush_keeps_room_until_retry(self):
+        master, room = self.create_room(2)
+
+        async def scenario():
+            socket = self.communicator(room, user=master)
+            await socket.connect()
+            await socket.send_json_to({
+                'action': 'patch_scene',
+                'ops': [{'op': 'update_token', 'id': 0, 'changes': {'gridX': 9}}],
+            })
+            await self.next_message(socket, 'scene_patch')
+            with mock.patch.object(room_state.RoomState, '_write_scene', side_effect=DatabaseError('fora do ar')):
+                await socket.disconnect()
+            # A sala não foi descarregada: as alterações continuam na fila
+            state = room_state._rooms.get(room.code)
+            kept = state is not None and len(state.log) == 1
+            # O write-behind grava de novo e, sem conexões, descarrega a sala
+            for _ in range(40):
+                if room.code not in room_state._rooms:
+                    break
+                await asyncio.sleep(0.05)
+            return kept, room.code in room_state._rooms
+
+        with self.assertLogs('grid.room_state', 'ERROR'):
+            kept, loaded = async_to_sync(scenario)()
+        self.assertEqual((kept, loaded), (True, False))
+        self.assertEqual(Scene.objects.get(room=room, is_active=True).tokens.get(token_id=0).grid_x, 9)
+
+
+class MigrationTests(TestCase):
+    """Migração dos tokens do scene_data para a tabela Token com dados antigos fora do formato"""
+
+    def test_legacy_tokens_coerced_and_ids_deduplicated(self):
+        migration = importlib.import_module('grid.migrations.0005_move_scene_tokens')
+        master = User.objects.create_user('mestre', password='senha')
+        room = Room.objects.create(name='Sala', master=master, code='LEGADO')
+        scene = Scene.objects.create(room=room, name='Cena', scene_data={'gridSize': 50, 'tokens': [
+            {'id': 1, 'name': 'A', 'size': '3', 'gridX': '1.5', 'gridY': 'abc'},
+            {'id': 1, 'name': 'B' * 150, 'size': None},
+            {'name': 'Sem id', 'controlledBy': 7, 'gridX': 10 ** 12},
+            {'id': '2', 'visible': False, 'hp': 5},
+            'não é um token',
+        ]})
+
+        migration.scene_tokens_to_table(django_apps, None)
+
+        scene.refresh_from_db()
+        self.assertEqual(scene.scene_data, {'gridSize': 50})
+        rows = [
+            (token.token_id, token.name, token.size, token.grid_x, token.grid_y,
+             token.visible, token.controlled_by, token.extra)
+            for token in scene.tokens.order_by('order')
+        ]
+        # Nenhum token se perde: o id repetido e o que faltava ganham ids novos
+        self.assertEqual(rows, [
+            (1, 'A', 3, 1, 0, True, None, {}),
+            (3, 'B' * 100, 1, 0, 0, True, None, {}),
+            (4, 'Sem id', 1, 0, 0, True, '7', {}),
+            (2, '', 1, 0, 0, False, None, {'hp': 5}),
+        ])
+
+
+class LoadTestCommandTests(TransactionTestCase):
+    """O comando loadtest numa sala pequena, no próprio processo, até o relatório"""
+
+    def test_small_run_reports_stats(self):
+        creation = connections['default'].creation
+        output = io.StringIO()
+        # O comando cria e apaga um banco descartável; aqui ele roda no banco dos testes
+        # (TransactionTestCase: as conexões das threads do consumer veem as salas criadas)
+        with mock.patch.object(creation, 'create_test_db'), \
+                mock.patch.object(creation, 'destroy_test_db') as destroy:
+            call_command(
+                'loadtest', rooms=1, players=1, masters=1, tokens=4, actions=3, rate=50,
+                mix='move_token=1,patch_scene=1', json=True, stdout=output,
+            )
+        destroy.assert_called_once()
+
+        results = json.loads(output.getvalue())['results']
+        self.assertEqual((results['connections'], results['actions']), (2, 6))
+        self.assertGreater(results['frames_delivered'], 0)
+        latency = results['latency_ms']
+        self.assertIsNotNone(latency['move_token']['p50'])
+        self.assertIsNotNone(latency['scene']['p50'])
+        self.assertIsNone(latency['get_state']['p50'])
+        self.assertEqual(
+            set(results['queries']['per_action']), {'move_token', 'patch_scene', 'update_scene', 'get_state'}
+        )
+        # Todas as conexões fecharam: a sala gravou a cena e saiu da memória
+        self.assertNotIn('LOAD0000', room_state._rooms)
+        self.assertEqual(Scene.objects.get(room__code='LOAD0000').tokens.count(), 4)
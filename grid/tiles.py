@@ -0,0 +1,134 @@
+"""
+Pirâmide de tiles (deep zoom) das imagens de fundo.
+
+Um mapa de fundo pode ter vários megabytes, e sem a pirâmide cada cliente baixa
+a imagem inteira antes de desenhar qualquer coisa, mesmo com o zoom em um canto.
+No upload de um fundo (?tiles=1, veja grid/uploads.py) a imagem é cortada em
+tiles de BACKGROUND_TILE_SIZE pixels, em níveis que dividem a resolução por
+dois: o nível levels - 1 é a imagem original e o nível 0 cabe em um tile só.
+
+Os tiles ficam em ASSET_ROOT/tiles/<id[:2]>/<id>/<nível>/<coluna>_<linha>.<ext>
+e são servidos por /assets/<id>/tiles/<nível>/<coluna>_<linha>/ com cache
+imutável. A cena guarda o descritor da pirâmide em backgroundTiles (além do
+backgroundImage, que continua valendo para clientes antigos), e o cliente
+busca só os tiles visíveis no nível que corresponde ao zoom.
+
+Gerar a pirâmide precisa do Pillow; sem ele o upload do fundo conclui sem
+pirâmide e a cena usa a imagem inteira.
+"""
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow é opcional: sem ele os fundos não são cortados em tiles
+    Image = None
+
+# Extensão dos arquivos -> content type, na ordem em que a view procura o tile
+TILE_FORMATS = (
+    ('webp', 'image/webp'),
+    ('jpg', 'image/jpeg'),
+    ('png', 'image/png'),
+)
+
+
+def tile_size():
+    return getattr(settings, 'BACKGROUND_TILE_SIZE', 256)
+
+
+def available():
+    return Image is not None
+
+
+def level_count(width, height, size=None):
+    """Níveis da pirâmide: a resolução cai pela metade até a imagem caber em um tile"""
+    size = size or tile_size()
+    levels = 1
+    largest = max(width, height)
+    while largest > size:
+        largest = (largest + 1) // 2
+        levels += 1
+    return levels
+
+
+def pyramid_dir(asset_id):
+    return os.path.join(str(settings.ASSET_ROOT), 'tiles', asset_id[:2], asset_id)
+
+
+def find_tile(asset_id, level, col, row):
+    """(caminho, content type) do tile, ou None se não existe"""
+    base = os.path.join(pyramid_dir(asset_id), str(level), f'{col}_{row}')
+    for extension, content_type in TILE_FORMATS:
+        path = f'{base}.{extension}'
+        if os.path.exists(path):
+            return path, content_type
+    return None
+
+
+def _tile_format(image):
+    """Formato dos tiles: WebP quando o Pillow tem suporte, senão JPEG (ou PNG com transparência)"""
+    has_alpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    if features.check('webp'):
+        return 'webp', 'WEBP', {'quality': 80}, has_alpha
+    if has_alpha:
+        return 'png', 'PNG', {'optimize': True}, True
+    return 'jpg', 'JPEG', {'quality': 85}, False
+
+
+def build_pyramid(asset_id, path):
+    """
+    Gera os tiles da imagem em path e registra a pirâmide (roda no pool de uploads).
+
+    Os tiles são gravados em uma pasta temporária renomeada no final: uma
+    pirâmide nunca fica pela metade no disco.
+    """
+    from .models import TilePyramid
+
+    pyramid = TilePyramid.objects.filter(asset_id=asset_id).first()
+    if pyramid is not None:
+        return pyramid
+
+    size = tile_size()
+    with Image.open(path) as source:
+        extension, image_format, options, has_alpha = _tile_format(source)
+        # GIF animado: só o primeiro quadro
+        image = source.convert('RGBA' if has_alpha else 'RGB')
+    width, height = image.size
+    levels = level_count(width, height, size)
+
+    target = pyramid_dir(asset_id)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp_dir = tempfile.mkdtemp(dir=os.path.dirname(target), prefix='.tiles-')
+    try:
+        for level in range(levels - 1, -1, -1):
+            level_dir = os.path.join(temp_dir, str(level))
+            os.mkdir(level_dir)
+            level_width, level_height = image.size
+            for col in range((level_width + size - 1) // size):
+                for row in range((level_height + size - 1) // size):
+                    box = (col * size, row * size, min((col + 1) * size, level_width), min((row + 1) * size, level_height))
+                    image.crop(box).save(os.path.join(level_dir, f'{col}_{row}.{extension}'), image_format, **options)
+            if level:
+                image = image.resize(
+                    (max((level_width + 1) // 2, 1), max((level_height + 1) // 2, 1)), Image.LANCZOS
+                )
+        if os.path.exists(target):
+            # Outro job gerou a mesma pirâmide antes
+            shutil.rmtree(temp_dir)
+        else:
+            os.replace(temp_dir, target)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+    pyramid, _ = TilePyramid.objects.get_or_create(asset_id=asset_id, defaults={
+        'width': width,
+        'height': height,
+        'tile_size': size,
+        'levels': levels,
+        'format': extension,
+    })
+    return pyramid
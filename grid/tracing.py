@@ -0,0 +1,243 @@
+"""
+Rastreamento por mensagem do GameRoomConsumer (opt-in).
+
+Cada mensagem recebida no socket (receive) e cada mensagem do grupo entregue a
+uma conexão (send_frame, room_invalidated) vira um trace com o código da sala e
+a ação. Dentro dele, os trechos caros marcam spans: decodificação, chamadas ao
+banco, serialização dos frames e group_send. Ao final:
+
+- traces sorteados (TRACING_SAMPLE_RATE) vão para o log 'grid.tracing' em DEBUG;
+- traces acima de TRACING_SLOW_MS vão para o mesmo log em WARNING.
+
+As linhas do log são JSON (sala, ação, duração e spans em milissegundos), para
+serem filtradas por sala ou ação. Com as duas configurações zeradas (padrão),
+trace() retorna um objeto nulo sem ler o relógio.
+
+Também é possível pegar um perfil (cProfile) de uma sala específica sem
+reiniciar o worker: a view room_profile_api manda um profile_room para o grupo
+da sala e o processo que tem a sala aberta liga o profiler nas mensagens dela
+por alguns segundos, gravando depois um arquivo .pstats em TRACING_PROFILE_DIR.
+O último perfil da sala pode ser lido em texto (pstats) pela mesma view.
+
+Uso:
+
+    with tracing.trace(room_code, 'receive') as trace:
+        with tracing.span('decode'):
+            ...
+        trace.set_action(action)
+"""
+import asyncio
+import contextvars
+import cProfile
+import glob
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import tempfile
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Trace da mensagem em andamento (cada task do asyncio tem o seu contexto)
+_current = contextvars.ContextVar('grid_trace', default=None)
+
+# Perfis em andamento, indexados pelo código da sala
+_profiles = {}
+
+# O cProfile só aceita um profiler ativo por vez na thread do event loop
+_profiling = False
+
+
+def sample_rate():
+    return getattr(settings, 'TRACING_SAMPLE_RATE', 0.0)
+
+
+def slow_threshold():
+    """Limite (segundos) para uma mensagem entrar no log de lentas; 0 desliga"""
+    return getattr(settings, 'TRACING_SLOW_MS', 0) / 1000
+
+
+def profile_dir():
+    return getattr(settings, 'TRACING_PROFILE_DIR', None) or tempfile.gettempdir()
+
+
+class _NullTrace:
+    def set_action(self, action):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_TRACE = _NullTrace()
+
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    def __init__(self, room_code, action, sampled, profile):
+        self.room_code = room_code
+        self.action = action
+        self.sampled = sampled
+        self.profile = profile
+        self.spans = []
+
+    def set_action(self, action):
+        # A ação só é conhecida depois de decodificar a mensagem
+        self.action = action
+
+    def __enter__(self):
+        global _profiling
+        self._token = _current.set(self)
+        if self.profile is not None:
+            if _profiling:
+                # Outra mensagem já está sendo perfilada: esta fica de fora
+                self.profile = None
+            else:
+                _profiling = True
+                self.profile.profiler.enable()
+                self.profile.messages += 1
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        global _profiling
+        duration = time.perf_counter() - self.started
+        if self.profile is not None:
+            self.profile.profiler.disable()
+            _profiling = False
+        _current.reset(self._token)
+
+        threshold = slow_threshold()
+        if threshold and duration >= threshold:
+            logger.warning(self.to_json(duration, slow=True))
+        elif self.sampled:
+            logger.debug(self.to_json(duration, slow=False))
+        return False
+
+    def to_json(self, duration, slow):
+        return json.dumps({
+            'event': 'slow_message' if slow else 'message',
+            'room': self.room_code,
+            'action': self.action,
+            'duration_ms': round(duration * 1000, 3),
+            'spans': [
+                {'name': name, 'start_ms': round(start * 1000, 3), 'duration_ms': round(elapsed * 1000, 3)}
+                for name, start, elapsed in self.spans
+            ],
+        })
+
+
+class _Span:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        ended = time.perf_counter()
+        self.trace.spans.append((self.name, self.started - self.trace.started, ended - self.started))
+        return False
+
+
+def trace(room_code, action):
+    """Context manager de uma mensagem da sala (nulo se nada estiver ligado)"""
+    profile = _profiles.get(room_code)
+    threshold = slow_threshold()
+    rate = sample_rate()
+    if not threshold and not rate and profile is None:
+        return NULL_TRACE
+    sampled = rate > 0 and random.random() < rate
+    return Trace(room_code, action, sampled, profile)
+
+
+def span(name):
+    """Marca um trecho da mensagem em andamento (nulo fora de um trace)"""
+    current = _current.get()
+    if current is None:
+        return NULL_SPAN
+    return _Span(current, name)
+
+
+# ==================== Profiling sob demanda ====================
+
+class RoomProfile:
+    def __init__(self, room_code, seconds):
+        self.room_code = room_code
+        self.seconds = seconds
+        self.profiler = cProfile.Profile()
+        self.messages = 0
+
+
+def start_profile(room_code, seconds):
+    """
+    Liga o profiler nas mensagens da sala por alguns segundos.
+
+    Cada conexão da sala recebe o pedido; só a primeira neste processo inicia
+    o perfil. O profiler fica ligado durante o processamento de cada mensagem
+    (uma por vez), então os trechos em que a mensagem espera por I/O também
+    incluem o que o event loop executou nesse meio tempo.
+    """
+    if room_code in _profiles:
+        return False
+    _profiles[room_code] = RoomProfile(room_code, seconds)
+    asyncio.get_running_loop().call_later(seconds, stop_profile, room_code)
+    logger.info(json.dumps({'event': 'profile_started', 'room': room_code, 'seconds': seconds}))
+    return True
+
+
+def stop_profile(room_code):
+    """Desliga o perfil da sala e grava o .pstats; retorna o caminho do arquivo"""
+    profile = _profiles.pop(room_code, None)
+    if profile is None:
+        return None
+    if not profile.messages:
+        logger.info(json.dumps({'event': 'profile_empty', 'room': room_code}))
+        return None
+
+    os.makedirs(profile_dir(), exist_ok=True)
+    path = os.path.join(
+        profile_dir(), f'room-{room_code}-{time.strftime("%Y%m%d-%H%M%S")}-{os.getpid()}.pstats'
+    )
+    profile.profiler.dump_stats(path)
+    logger.info(json.dumps({
+        'event': 'profile_saved',
+        'room': room_code,
+        'messages': profile.messages,
+        'path': path,
+    }))
+    return path
+
+
+def latest_profile(room_code):
+    """Caminho do .pstats mais recente da sala (None se ainda não há perfil)"""
+    pattern = os.path.join(glob.escape(profile_dir()), f'room-{glob.escape(room_code)}-*.pstats')
+    paths = glob.glob(pattern)
+    return max(paths, key=os.path.getmtime) if paths else None
+
+
+def profile_report(path, limit=40):
+    """Saída do pstats (funções mais caras pelo tempo acumulado) de um perfil gravado"""
+    stream = io.StringIO()
+    pstats.Stats(path, stream=stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
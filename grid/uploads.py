@@ -0,0 +1,355 @@
+"""
+Pipeline de upload de imagens.
+
+O corpo do upload é gravado em blocos em um arquivo temporário (Spool), que
+calcula o SHA-256 e valida tipo e tamanho já nos primeiros bytes: um arquivo
+que não é imagem, ou que passa de ASSET_MAX_SIZE, é recusado sem esperar o
+resto do corpo. O endpoint POST /api/upload/ (UploadConsumer) recebe a imagem
+crua no corpo, direto do servidor ASGI; /api/upload/image/ (multipart ou
+base64) continua aceito.
+
+Gravar no armazenamento e processar a imagem roda em um pool de threads
+limitado (ASSET_UPLOAD_WORKERS), com no máximo ASSET_UPLOAD_QUEUE jobs na fila.
+Os dois endpoints exigem ?room=<code> e um usuário autenticado que seja o
+mestre da sala (authorize): as imagens ficam no armazenamento do servidor.
+O id do job é o id do asset (o hash do conteúdo): o cliente consulta
+/api/upload/jobs/<id>/ ou recebe um asset_ready pelo WebSocket da sala. O
+estado do job fica no cache do Django, compartilhado pelos workers (o Redis,
+com REDIS_URL; veja grid/checks.py). Com ASSET_UPLOAD_WORKERS = 0 o
+processamento acontece na própria requisição.
+
+Uploads de fundo (?tiles=1) também geram a pirâmide de tiles (grid/tiles.py)
+no mesmo job; a resposta do job concluído traz o descritor em 'pyramid'. Com o
+armazenamento local, o job gera ainda as variantes reduzidas (grid/variants.py).
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.db import IntegrityError, close_old_connections
+from django.urls import reverse
+
+from . import assets, tiles, variants
+from .models import Asset, Room, TilePyramid
+
+logger = logging.getLogger(__name__)
+
+# Bytes lidos do início do arquivo para reconhecer o formato
+HEAD_SIZE = 16
+
+# Por quanto tempo o estado de um job fica disponível para consulta (segundos)
+JOB_TTL = 3600
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def max_size():
+    return getattr(settings, 'ASSET_MAX_SIZE', 50 * 1024 * 1024)
+
+
+def worker_count():
+    return getattr(settings, 'ASSET_UPLOAD_WORKERS', 2)
+
+
+def queue_limit():
+    return getattr(settings, 'ASSET_UPLOAD_QUEUE', 16)
+
+
+class UploadError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Spool:
+    """
+    Recebe o upload em blocos: grava em arquivo temporário, calcula o hash e valida no caminho.
+
+    No event loop (UploadConsumer, submit) use os métodos awrite, afinish e
+    adiscard: o hash e o disco rodam em uma thread, sem travar as salas.
+    """
+
+    def __init__(self, expected_size=None):
+        if expected_size is not None and expected_size > max_size():
+            raise UploadError(413, 'Imagem maior que o limite')
+        self.file = tempfile.NamedTemporaryFile(prefix='upload-', delete=False)
+        self.path = self.file.name
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.content_type = None
+
+    def write(self, chunk):
+        try:
+            if self.content_type is None:
+                self.head += chunk[:HEAD_SIZE]
+                if len(self.head) >= HEAD_SIZE:
+                    self._sniff()
+            self.size += len(chunk)
+            if self.size > max_size():
+                raise UploadError(413, 'Imagem maior que o limite')
+        except UploadError:
+            self.discard()
+            raise
+        self.sha256.update(chunk)
+        self.file.write(chunk)
+
+    def _sniff(self):
+        self.content_type = assets.sniff_content_type(self.head)
+        if self.content_type is None:
+            raise UploadError(415, 'Formato de imagem não suportado')
+
+    def finish(self):
+        """Fecha o arquivo e retorna o id do asset"""
+        self.file.close()
+        if self.content_type is None:
+            try:
+                self._sniff()
+            except UploadError:
+                self.discard()
+                raise
+        return self.sha256.hexdigest()
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def awrite(self, chunk):
+        await sync_to_async(self.write, thread_sensitive=False)(chunk)
+
+    async def afinish(self):
+        return await sync_to_async(self.finish, thread_sensitive=False)()
+
+    async def adiscard(self):
+        await sync_to_async(self.discard, thread_sensitive=False)()
+
+
+# ==================== Jobs ====================
+
+_executor = None
+_queued = 0
+_queued_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=worker_count(), thread_name_prefix='asset-upload')
+    return _executor
+
+
+def _job_key(job_id):
+    return f'upload-job:{job_id}'
+
+
+def job_payload(job_id, status, error=None, pyramid=None):
+    payload = {
+        'job_id': job_id,
+        'status': status,
+        'asset_id': job_id,
+        'ref': assets.reference(job_id),
+        'url': reverse('asset', args=[job_id]),
+    }
+    if error:
+        payload['error'] = error
+    if pyramid is not None:
+        payload['pyramid'] = pyramid.descriptor()
+    return payload
+
+
+def job_status(job_id):
+    """Estado do job (None se não existe); assets já gravados, sem job pendente, valem como concluídos"""
+    entry = cache.get(_job_key(job_id))
+    if entry is not None:
+        return job_payload(job_id, entry['status'], entry.get('error'))
+    if Asset.objects.filter(pk=job_id).exists():
+        return job_payload(job_id, DONE, pyramid=TilePyramid.objects.filter(asset_id=job_id).first())
+    return None
+
+
+def store_asset(job_id, path, content_type, size, user_id):
+    """Grava o arquivo no armazenamento e registra o asset (roda no pool de uploads)"""
+    if Asset.objects.filter(pk=job_id).exists():
+        return
+    with open(path, 'rb') as source:
+        assets.get_storage().save(job_id, File(source))
+    try:
+        Asset.objects.create(id=job_id, content_type=content_type, size=size, uploaded_by_id=user_id)
+    except IntegrityError:
+        # Outro upload da mesma imagem terminou antes
+        pass
+
+
+def derive_images(job_id, path, build_tiles):
+    """
+    Variantes e pirâmide de tiles do asset; retorna a pirâmide (ou None).
+
+    Uma imagem que o Pillow não consegue decodificar não falha o upload: o
+    asset já foi gravado e os clientes usam a imagem original.
+    """
+    pyramid = None
+    try:
+        if variants.available() and assets.get_storage().url(job_id) is None:
+            variants.build_variants(job_id, path)
+        if build_tiles and tiles.available():
+            pyramid = tiles.build_pyramid(job_id, path)
+    except Exception:
+        logger.warning('Imagem %s sem variantes ou tiles', job_id, exc_info=True)
+    return pyramid
+
+
+def _run_job(job_id, path, content_type, size, user_id, build_tiles=False):
+    global _queued
+    close_old_connections()
+    try:
+        store_asset(job_id, path, content_type, size, user_id)
+        pyramid = derive_images(job_id, path, build_tiles)
+        cache.delete(_job_key(job_id))
+        return job_payload(job_id, DONE, pyramid=pyramid)
+    except Exception as e:
+        logger.exception('Erro ao processar o upload %s', job_id)
+        cache.set(_job_key(job_id), {'status': FAILED, 'error': str(e)}, JOB_TTL)
+        return job_payload(job_id, FAILED, str(e))
+    finally:
+        os.unlink(path)
+        close_old_connections()
+        with _queued_lock:
+            _queued -= 1
+
+
+async def notify(room_code, payload):
+    """Avisa as conexões da sala (o mestre recebe asset_ready)"""
+    await get_channel_layer().group_send(f'game_room_{room_code}', {'type': 'asset_ready', **payload})
+
+
+async def authorize(user, room_code):
+    """Só o mestre autenticado da sala envia imagens: confira antes de gravar qualquer byte"""
+    if user is None or not user.is_authenticated or not room_code:
+        raise UploadError(403, 'Apenas o mestre da sala pode enviar imagens')
+    if not await Room.objects.filter(code=room_code, master_id=user.id).aexists():
+        raise UploadError(403, 'Apenas o mestre da sala pode enviar imagens')
+
+
+async def submit(spool, user, room_code, build_tiles=False):
+    """
+    Conclui um upload recebido (já liberado por authorize): retorna (status HTTP, resposta).
+
+    Asset que já existe (com a pirâmide, se pedida) responde na hora (200);
+    os demais entram no pool e a resposta sai com o job pendente (202). O
+    mestre recebe o asset_ready pelo WebSocket da sala.
+    """
+    global _queued
+    job_id = await spool.afinish()
+    user_id = user.id
+
+    build_tiles = build_tiles and tiles.available()
+    if await Asset.objects.filter(pk=job_id).aexists():
+        pyramid = await TilePyramid.objects.filter(asset_id=job_id).afirst()
+        if not build_tiles or pyramid is not None:
+            await spool.adiscard()
+            return 200, job_payload(job_id, DONE, pyramid=pyramid)
+
+    if worker_count() == 0:
+        with _queued_lock:
+            _queued += 1
+        payload = await database_sync_to_async(_run_job)(
+            job_id, spool.path, spool.content_type, spool.size, user_id, build_tiles
+        )
+        await notify(room_code, payload)
+        return (201 if payload['status'] == DONE else 500), payload
+
+    with _queued_lock:
+        full = _queued >= queue_limit()
+        if not full:
+            _queued += 1
+    if full:
+        await spool.adiscard()
+        raise UploadError(503, 'Fila de uploads cheia, tente novamente')
+    await database_sync_to_async(cache.set)(_job_key(job_id), {'status': PENDING}, JOB_TTL)
+    future = asyncio.get_running_loop().run_in_executor(
+        _get_executor(), _run_job, job_id, spool.path, spool.content_type, spool.size, user_id, build_tiles
+    )
+    future.add_done_callback(lambda done: asyncio.ensure_future(notify(room_code, done.result())))
+    return 202, job_payload(job_id, PENDING)
+
+
+# ==================== Endpoint com o corpo cru ====================
+
+class UploadConsumer(AsyncHttpConsumer):
+    """
+    POST /api/upload/?room=<code>&tiles=1 com a imagem no corpo.
+
+    Cada bloco do corpo vai para o Spool assim que chega do servidor ASGI; o
+    tamanho declarado (Content-Length) e o tipo são conferidos antes do resto
+    do corpo.
+    """
+
+    async def http_request(self, message):
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        room_code = query.get('room', [None])[0]
+        try:
+            if not hasattr(self, 'spool'):
+                # Recusa quem não é o mestre já no primeiro bloco, sem tocar no disco
+                self.check_csrf()
+                await authorize(self.scope.get('user'), room_code)
+                # Cria o arquivo temporário fora do event loop
+                self.spool = await sync_to_async(self.start, thread_sensitive=False)()
+            if message.get('body'):
+                await self.spool.awrite(message['body'])
+            if message.get('more_body'):
+                return
+            build_tiles = query.get('tiles', [''])[0] == '1'
+            status, payload = await submit(self.spool, self.scope.get('user'), room_code, build_tiles)
+        except UploadError as error:
+            status, payload = error.status, {'error': str(error)}
+        await self.send_json(status, payload)
+        raise StopConsumer()
+
+    def check_csrf(self):
+        """
+        O login vem do cookie de sessão: exige o X-CSRFToken igual ao cookie
+        csrftoken, que um formulário de outro site não consegue enviar.
+        """
+        token = self.scope.get('cookies', {}).get('csrftoken', '')
+        header = dict(self.scope['headers']).get(b'x-csrftoken', b'')
+        if not token or not hmac.compare_digest(header, token.encode()):
+            raise UploadError(403, 'Token CSRF ausente ou inválido')
+
+    def start(self):
+        if self.scope['method'] != 'POST':
+            raise UploadError(405, 'Método não permitido')
+        headers = dict(self.scope['headers'])
+        try:
+            expected_size = int(headers[b'content-length'])
+        except (KeyError, ValueError):
+            expected_size = None
+        return Spool(expected_size)
+
+    async def send_json(self, status, payload):
+        await self.send_response(
+            status, json.dumps(payload).encode(), headers=[(b'Content-Type', b'application/json')]
+        )
+
+    async def disconnect(self):
+        # Cliente desistiu no meio do envio
+        spool = getattr(self, 'spool', None)
+        if spool is not None and not spool.file.closed:
+            await spool.adiscard()
@@ -0,0 +1,86 @@
+"""
+Variantes reduzidas das imagens (arte dos tokens).
+
+Os tokens são desenhados com poucas dezenas de pixels, mas a arte enviada pode
+ter vários megabytes. Para cada asset são geradas versões com TOKEN_VARIANT_SIZES
+pixels no lado maior (64, 128 e 256 por padrão), em WebP quando o Pillow tem
+suporte (senão PNG), gravadas em ASSET_ROOT/variants/<id[:2]>/<id>/<lado>.<ext>.
+Como o id é o hash do conteúdo, a variante nunca muda e é servida por
+/assets/<id>/w<lado>/ com cache imutável.
+
+As variantes são geradas no job de upload (grid/uploads.py). Assets enviados
+antes disso ganham as variantes no primeiro pedido a /assets/<id>/w<lado>/. O
+cliente escolhe a variante pelo tamanho do token na tela (tokenImageUrl).
+
+Sem o Pillow a view redireciona para a imagem original.
+"""
+import os
+import tempfile
+
+from django.conf import settings
+
+try:
+    from PIL import Image, features
+except ImportError:  # Pillow é opcional: sem ele os tokens usam a imagem original
+    Image = None
+
+# Extensão dos arquivos -> content type, na ordem em que a view procura a variante
+VARIANT_FORMATS = (
+    ('webp', 'image/webp'),
+    ('png', 'image/png'),
+)
+
+
+def variant_sizes():
+    return tuple(getattr(settings, 'TOKEN_VARIANT_SIZES', (64, 128, 256)))
+
+
+def available():
+    return Image is not None
+
+
+def variant_dir(asset_id):
+    return os.path.join(str(settings.ASSET_ROOT), 'variants', asset_id[:2], asset_id)
+
+
+def find_variant(asset_id, size):
+    """(caminho, content type) da variante, ou None se ainda não foi gerada"""
+    base = os.path.join(variant_dir(asset_id), str(size))
+    for extension, content_type in VARIANT_FORMATS:
+        path = f'{base}.{extension}'
+        if os.path.exists(path):
+            return path, content_type
+    return None
+
+
+def build_variants(asset_id, source):
+    """
+    Gera as variantes que faltam a partir da imagem original (caminho ou arquivo aberto).
+
+    A imagem é decodificada uma vez e reduzida da maior variante para a menor;
+    cada arquivo é gravado com nome temporário e renomeado no final.
+    """
+    sizes = [size for size in sorted(variant_sizes(), reverse=True) if find_variant(asset_id, size) is None]
+    if not sizes:
+        return
+    if features.check('webp'):
+        extension, image_format, options = 'webp', 'WEBP', {'quality': 85}
+    else:
+        extension, image_format, options = 'png', 'PNG', {'optimize': True}
+
+    with Image.open(source) as original:
+        # GIF animado: só o primeiro quadro
+        image = original.convert('RGBA')
+    target = variant_dir(asset_id)
+    os.makedirs(target, exist_ok=True)
+    for size in sizes:
+        # thumbnail mantém a proporção e nunca amplia
+        image.thumbnail((size, size), Image.LANCZOS)
+        fd, temp_path = tempfile.mkstemp(dir=target, prefix='.variant-')
+        try:
+            with os.fdopen(fd, 'wb') as output:
+                image.save(output, image_format, **options)
+            os.replace(temp_path, os.path.join(target, f'{size}.{extension}'))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
@@ -3,15 +3,27 @@ from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib import messages
-from .models import Room, RoomMember, Scene
+from .models import Asset, Room, RoomMember, Scene, TilePyramid
 from django.views.decorators.http import require_http_methods
-from django.http import JsonResponse
-from django.views.decorators.csrf import csrf_exempt
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, JsonResponse
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.urls import reverse
+from django.utils.http import parse_etags, quote_etag
+from django.db import transaction
+from django.db.models import Count, Max
+from django.utils.safestring import mark_safe
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from . import assets, cluster, metrics, room_state, tiles, tracing, uploads, variants
+from .scene_ops import validate_scene
 import json
-import cloudinary.uploader
 import base64
+import logging
 from io import BytesIO
 
+logger = logging.getLogger(__name__)
+
 def login_view(request):
     if request.user.is_authenticated:
         return redirect('dashboard')
@@ -104,13 +116,35 @@ def create_room_view(request):
     
     return redirect('dashboard')
 
+# Caracteres escapados para embutir JSON em <script> (os mesmos do filtro json_script)
+_SCRIPT_ESCAPES = {ord('<'): '\\u003C', ord('>'): '\\u003E', ord('&'): '\\u0026'}
+
+def embedded_room_snapshot(room_code, role):
+    """Snapshot da sala para embutir no HTML (ROOM_SNAPSHOT_EMBED), ou None"""
+    if not getattr(settings, 'ROOM_SNAPSHOT_EMBED', True):
+        return None
+    if cluster.is_enabled() and async_to_sync(cluster.route)(room_code) is not None:
+        # A sala está na memória de outro worker e o banco pode estar atrás dela:
+        # sem snapshot embutido, o estado chega pelo WebSocket do dono
+        return None
+    snapshot = async_to_sync(room_state.room_snapshot)(room_code, role=role)
+    return mark_safe(snapshot.translate(_SCRIPT_ESCAPES))
+
+def room_socket_base(room_code):
+    """Endereço do worker que atende a sala (modo cluster), ou None"""
+    if not cluster.is_enabled():
+        return None
+    return async_to_sync(cluster.owner_url)(room_code)
+
 @login_required
 def master_room_view(request, room_code):
     room = get_object_or_404(Room, code=room_code, master=request.user)
     
     return render(request, 'grid/master_room.html', {
         'room': room,
-        'is_master': True
+        'is_master': True,
+        'room_snapshot': embedded_room_snapshot(room.code, 'master'),
+        'room_socket_base': room_socket_base(room.code)
     })
 
 def player_room_view(request, room_code):
@@ -124,7 +158,9 @@ def player_room_view(request, room_code):
     return render(request, 'grid/player_room.html', {
         'room': room,
         'is_master': False,
-        'player_name': player_name
+        'player_name': player_name,
+        'room_snapshot': embedded_room_snapshot(room.code, 'player'),
+        'room_socket_base': room_socket_base(room.code)
     })
 
 @login_required
@@ -140,15 +176,205 @@ def logout_view(request):
     messages.success(request, 'Logout realizado com sucesso')
     return redirect('login')
 
+# ==================== API da Sala ====================
+
+@require_http_methods(["GET"])
+def room_snapshot_api(request, room_code):
+    """Estado atual da sala (o mesmo room_state do WebSocket), comprimido com gzip se aceito"""
+    room = get_object_or_404(Room, code=room_code, is_active=True)
+    is_master = room.master_id == request.user.id
+    if not is_master and not request.session.get('player_name'):
+        return JsonResponse({'error': 'Acesso negado'}, status=403)
+    misdirected = misdirected_scene_response(room.code)
+    if misdirected is not None:
+        return misdirected
+    
+    # Jogadores recebem a projeção da cena (sem tokens ocultos)
+    compressed = 'gzip' in request.headers.get('Accept-Encoding', '')
+    response = HttpResponse(
+        async_to_sync(room_state.room_snapshot)(
+            room.code, compressed=compressed, role='master' if is_master else 'player'
+        ),
+        content_type='application/json'
+    )
+    if compressed:
+        response['Content-Encoding'] = 'gzip'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+# ==================== Métricas ====================
+
+@require_http_methods(["GET"])
+async def metrics_view(request):
+    """
+    Métricas do processo no formato do Prometheus, com o token de METRICS_TOKEN.
+    
+    O endereço de origem não serve de autenticação: atrás de um proxy local
+    todas as requisições chegam de 127.0.0.1.
+    """
+    # View assíncrona: roda no event loop, junto com as salas que ela lê
+    if not metrics.is_enabled():
+        raise Http404
+    if not metrics.is_authorized(request.headers.get('Authorization', '')):
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@login_required
+@require_http_methods(["GET", "POST"])
+def room_profile_api(request, room_code):
+    """
+    POST liga o cProfile nas mensagens da sala por alguns segundos; GET
+    retorna o último perfil gravado, em texto (pstats). Apenas o mestre da sala.
+    """
+    room = get_object_or_404(Room, code=room_code, master=request.user)
+    
+    if request.method == 'GET':
+        path = tracing.latest_profile(room.code)
+        if path is None:
+            return JsonResponse({'error': 'Nenhum perfil gravado para esta sala'}, status=404)
+        return HttpResponse(tracing.profile_report(path), content_type='text/plain; charset=utf-8')
+    
+    try:
+        data = json.loads(request.body or '{}')
+        seconds = float(data.get('seconds', 30))
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    if not 0 < seconds <= 300:
+        return JsonResponse({'error': 'seconds deve estar entre 0 e 300'}, status=400)
+    
+    # O pedido vai pelo grupo da sala: o worker que tem a sala aberta inicia o perfil
+    async_to_sync(get_channel_layer().group_send)(
+        f'game_room_{room.code}',
+        {'type': 'profile_room', 'seconds': seconds}
+    )
+    return JsonResponse({'room': room.code, 'seconds': seconds, 'profile_dir': tracing.profile_dir()})
+
 # ==================== API de Cenas ====================
 
+# Maior página aceita em ?page_size= na lista de cenas
+SCENE_LIST_MAX_PAGE_SIZE = 200
+
+def scene_summary(scene):
+    """Resumo de uma cena para a lista (sem scene_data nem tokens)"""
+    return {
+        'id': scene.id,
+        'name': scene.name,
+        'is_active': scene.is_active,
+        'order': scene.order,
+        'revision': scene.revision,
+        'token_count': scene.token_count,
+        'thumbnail': scene.thumbnail or None,
+        'created_at': scene.created_at,
+        'updated_at': scene.updated_at
+    }
+
+def scene_etag(revision):
+    """ETag de uma cena: a própria revisão"""
+    return quote_etag(str(revision))
+
+def if_match_revision(request):
+    """Revisão pedida no If-Match (None sem o cabeçalho ou com *)"""
+    etags = parse_etags(request.headers.get('If-Match', ''))
+    if not etags or etags == ['*']:
+        return None
+    try:
+        return int(etags[0].removeprefix('W/').strip('"'))
+    except ValueError:
+        # ETag que não é de cena: nunca corresponde
+        return -1
+
+def stale_scene_response(revision):
+    """412: a cena mudou desde a revisão do If-Match"""
+    response = JsonResponse({'error': 'A cena foi alterada', 'revision': revision}, status=412)
+    response['ETag'] = scene_etag(revision)
+    return response
+
+def misdirected_scene_response(room_code):
+    """
+    421 com a URL do dono quando a sala pertence a outro worker (modo cluster):
+    a cena ativa pode estar na memória dele, à frente do banco. None se a sala é daqui.
+    """
+    if not cluster.is_enabled():
+        return None
+    owner_url = async_to_sync(cluster.route)(room_code)
+    if owner_url is None:
+        return None
+    return JsonResponse({'error': 'A sala está em outro worker', 'owner_url': owner_url}, status=421)
+
 @login_required
 @require_http_methods(["GET"])
 def list_scenes_api(request, room_code):
-    """Lista todas as cenas de uma sala"""
+    """
+    Lista as cenas de uma sala: só o resumo, paginado (?page=, ?page_size=).
+    
+    O scene_data completo vem de get_scene_api, quando o mestre abre a cena.
+    A resposta tem ETag: com If-None-Match igual, responde 304 sem ler as cenas.
+    """
     room = get_object_or_404(Room, code=room_code, master=request.user)
-    scenes = room.scenes.all().values('id', 'name', 'scene_data', 'is_active', 'order', 'created_at', 'updated_at')
-    return JsonResponse({'scenes': list(scenes)})
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        page_size = int(request.GET.get('page_size', settings.SCENE_LIST_PAGE_SIZE))
+    except ValueError:
+        return JsonResponse({'error': 'Página inválida'}, status=400)
+    page_size = min(max(page_size, 1), SCENE_LIST_MAX_PAGE_SIZE)
+    
+    # Criar, alterar, trocar ou deletar uma cena muda a contagem ou o maior updated_at
+    scenes = room.scenes.all()
+    state = scenes.aggregate(total=Count('id'), updated=Max('updated_at'))
+    etag = quote_etag(f"{state['total']}-{state['updated'].timestamp() if state['updated'] else 0}-{page}-{page_size}")
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        offset = (page - 1) * page_size
+        page_scenes = list(scenes.defer('scene_data')[offset:offset + page_size + 1])
+        has_next = len(page_scenes) > page_size
+        response = JsonResponse({
+            'scenes': [scene_summary(scene) for scene in page_scenes[:page_size]],
+            'page': page,
+            'page_size': page_size,
+            'total': state['total'],
+            'next': f'{request.path}?page={page + 1}&page_size={page_size}' if has_next else None
+        })
+    response['ETag'] = etag
+    # O navegador guarda a lista, mas sempre confirma com o servidor
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@login_required
+@require_http_methods(["GET"])
+def get_scene_api(request, room_code, scene_id):
+    """
+    Estado completo de uma cena (quando o mestre abre ou troca de cena).
+    
+    O ETag é a revisão da cena: com If-None-Match igual, responde 304 sem ler os tokens.
+    """
+    room = get_object_or_404(Room, code=room_code, master=request.user)
+    scene = get_object_or_404(Scene, id=scene_id, room=room)
+    misdirected = misdirected_scene_response(room.code)
+    if misdirected is not None:
+        return misdirected
+    # Cena ativa de uma sala aberta: a memória está à frente do banco
+    opened = async_to_sync(room_state.open_scene)(room.code, scene.id)
+    if opened is not None:
+        scene.revision, scene_data = opened
+    
+    etag = scene_etag(scene.revision)
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = JsonResponse({
+            **scene_summary(scene),
+            'scene_data': scene_data if opened is not None else scene.get_scene_data()
+        })
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+def scene_api(request, room_code, scene_id):
+    """GET lê a cena completa, PUT atualiza"""
+    if request.method == 'GET':
+        return get_scene_api(request, room_code, scene_id)
+    return update_scene_api(request, room_code, scene_id)
 
 @login_required
 @require_http_methods(["POST"])
@@ -163,63 +389,99 @@ def create_scene_api(request, room_code):
         
         if not name:
             return JsonResponse({'error': 'Nome da cena é obrigatório'}, status=400)
+        validate_scene(scene_data)
         
         # Verificar se já existe cena com esse nome
         if Scene.objects.filter(room=room, name=name).exists():
             return JsonResponse({'error': 'Já existe uma cena com esse nome'}, status=400)
         
         # Criar cena
-        scene = Scene.objects.create(
+        scene = Scene(
             room=room,
             name=name,
-            scene_data=scene_data,
             is_active=not room.scenes.exists(),  # Primeira cena é ativa
             order=room.scenes.count()
         )
+        scene.set_scene_data(scene_data)
         
         return JsonResponse({
-            'id': scene.id,
-            'name': scene.name,
-            'scene_data': scene.scene_data,
-            'is_active': scene.is_active,
-            'order': scene.order,
-            'created_at': scene.created_at.isoformat(),
-            'updated_at': scene.updated_at.isoformat()
+            **scene_summary(scene),
+            'scene_data': scene.get_scene_data()
         })
     except json.JSONDecodeError:
         return JsonResponse({'error': 'JSON inválido'}, status=400)
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
 
 @login_required
 @require_http_methods(["PUT"])
 def update_scene_api(request, room_code, scene_id):
-    """Atualiza uma cena existente"""
+    """
+    Atualiza uma cena existente.
+    
+    Com If-Match (o ETag de get_scene_api), só altera se a cena ainda está
+    naquela revisão; senão responde 412 com a revisão atual. Cada troca do
+    scene_data incrementa a revisão.
+    """
     room = get_object_or_404(Room, code=room_code, master=request.user)
-    scene = get_object_or_404(Scene, id=scene_id, room=room)
     
     try:
         data = json.loads(request.body)
+    except json.JSONDecodeError:
+        return JsonResponse({'error': 'JSON inválido'}, status=400)
+    try:
+        validate_scene(data.get('scene_data'))
+    except ValueError as error:
+        return JsonResponse({'error': str(error)}, status=400)
+    # Só o dono da sala grava: aqui a troca não passaria pela memória dele
+    misdirected = misdirected_scene_response(room.code)
+    if misdirected is not None:
+        return misdirected
+    expected = if_match_revision(request)
+    
+    # Cena ativa de uma sala aberta: a troca passa pelo estado em memória (e vai
+    # para os jogadores); a gravação fica com o write-behind da sala
+    opened = None
+    replaced = False
+    if 'scene_data' in data:
+        try:
+            revision = async_to_sync(room_state.put_scene)(room.code, scene_id, data['scene_data'], expected)
+        except room_state.StaleRevision as error:
+            return stale_scene_response(error.revision)
+        if revision is not None:
+            opened = (revision, data['scene_data'] or {})
+            replaced = True
+            expected = None
+    elif expected is not None:
+        opened = async_to_sync(room_state.open_scene)(room.code, scene_id)
+    
+    with transaction.atomic():
+        scene = get_object_or_404(Scene.objects.select_for_update(), id=scene_id, room=room)
+        if opened is not None:
+            scene.revision = opened[0]
+        if expected is not None and expected != scene.revision:
+            return stale_scene_response(scene.revision)
         
         if 'name' in data:
             scene.name = data['name']
-        if 'scene_data' in data:
-            scene.scene_data = data['scene_data']
         if 'is_active' in data:
             scene.is_active = data['is_active']
         if 'order' in data:
             scene.order = data['order']
         
-        scene.save()
-        
-        return JsonResponse({
-            'id': scene.id,
-            'name': scene.name,
-            'scene_data': scene.scene_data,
-            'is_active': scene.is_active,
-            'order': scene.order,
-            'updated_at': scene.updated_at.isoformat()
-        })
-    except json.JSONDecodeError:
-        return JsonResponse({'error': 'JSON inválido'}, status=400)
+        if 'scene_data' in data and not replaced:
+            scene.revision += 1
+            scene.set_scene_data(data['scene_data'])
+        else:
+            # Só os campos da lista: o scene_data e a revisão podem estar em memória
+            scene.save(update_fields=['name', 'is_active', 'order', 'updated_at'])
+    
+    response = JsonResponse({
+        **scene_summary(scene),
+        'scene_data': opened[1] if opened is not None else scene.get_scene_data()
+    })
+    response['ETag'] = scene_etag(scene.revision)
+    return response
 
 @login_required
 @require_http_methods(["DELETE"])
@@ -239,51 +501,170 @@ def switch_scene_api(request, room_code, scene_id):
     room = get_object_or_404(Room, code=room_code, master=request.user)
     scene = get_object_or_404(Scene, id=scene_id, room=room)
     
-    # Marcar como ativa (o save do model cuida de desativar outras)
+    # Marcar como ativa (o save do model cuida de desativar outras). Só esses campos:
+    # o write-behind da sala pode ter gravado revisão e snapshot depois da leitura acima
     scene.is_active = True
-    scene.save()
+    scene.save(update_fields=['is_active', 'updated_at'])
     
     return JsonResponse({
-        'id': scene.id,
-        'name': scene.name,
-        'scene_data': scene.scene_data,
-        'is_active': scene.is_active
+        **scene_summary(scene),
+        'scene_data': scene.get_scene_data()
     })
 
-@csrf_exempt
+def spool_form_upload(request):
+    """Copia a imagem do formulário (arquivo ou base64) para um Spool"""
+    if request.FILES.get('image'):
+        image_file = request.FILES['image']
+        spool = uploads.Spool(image_file.size)
+        for chunk in image_file.chunks(assets.CHUNK_SIZE):
+            spool.write(chunk)
+        return spool
+    image_data = request.POST.get('image_data')
+    if not image_data:
+        raise uploads.UploadError(400, 'Nenhuma imagem fornecida')
+    
+    # Remove o prefixo data:image/...;base64, se existir
+    if ',' in image_data:
+        image_data = image_data.split(',')[1]
+    spool = uploads.Spool(len(image_data) * 3 // 4)
+    # Decodifica em blocos (múltiplos de 4 caracteres) sem criar uma segunda cópia inteira
+    step = assets.CHUNK_SIZE // 3 * 4
+    try:
+        for start in range(0, len(image_data), step):
+            spool.write(base64.b64decode(image_data[start:start + step]))
+    except ValueError:
+        spool.discard()
+        raise uploads.UploadError(400, 'image_data inválido')
+    return spool
+
 @require_http_methods(["POST"])
-def upload_image_api(request):
-    """Faz upload de imagem para o Cloudinary"""
+async def upload_image_api(request):
+    """
+    Recebe uma imagem por formulário (multipart ou base64) e grava como asset.
+    
+    Prefira POST /api/upload/ com a imagem crua no corpo (grid.uploads), que
+    valida e grava em disco enquanto o corpo chega. Aqui o corpo já foi
+    recebido pelo Django; arquivos grandes ficam em disco (FILE_UPLOAD_MAX_MEMORY_SIZE).
+    A gravação roda no pool de uploads: 202 com o job pendente, 201 se já
+    concluiu e 200 se a imagem já existia. Apenas o mestre da sala (?room=<code>).
+    """
+    room_code = request.GET.get('room')
     try:
-        # Pode ser um arquivo direto ou base64
-        if request.FILES.get('image'):
-            # Upload de arquivo direto
-            image_file = request.FILES['image']
-            result = cloudinary.uploader.upload(
-                image_file,
-                folder="rpg_grid",
-                resource_type="auto"
-            )
-        elif request.POST.get('image_data'):
-            # Upload de base64
-            image_data = request.POST.get('image_data')
-            
-            # Remove o prefixo data:image/...;base64, se existir
-            if ',' in image_data:
-                image_data = image_data.split(',')[1]
-            
-            result = cloudinary.uploader.upload(
-                f"data:image/png;base64,{image_data}",
-                folder="rpg_grid",
-                resource_type="auto"
-            )
+        user = await request.auser()
+        # Antes de ler o formulário: quem não é o mestre não grava nada no disco
+        await uploads.authorize(user, room_code)
+        spool = await sync_to_async(spool_form_upload)(request)
+        status, payload = await uploads.submit(spool, user, room_code, request.GET.get('tiles') == '1')
+    except uploads.UploadError as error:
+        return JsonResponse({'error': str(error)}, status=error.status)
+    return JsonResponse(payload, status=status)
+
+@require_http_methods(["GET"])
+def upload_job_api(request, job_id):
+    """Estado de um job de upload (pending, done ou failed)"""
+    payload = uploads.job_status(job_id) if assets.is_asset_id(job_id) else None
+    if payload is None:
+        return JsonResponse({'error': 'Job não encontrado'}, status=404)
+    return JsonResponse(payload)
+
+# Assets são imutáveis: o mesmo id sempre tem o mesmo conteúdo
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+@require_http_methods(["GET", "HEAD"])
+def asset_view(request, asset_id):
+    """Serve um asset com cache de longa duração (também usado para saber se um asset já existe)"""
+    if not assets.is_asset_id(asset_id):
+        raise Http404
+    etag = f'"{asset_id}"'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        # O conteúdo de um id nunca muda: responde sem consultar o banco
+        response = HttpResponseNotModified()
+    else:
+        asset = get_object_or_404(Asset, pk=asset_id)
+        storage = assets.get_storage()
+        url = storage.url(asset_id)
+        if url is not None:
+            response = HttpResponseRedirect(url)
+        elif request.method == 'HEAD':
+            # Só a confirmação de que o asset existe (o cliente evita o upload)
+            response = HttpResponse(content_type=asset.content_type)
+            response['Content-Length'] = asset.size
         else:
-            return JsonResponse({'error': 'Nenhuma imagem fornecida'}, status=400)
-        
-        return JsonResponse({
-            'success': True,
-            'url': result['secure_url'],
-            'public_id': result['public_id']
-        })
-    except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+            try:
+                response = FileResponse(storage.open(asset_id), content_type=asset.content_type)
+            except FileNotFoundError:
+                raise Http404
+            response['X-Content-Type-Options'] = 'nosniff'
+    response['ETag'] = etag
+    response['Cache-Control'] = ASSET_CACHE_CONTROL
+    return response
+
+@require_http_methods(["GET", "HEAD"])
+def asset_variant_view(request, asset_id, size):
+    """
+    Serve a variante reduzida de um asset (lado maior com size pixels).
+    
+    Assets enviados antes das variantes as ganham aqui, no primeiro pedido.
+    """
+    if not assets.is_asset_id(asset_id) or size not in variants.variant_sizes():
+        raise Http404
+    etag = f'"{asset_id}-w{size}"'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        found = variants.find_variant(asset_id, size)
+        if found is None:
+            asset = get_object_or_404(Asset, pk=asset_id)
+            storage = assets.get_storage()
+            url = storage.url(asset_id, size)
+            if url is not None:
+                response = HttpResponseRedirect(url)
+                response['Cache-Control'] = ASSET_CACHE_CONTROL
+                return response
+            if not variants.available():
+                # Sem Pillow: a imagem original (redirect sem cache longo, o servidor pode ganhar o Pillow)
+                return HttpResponseRedirect(reverse('asset', args=[asset.id]))
+            try:
+                with storage.open(asset_id) as source:
+                    variants.build_variants(asset_id, source)
+            except FileNotFoundError:
+                raise Http404
+            except Exception:
+                # Imagem que o Pillow não decodifica: fica a original
+                logger.warning('Variantes do asset %s não geradas', asset_id, exc_info=True)
+                return HttpResponseRedirect(reverse('asset', args=[asset.id]))
+            found = variants.find_variant(asset_id, size)
+        path, content_type = found
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['X-Content-Type-Options'] = 'nosniff'
+    response['ETag'] = etag
+    response['Cache-Control'] = ASSET_CACHE_CONTROL
+    return response
+
+@require_http_methods(["GET"])
+def asset_pyramid_view(request, asset_id):
+    """Descritor da pirâmide de tiles de um fundo (404 se o asset não tem pirâmide)"""
+    pyramid = get_object_or_404(TilePyramid, asset_id=asset_id)
+    response = JsonResponse(pyramid.descriptor())
+    # A pirâmide de um asset nunca muda depois de gerada
+    response['Cache-Control'] = ASSET_CACHE_CONTROL
+    return response
+
+@require_http_methods(["GET", "HEAD"])
+def asset_tile_view(request, asset_id, level, col, row):
+    """Serve um tile da pirâmide de um fundo, direto do disco e com cache imutável"""
+    if not assets.is_asset_id(asset_id):
+        raise Http404
+    etag = f'"{asset_id}-{level}-{col}-{row}"'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        found = tiles.find_tile(asset_id, level, col, row)
+        if found is None:
+            raise Http404
+        path, content_type = found
+        response = FileResponse(open(path, 'rb'), content_type=content_type)
+        response['X-Content-Type-Options'] = 'nosniff'
+    response['ETag'] = etag
+    response['Cache-Control'] = ASSET_CACHE_CONTROL
+    return response
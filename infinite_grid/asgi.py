@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 import os
 
 from django.core.asgi import get_asgi_application
+from django.urls import re_path
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.security.websocket import AllowedHostsOriginValidator
@@ -17,8 +18,14 @@ import grid.routing
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "infinite_grid.settings")
 
+django_asgi_app = get_asgi_application()
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": URLRouter(
+        grid.routing.http_urlpatterns + [
+            re_path(r'', django_asgi_app),
+        ]
+    ),
     "websocket": AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter(
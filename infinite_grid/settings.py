@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -75,11 +76,87 @@ WSGI_APPLICATION = "infinite_grid.wsgi.application"
 ASGI_APPLICATION = "infinite_grid.asgi.application"
 
 # Channels configuration
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# Vários workers (um daphne por núcleo): com REDIS_URL o channel layer vai para o Redis e
+# cada sala fica em um worker só, escolhido por hash consistente do código (grid/cluster.py)
+REDIS_URL = os.environ.get("REDIS_URL")
+
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [REDIS_URL],
+            },
+        }
     }
-}
+    # O estado dos jobs de upload (grid/uploads.py) precisa ser visto por todos os workers
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
+# Cluster: endereço público deste worker (para onde os sockets das salas dele são
+# redirecionados) e heartbeat/validade do registro no Redis, em segundos
+CLUSTER_ENABLED = bool(REDIS_URL)
+CLUSTER_WORKER_ID = os.environ.get("CLUSTER_WORKER_ID")
+CLUSTER_WORKER_URL = os.environ.get("CLUSTER_WORKER_URL", "")
+CLUSTER_HEARTBEAT = 5
+CLUSTER_WORKER_TTL = 15
+
+# Estado das salas em memória: intervalo (segundos) para gravar a cena no banco
+ROOM_STATE_FLUSH_INTERVAL = 2.0
+
+# Ticks por segundo do broadcast de movimentos de tokens (0 envia sem agrupar)
+ROOM_BROADCAST_TICK_HZ = 20
+
+# Presença: segundos sem heartbeat até a conexão ser considerada perdida
+ROOM_PRESENCE_TIMEOUT = 90
+
+# Eventos guardados por sala para clientes que reconectam (retomada sem reenviar a cena)
+ROOM_REPLAY_BUFFER = 512
+
+# Fila de saída por conexão: frames sem confirmação (ack) do cliente e limite da fila
+# antes de trocar o backlog pelo estado completo da sala
+ROOM_OUTBOX_WINDOW = 64
+ROOM_OUTBOX_LIMIT = 256
+
+# Índice espacial dos tokens (células de SPATIAL_CELL_SIZE casas) e folga, em casas,
+# em volta da área assinada com subscribe_viewport
+SPATIAL_CELL_SIZE = 16
+VIEWPORT_MARGIN = 8
+
+# Embute o estado da sala no HTML das salas (primeira renderização sem esperar o WebSocket)
+ROOM_SNAPSHOT_EMBED = True
+
+# Métricas da camada de tempo real em /metrics/ (formato do Prometheus). O scrape
+# precisa mandar "Authorization: Bearer <METRICS_TOKEN>"; sem token, o endpoint recusa tudo
+METRICS_ENABLED = False
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+# Tracing por mensagem no logger grid.tracing: fração de mensagens registradas (DEBUG)
+# e limite em ms para o log de mensagens lentas (WARNING); 0 desliga
+TRACING_SAMPLE_RATE = 0.0
+TRACING_SLOW_MS = 0
+# Pasta dos perfis .pstats pedidos em /api/room/<code>/profile/ (None usa a pasta temporária)
+TRACING_PROFILE_DIR = None
+
+# Cenas por página na lista de cenas (/api/room/<code>/scenes/, ?page_size= até 200)
+SCENE_LIST_PAGE_SIZE = 50
+
+# Log de operações das cenas: a cada SCENE_SNAPSHOT_INTERVAL revisões a sala regrava o
+# snapshot (scene_data e tokens), e a compactação mantém só as últimas SCENE_OP_RETENTION
+# revisões do log anteriores ao snapshot. SCENE_UNDO_DEPTH edições podem ser desfeitas
+SCENE_SNAPSHOT_INTERVAL = 200
+SCENE_OP_RETENTION = 500
+SCENE_UNDO_DEPTH = 100
 
 # Login configuration
 LOGIN_URL = '/login/'
@@ -88,7 +165,26 @@ LOGOUT_REDIRECT_URL = '/login/'
 
 # Upload limits - Aumentado para suportar imagens base64 nas cenas
 DATA_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
-FILE_UPLOAD_MAX_MEMORY_SIZE = 52428800  # 50 MB
+# Arquivos de formulário acima disso vão para disco em vez de ficar na memória
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440  # 2,5 MB
+
+# Imagens enviadas (assets), gravadas uma vez por conteúdo. ASSET_STORAGE é a classe
+# do backend de armazenamento; o local grava em ASSET_ROOT
+ASSET_STORAGE = 'grid.assets.LocalAssetStorage'
+ASSET_ROOT = BASE_DIR / 'assets'
+
+# Pipeline de upload (grid.uploads): tamanho máximo de uma imagem, threads que gravam
+# no armazenamento (0 grava na própria requisição) e jobs na fila antes de responder 503
+ASSET_MAX_SIZE = 52428800  # 50 MB
+ASSET_UPLOAD_WORKERS = 2
+ASSET_UPLOAD_QUEUE = 16
+
+# Lado (pixels) dos tiles da pirâmide gerada para os fundos (grid/tiles.py, precisa do Pillow)
+BACKGROUND_TILE_SIZE = 256
+
+# Lados (pixels) das variantes reduzidas das imagens, escolhidas pelo cliente conforme o
+# tamanho do token na tela (grid/variants.py; iguais a TOKEN_VARIANT_SIZES em wire_format.html)
+TOKEN_VARIANT_SIZES = (64, 128, 256)
 
 # Cloudinary configuration
 import cloudinary
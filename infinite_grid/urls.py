@@ -38,13 +38,25 @@ urlpatterns = [
     path("room/<str:room_code>/", views.master_room_view, name="master_room"),
     path("room/<str:room_code>/delete/", views.delete_room_view, name="delete_room"),
     
+    # API da Sala
+    path("api/room/<str:room_code>/snapshot/", views.room_snapshot_api, name="room_snapshot"),
+    
     # API de Cenas
     path("api/room/<str:room_code>/scenes/", views.list_scenes_api, name="list_scenes"),
     path("api/room/<str:room_code>/scenes/create/", views.create_scene_api, name="create_scene"),
-    path("api/room/<str:room_code>/scenes/<int:scene_id>/", views.update_scene_api, name="update_scene"),
+    path("api/room/<str:room_code>/scenes/<int:scene_id>/", views.scene_api, name="scene"),
     path("api/room/<str:room_code>/scenes/<int:scene_id>/delete/", views.delete_scene_api, name="delete_scene"),
     path("api/room/<str:room_code>/scenes/<int:scene_id>/switch/", views.switch_scene_api, name="switch_scene"),
     
+    # Métricas (Prometheus) e perfil sob demanda
+    path("metrics/", views.metrics_view, name="metrics"),
+    path("api/room/<str:room_code>/profile/", views.room_profile_api, name="room_profile"),
+    
     # API de Upload
     path("api/upload/image/", views.upload_image_api, name="upload_image"),
+    path("api/upload/jobs/<str:job_id>/", views.upload_job_api, name="upload_job"),
+    path("assets/<str:asset_id>/", views.asset_view, name="asset"),
+    path("assets/<str:asset_id>/w<int:size>/", views.asset_variant_view, name="asset_variant"),
+    path("assets/<str:asset_id>/pyramid/", views.asset_pyramid_view, name="asset_pyramid"),
+    path("assets/<str:asset_id>/tiles/<int:level>/<int:col>_<int:row>/", views.asset_tile_view, name="asset_tile"),
 ]